@@ -0,0 +1,422 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import itertools
+import tempfile
+import multiprocessing
+from array import array
+from optparse import OptionParser
+import checksum_reader
+import dedupe
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+from partition import partition_vectors
+from metrics import peak_rss_mb
+from metrics import reset_peak_rss
+from metrics import status_mb
+
+#------------------------------------------------
+#
+# Parser benchmark, compares regex based md5deep parsing against the
+# chunked parser in checksum_reader.  Sub-file checksums are taken from
+# the bundled zip files and replicated (with renamed files) to produce
+# an input of realistic size.
+#
+# python benchmark.py -r 20000 input_files/test_subhashes.out.zip
+#
+# Stage benchmark (--suite), times each analysis stage over synthetic
+# md5deep output from a seeded generator, optionally comparing against
+# stored baselines.
+#
+# python benchmark.py --suite --blocks 1m --baseline baselines.json
+#
+#------------------------------------------------
+
+
+def read_zipped_lines(fname):
+    "returns lines of plain or compressed (e.g. zip) file"
+    return list(itertools.chain.from_iterable(
+        checksum_reader.read_line_chunks(fname)))
+
+
+def replicate_subfile_lines(lines, repeat, fd):
+    "writes repeat copies of sub-file lines, renaming files in each copy"
+    for i in xrange(repeat):
+        suffix = '.{}'.format(i)
+        for text in lines:
+            (head, sep, span) = text.rpartition(' offset ')
+            fd.write(head + suffix + sep + span + '\n')
+
+
+def time_call(func, *args):
+    "returns (elapsed seconds, result)"
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def parse_with_regex(fname):
+    "returns number of lines parsed using md5deep_subfile_re"
+    count = 0
+    for entry in dedupe.read_md5deep_subfile_entries(fname):
+        count += 1
+    return count
+
+
+def parse_chunked(fname, hash_type='MD5'):
+    "returns number of lines parsed using checksum_reader"
+    count = 0
+    for name, blocks in checksum_reader.read_subfile_blocks(fname, hash_type):
+        count += len(blocks)
+    return count
+
+
+def benchmark_parser(fname):
+    "prints throughput of regex and chunked parsers for sub-file input"
+    size = os.path.getsize(fname)
+    regex_time, regex_lines = time_call(parse_with_regex, fname)
+    chunk_time, chunk_lines = time_call(parse_chunked, fname)
+    if regex_lines != chunk_lines:
+        raise ValueError('line count mismatch: {} != {}'.format(
+            regex_lines, chunk_lines))
+    for label, elapsed in (('regex', regex_time), ('chunked', chunk_time)):
+        print '{:8} {:10} lines {:8.3f}s {:12.0f} lines/s {:8.1f} MB/s'.format(
+            label, chunk_lines, elapsed, chunk_lines / elapsed,
+            size / elapsed / (1 << 20))
+    print 'speedup  {:.1f}x'.format(regex_time / chunk_time)
+
+
+#------------------------------------------------
+# Synthetic md5deep output
+#------------------------------------------------
+
+family_size = 8         # average number of files drawn from each family
+
+
+def parse_count(text):
+    """
+    count with optional k, m or g suffix, as decimal multiples
+    >>> parse_count('10k'), parse_count('100m'), parse_count('250')
+    (10000, 100000000, 250)
+    """
+    scale = {'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9}
+    if text and text[-1].lower() in scale:
+        return int(text[:-1]) * scale[text[-1].lower()]
+    return int(text)
+
+
+def shared_digest(seed, family, position, variant):
+    "checksum of block shared by files of a family at the same position"
+    return hashlib.md5('{}:{}:{}:{}'.format(seed, family, position,
+                                            variant)).hexdigest()
+
+
+def synthetic_file(seed, idx, families, blocks_per_file, shared_ratio,
+                   conflict_density):
+    """whole-file checksum and block checksums of file idx.  Each file
+       belongs to a family, which shares blocks at shared_ratio of its
+       offsets.  conflict_density of shared blocks take one of two
+       alternative values, so that different subsets of the family share
+       different checksums for the same range"""
+    rng = random.Random((seed << 32) + idx)
+    whole = '%032x' % rng.getrandbits(128)
+    family = rng.randrange(families)
+    family_rng = random.Random((seed << 32) - 1 - family)
+    blocks = []
+    for position in xrange(rng.randint(1, 2 * blocks_per_file - 1)):
+        if family_rng.random() < shared_ratio:
+            variant = 0
+            if rng.random() < conflict_density:
+                variant = rng.randint(1, 2)
+            blocks.append(shared_digest(seed, family, position, variant))
+        else:
+            blocks.append('%032x' % rng.getrandbits(128))
+    return whole, blocks
+
+
+def generate_checksums(whole_fd, sub_fd, blocks, blocks_per_file=16,
+                       dup_ratio=0.1, shared_ratio=0.3, conflict_density=0.05,
+                       seed=1, block_size=1 << 20):
+    """writes md5deep style whole-file checksums (sorted by checksum) and
+       sub-file checksums for about blocks blocks.  dup_ratio of files
+       are exact copies of an earlier file.  Output depends only on the
+       parameters.  Block checksums are written as generated, whole-file
+       entries are held for sorting.  Returns (files, blocks) written"""
+    files = max(1, blocks // blocks_per_file)
+    families = max(1, files // family_size)
+    rng = random.Random(seed)
+    source = array('l')     # file each file is a copy of, or itself
+    entries = []
+    total = 0
+    idx = 0
+    while total < blocks:
+        if idx and rng.random() < dup_ratio:
+            source.append(source[rng.randrange(idx)])
+        else:
+            source.append(idx)
+        (whole, digests) = synthetic_file(seed, source[idx], families,
+                                          blocks_per_file, shared_ratio,
+                                          conflict_density)
+        name = '/bench/{:03d}/file{}.bin'.format(idx % 1000, idx)
+        entries.append((whole, name))
+        for position, digest in enumerate(digests):
+            sub_fd.write('{}  {} offset {}-{}\n'.format(
+                digest, name, position * block_size,
+                (position + 1) * block_size - 1))
+        total += len(digests)
+        idx += 1
+    entries.sort()
+    for whole, name in entries:
+        whole_fd.write('{}  {}\n'.format(whole, name))
+    return idx, total
+
+
+#------------------------------------------------
+# Stage benchmark
+#------------------------------------------------
+
+
+def write_checksums(whole_fname, sub_fname, args):
+    """generate_checksums to named files, returns (files, blocks) through
+       a pipe when run in a separate process"""
+    whole_fd = open(whole_fname, 'w')
+    sub_fd = open(sub_fname, 'w')
+    try:
+        return generate_checksums(whole_fd, sub_fd, *args)
+    finally:
+        whole_fd.close()
+        sub_fd.close()
+
+
+def generate_in_process(whole_fname, sub_fname, *args):
+    """same as write_checksums, run in a child process so memory used by
+       the generator is not counted against any stage"""
+    pool = multiprocessing.Pool(1)
+    try:
+        result = pool.apply(write_checksums, (whole_fname, sub_fname, args))
+        pool.close()
+    finally:
+        pool.terminate()
+    return result
+
+
+def run_stage(results, stage, unit, count, func, *args):
+    """calls func, appending wall time, throughput in count(result) units
+       and memory to results.  peak_mb is the high-water mark during the
+       stage where it can be reset (Linux), otherwise of the process so
+       far.  grown_mb is by how much the stage raised memory above what
+       earlier stages hold.  Returns result of func"""
+    if reset_peak_rss():
+        before = status_mb('VmRSS')
+        stage_peak = lambda: status_mb('VmHWM')
+    else:
+        before = peak_rss_mb()
+        stage_peak = peak_rss_mb
+    start = time.time()
+    value = func(*args)
+    elapsed = time.time() - start
+    peak = stage_peak()
+    items = count(value)
+    results.append({'stage': stage, 'unit': unit, 'items': items,
+                    'seconds': elapsed,
+                    'rate': items / elapsed if elapsed else 0.0,
+                    'peak_mb': peak,
+                    'grown_mb': max(0.0, peak - before)})
+    return value
+
+
+def graph_edges(graphs):
+    return sum(len(graph.edge_file) for graph in graphs)
+
+
+def benchmark_stages(whole_fname, sub_fname, min_blocks=2):
+    """runs each analysis stage in turn over the given checksum files,
+       measuring memory of each stage as in run_stage"""
+    FnameMap.reset()
+    ChecksumMap.reset()
+    results = []
+    fd = open(whole_fname)
+    files = sum(1 for text in fd)
+    fd.close()
+    duplicates = run_stage(results, 'identify_duplicates', 'files',
+                           lambda dups: files,
+                           dedupe.identify_duplicates, whole_fname)
+    dup_map = dedupe.create_duplicate_map(duplicates)
+    vectors = run_stage(results, 'construct_subhash_vectors', 'blocks',
+                        lambda vset: sum(len(hset) for fno, hset in vset),
+                        dedupe.construct_subhash_vectors, sub_fname, dup_map)
+    blocks = sum(len(hset) for fno, hset in vectors)
+    pruned = run_stage(results, 'prune_vectors', 'blocks',
+                       lambda vset: blocks,
+                       dedupe.prune_vectors, vectors, min_blocks)
+    del vectors
+    partitions = run_stage(results, 'partition_vectors', 'files',
+                           lambda parts: sum(len(members)
+                                             for members in parts),
+                           partition_vectors, pruned, ChecksumMap.size())
+    graphs = run_stage(results, 'build_graph_from_vectors', 'edges',
+                       graph_edges,
+                       lambda: [dedupe.build_graph_from_vectors(members)
+                                for members in partitions
+                                if len(members) > 1])
+    edges = graph_edges(graphs)
+    run_stage(results, 'process_subgraph', 'edges', lambda groups: edges,
+              dedupe.process_partitions, graphs, True)
+    return results
+
+
+def scenario_name(options):
+    "baseline key for generator parameters"
+    return 'blocks={} bpf={} dup={} shared={} conflict={} seed={}'.format(
+        options.blocks, options.blocks_per_file, options.dup_ratio,
+        options.shared_ratio, options.conflict_density, options.seed)
+
+
+def compare_baseline(results, baseline, tolerance):
+    """marks stages slower or larger than baseline by more than tolerance.
+       Stages taking under 0.1s are not compared.  Returns number of
+       regressions"""
+    previous = dict((entry['stage'], entry) for entry in baseline)
+    regressions = 0
+    for entry in results:
+        base = previous.get(entry['stage'])
+        entry['status'] = ''
+        if base is None:
+            continue
+        entry['status'] = '{:.2f}x'.format(
+            entry['seconds'] / base['seconds'] if base['seconds'] else 1.0)
+        if (entry['seconds'] > 0.1 and
+                entry['seconds'] > base['seconds'] * (1 + tolerance)) or \
+                entry['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            entry['status'] += ' REGRESSION'
+            regressions += 1
+    return regressions
+
+
+def print_results(results):
+    print '{:26} {:>12} {:>6} {:>9} {:>12} {:>9} {:>9}  {}'.format(
+        'stage', 'items', 'unit', 'seconds', 'items/s', 'peak MB',
+        'grown MB', 'vs baseline')
+    for entry in results:
+        print '{:26} {:12} {:>6} {:9.3f} {:12.0f} {:9.1f} {:9.1f}  {}'.format(
+            entry['stage'], entry['items'], entry['unit'], entry['seconds'],
+            entry['rate'], entry['peak_mb'], entry.get('grown_mb', 0.0),
+            entry.get('status', ''))
+
+
+def run_suite(options):
+    """generates synthetic input, benchmarks stages and checks or stores
+       baseline.  Returns number of regressions"""
+    work_dir = options.work_dir or tempfile.mkdtemp()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    whole_fname = os.path.join(work_dir, 'bench_hashes_sorted.out')
+    sub_fname = os.path.join(work_dir, 'bench_subhashes.out')
+    try:
+        start = time.time()
+        (files, blocks) = generate_in_process(
+            whole_fname, sub_fname, parse_count(options.blocks),
+            options.blocks_per_file, options.dup_ratio, options.shared_ratio,
+            options.conflict_density, options.seed)
+        print 'generated {} files, {} blocks in {:.1f}s'.format(
+            files, blocks, time.time() - start)
+        results = benchmark_stages(whole_fname, sub_fname)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir)
+
+    baselines = {}
+    if options.baseline and os.path.exists(options.baseline):
+        fd = open(options.baseline)
+        baselines = json.load(fd)
+        fd.close()
+    name = scenario_name(options)
+    regressions = 0
+    if name in baselines:
+        regressions = compare_baseline(results, baselines[name],
+                                       options.tolerance)
+    print_results(results)
+
+    if options.baseline and options.save_baseline:
+        baselines[name] = [dict((key, entry[key]) for key in
+                                ('stage', 'unit', 'items', 'seconds',
+                                 'peak_mb', 'grown_mb'))
+                           for entry in results]
+        fd = open(options.baseline, 'w')
+        json.dump(baselines, fd, indent=4, sort_keys=True)
+        fd.close()
+        print 'baseline saved to {}'.format(options.baseline)
+    elif regressions:
+        print '{} stage(s) regressed beyond {:.0%}'.format(regressions,
+                                                           options.tolerance)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='usage: %prog [options] [subfile_checksums]')
+    parser.add_option("-r", "--repeat", type='int', default=20000,
+                      dest="repeat",
+                      help="number of COPIES of input checksums to parse",
+                      metavar="COPIES")
+    parser.add_option("--suite", default=False, action="store_true",
+                      dest="suite",
+                      help="benchmarks analysis stages over synthetic input")
+    parser.add_option("--blocks", type='string', default='100k',
+                      dest="blocks",
+                      help="approximate number of sub-file BLOCKS generated," +
+                           " e.g. 10k, 100m",
+                      metavar="BLOCKS")
+    parser.add_option("--blocks_per_file", type='int', default=16,
+                      dest="blocks_per_file",
+                      help="average number of blocks per file")
+    parser.add_option("--dup_ratio", type='float', default=0.1,
+                      dest="dup_ratio",
+                      help="fraction of files that are whole-file duplicates")
+    parser.add_option("--shared_ratio", type='float', default=0.3,
+                      dest="shared_ratio",
+                      help="fraction of blocks shared within a file family")
+    parser.add_option("--conflict_density", type='float', default=0.05,
+                      dest="conflict_density",
+                      help="fraction of shared blocks taking conflicting" +
+                           " values")
+    parser.add_option("--seed", type='int', default=1, dest="seed",
+                      help="generator seed")
+    parser.add_option("--work_dir", type='string', default='',
+                      dest="work_dir",
+                      help="keeps generated checksums in DIR",
+                      metavar="DIR")
+    parser.add_option("--baseline", type='string', default='',
+                      dest="baseline",
+                      help="JSON FILE of baselines, compared against" +
+                           " results of the same generator parameters",
+                      metavar="FILE")
+    parser.add_option("--save_baseline", default=False, action="store_true",
+                      dest="save_baseline",
+                      help="stores results as baseline instead of comparing")
+    parser.add_option("--tolerance", type='float', default=0.25,
+                      dest="tolerance",
+                      help="fraction by which a stage may exceed baseline" +
+                           " time or memory before reported as a regression")
+    (options, args) = parser.parse_args()
+
+    dedupe.debug = False
+    dedupe.display_graph_flag = False
+    if options.suite:
+        sys.exit(1 if run_suite(options) else 0)
+    if not args:
+        args = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'input_files', 'test_subhashes.out.zip')]
+
+    lines = []
+    for fname in args:
+        lines.extend(read_zipped_lines(fname))
+
+    fd = tempfile.NamedTemporaryFile(suffix='.out')
+    replicate_subfile_lines(lines, options.repeat, fd)
+    fd.flush()
+    benchmark_parser(fd.name)
+    fd.close()
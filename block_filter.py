@@ -0,0 +1,66 @@
+#---------------------------------------------------
+# Approximate block occurrence counting, used to drop singleton blocks
+# before checksums are registered in ChecksumMap
+#---------------------------------------------------
+
+
+class BlockCounter(object):
+    """
+    counts block occurrences up to 2 using two bitmaps (seen once, seen
+    twice), each block addressed by two bit positions.  Blocks occurring
+    more than once are always reported as shared.  Singleton blocks are
+    reported as shared with a small false positive rate, about 1.5% at
+    the default of 16 bits per expected block, so callers must still
+    check exact counts
+    >>> counter = BlockCounter(100)
+    >>> counter.add_blocks([('\\x01', 0, 9), ('\\x02', 10, 19)])
+    >>> counter.add_blocks([('\\x01', 0, 9), ('\\x02', 0, 9)])
+    >>> counter.shared_blocks([('\\x01', 0, 9), ('\\x02', 0, 9)])
+    [('\\x01', 0, 9)]
+    >>> len(counter.once), len(counter.twice)
+    (1024, 1024)
+    """
+
+    bits_per_block = 16
+    min_bits = 1 << 13
+
+    def __init__(self, expected_blocks):
+        size = self.min_bits
+        while size < self.bits_per_block * expected_blocks:
+            size <<= 1
+        self.once = bytearray(size >> 3)
+        self.twice = bytearray(size >> 3)
+        self.mask = size - 1
+
+    def add_blocks(self, blocks):
+        "counts occurrence of each (digest, start, end) block"
+        once = self.once
+        twice = self.twice
+        mask = self.mask
+        for digest, start, end in blocks:
+            code = hash(digest) ^ start
+            for slot in (code & mask, (code >> 32) & mask):
+                (byte, bit) = (slot >> 3, 1 << (slot & 7))
+                if once[byte] & bit:
+                    twice[byte] |= bit
+                else:
+                    once[byte] |= bit
+
+    def shared_blocks(self, blocks):
+        "returns those blocks that have (probably) been seen more than once"
+        twice = self.twice
+        mask = self.mask
+        result = []
+        for block in blocks:
+            code = hash(block[0]) ^ block[1]
+            slot1 = code & mask
+            slot2 = (code >> 32) & mask
+            if twice[slot1 >> 3] & (1 << (slot1 & 7)) and \
+                    twice[slot2 >> 3] & (1 << (slot2 & 7)):
+                result.append(block)
+        return result
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
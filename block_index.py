@@ -0,0 +1,176 @@
+import os
+import gc
+import cPickle as pickle
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+
+#---------------------------------------------------
+# Persistent state for incremental analysis
+#---------------------------------------------------
+
+
+class BlockIndex(object):
+    """
+    whole-file checksum and blocks of each file, files holding each
+    block, and dedupe groups with the partition each file was last
+    found in.  Groups are stored resolved (file names and checksum
+    values) so they remain valid across runs.  Files are always
+    processed in name order, so re-analysing a partition gives the same
+    result whether or not the rest of the index was re-analysed
+    >>> index = BlockIndex()
+    >>> blocks = [('\\x01', 0, 9), ('\\x02', 10, 19)]
+    >>> sorted(index.update([('aa', '/a'), ('bb', '/b')],
+    ...                     [('/a', blocks), ('/b', blocks)], []))
+    ['/a', '/b']
+    >>> FnameMap.reset(); ChecksumMap.reset()
+    >>> index.vectors(['/a', '/b'], {}, 2)
+    [[0, [0, 1]], [1, [0, 1]]]
+    >>> index.replace_groups(['/a', '/b'], [{'files': ['/a', '/b']}])
+    >>> sorted(index.update([('cc', '/c')], [('/c', blocks[:1])], []))
+    ['/a', '/b', '/c']
+    >>> sorted(index.affected_files(['/c']))
+    ['/a', '/b', '/c']
+    >>> sorted(index.update([], [], ['/b']))
+    ['/a', '/b', '/c']
+    >>> index.file_entries()
+    [('aa', '/a'), ('cc', '/c')]
+    >>> FnameMap.reset(); ChecksumMap.reset()
+    """
+
+    def __init__(self):
+        self.whole = {}             # file name -> whole-file checksum
+        self.files = {}             # file name -> [(digest, start, end)]
+        self.block_files = {}       # (digest, start, end) -> set of names
+        self.duplicates = []        # whole-file duplicate groups
+        self.groups = {}            # partition key -> dedupe group
+        self.partition_of = {}      # file name -> partition key
+
+    @staticmethod
+    def load(fname):
+        "loads index from fname, or returns empty index if none saved yet"
+        if not os.path.exists(fname):
+            return BlockIndex()
+        fd = open(fname, 'rb')
+        gc.disable()    # collector passes over millions of blocks add minutes
+        try:
+            index = pickle.load(fd)
+        finally:
+            gc.enable()
+            fd.close()
+        return index
+
+    def save(self, fname):
+        "writes index to fname, replacing previous state only once complete"
+        fd = open(fname + '.tmp', 'wb')
+        gc.disable()
+        try:
+            pickle.dump(self, fd, pickle.HIGHEST_PROTOCOL)
+        finally:
+            gc.enable()
+            fd.close()
+        os.rename(fname + '.tmp', fname)
+
+    def update(self, file_entries, block_sets, removed):
+        """applies delta of (checksum, name) whole-file entries, (name,
+           blocks) block records and removed file names.  Returns names
+           of changed files and of files sharing blocks with them, before
+           or after the change"""
+        touched = set()
+        for name in removed:
+            if name in self.whole or name in self.files:
+                touched.update(self.neighbours([name]))
+                self.whole.pop(name, None)
+                self._remove_blocks(name)
+        for val, name in file_entries:
+            if self.whole.get(name) != val:
+                self.whole[name] = val
+                touched.add(name)
+        for name, blocks in block_sets or ():
+            if self.files.get(name) == blocks:
+                continue
+            touched.update(self.neighbours([name]))
+            self._remove_blocks(name)
+            self.files[name] = blocks
+            for block in blocks:
+                if block in self.block_files:
+                    self.block_files[block].add(name)
+                else:
+                    self.block_files[block] = set([name])
+            touched.update(self.neighbours([name]))
+        return touched
+
+    def _remove_blocks(self, name):
+        for block in self.files.pop(name, ()):
+            names = self.block_files[block]
+            names.discard(name)
+            if not names:
+                del self.block_files[block]
+
+    def neighbours(self, names):
+        "names together with all files sharing a block with them"
+        result = set(names)
+        for name in names:
+            for block in self.files.get(name, ()):
+                result.update(self.block_files[block])
+        return result
+
+    def affected_files(self, names):
+        """files that must be re-analysed when names have changed: names,
+           files sharing blocks with them, and all members of the
+           partitions those files were in"""
+        result = self.neighbours(names)
+        for name in list(result):
+            key = self.partition_of.get(name)
+            if key is not None:
+                result.update(self.groups[key]['files'])
+        return result
+
+    def file_entries(self):
+        "(checksum, name) for all files, in name order"
+        return [(self.whole[name], name) for name in sorted(self.whole)]
+
+    def vectors(self, names, dup_map, min_blocks):
+        """pruned [fno, [hno, ...]] vectors for names, as built by
+           generate_subfile_vectors over the full index.  Block counts
+           are taken over all files in the index"""
+        files = self.files
+        counts = {}
+        result = []
+        for name in sorted(names):
+            blocks = files.get(name, ())
+            if name in dup_map or len(blocks) < 2:
+                continue
+            hset = []
+            for block in blocks:
+                if block not in counts:
+                    counts[block] = sum(
+                        1 for other in self.block_files[block]
+                        if other not in dup_map and len(files[other]) > 1)
+                if counts[block] > 1:
+                    hset.append(ChecksumMap.get_block_id(*block))
+            if len(hset) >= min_blocks:
+                result.append([FnameMap.get_id(name), hset])
+        return result
+
+    def replace_groups(self, names, groups):
+        """drops groups of partitions holding any of names, and stores
+           groups found when re-analysing them"""
+        for name in names:
+            key = self.partition_of.get(name)
+            if key in self.groups:
+                for member in self.groups.pop(key)['files']:
+                    del self.partition_of[member]
+        for group in groups:
+            key = min(group['files'])
+            self.groups[key] = group
+            for member in group['files']:
+                self.partition_of[member] = key
+
+    def all_groups(self):
+        "all dedupe groups, ordered by partition"
+        return [self.groups[key] for key in sorted(self.groups)]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
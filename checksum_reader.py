@@ -0,0 +1,391 @@
+import os
+import sys
+import bz2
+import zlib
+import Queue
+import zipfile
+import itertools
+import threading
+from binascii import unhexlify
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#---------------------------------------------------
+# Chunked readers for md5deep output
+#---------------------------------------------------
+
+# width of hex digest for each supported checksum type
+checksum_widths = {'MD5': 32, 'SHA1': 40, 'SHA256': 64}
+
+chunk_size = 1 << 22
+
+# leading bytes identifying compressed input, and usual file suffix
+compression_types = [('\x1f\x8b', 'gzip', '.gz'),
+                     ('BZh', 'bz2', '.bz2'),
+                     ('\xfd7zXZ\x00', 'xz', '.xz'),
+                     ('\x28\xb5\x2f\xfd', 'zstd', '.zst'),
+                     ('PK\x03\x04', 'zip', '.zip')]
+
+# number of decompressed buffers queued ahead of the parser
+read_ahead = 4
+
+
+class BadSubfileEntry(ValueError):
+    pass
+
+
+class BadFileEntry(ValueError):
+    pass
+
+
+class UnsupportedCompression(IOError):
+    pass
+
+
+class TruncatedInput(IOError):
+    pass
+
+
+def checksum_width(hash_type):
+    """
+    width of hex digest for checksum type
+    >>> checksum_width('md5')
+    32
+    >>> checksum_width('SHA256')
+    64
+    """
+    return checksum_widths[hash_type.upper()]
+
+
+def compression_type(fname):
+    "returns compression of file, from its leading bytes, or None if plain"
+    fd = open(fname, 'rb')
+    head = fd.read(8)
+    fd.close()
+    for magic, kind, suffix in compression_types:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def strip_compression_suffix(fname):
+    """
+    file name without compression suffix
+    >>> strip_compression_suffix('input_files/test_hashes_sorted.out.zip')
+    'input_files/test_hashes_sorted.out'
+    >>> strip_compression_suffix('file_hashes.out')
+    'file_hashes.out'
+    """
+    for magic, kind, suffix in compression_types:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname
+
+
+def _decompressor(kind):
+    "returns new streaming decompressor object"
+    if kind == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if kind == 'bz2':
+        return bz2.BZ2Decompressor()
+    if lzma is None:
+        raise UnsupportedCompression('xz input requires lzma module')
+    return lzma.LZMADecompressor()
+
+
+def _stream_ended(decompressor):
+    """whether decompressor has read the end of its stream.  Python 2 zlib
+       and bz2 decompressors have no eof attribute: a finished bz2 stream
+       raises EOFError on further input, a finished zlib stream leaves it
+       unused"""
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    if isinstance(decompressor, bz2.BZ2Decompressor):
+        try:
+            decompressor.decompress('')
+        except EOFError:
+            return True
+        return False
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return probe.unused_data == '\0'
+
+
+def _decompressed_chunks(fname, kind):
+    """yields decompressed data of file in large buffers.  Concatenated
+       streams (e.g. from pigz or pbzip2) are read in turn, and a final
+       stream cut short raises TruncatedInput"""
+    if kind == 'zip':
+        zfd = zipfile.ZipFile(fname)
+        for member in zfd.namelist():
+            if member.endswith('/') or '__MACOSX' in member:
+                continue
+            fd = zfd.open(member)
+            for data in iter(lambda: fd.read(chunk_size), ''):
+                yield data
+            fd.close()
+        zfd.close()
+        return
+
+    fd = open(fname, 'rb')
+    if kind == 'zstd':
+        if zstandard is None:
+            raise UnsupportedCompression('zstd input requires zstandard module')
+        for data in zstandard.ZstdDecompressor().read_to_iter(
+                fd, read_size=chunk_size):
+            yield data
+        fd.close()
+        return
+
+    decompressor = _decompressor(kind)
+    for data in iter(lambda: fd.read(chunk_size), ''):
+        while data:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # stream ended exactly at end of previous buffer
+                decompressor = _decompressor(kind)
+                continue
+            if output:
+                yield output
+            data = decompressor.unused_data
+            if data:
+                decompressor = _decompressor(kind)
+    fd.close()
+    if not _stream_ended(decompressor):
+        raise TruncatedInput('{}: {} stream ends early'.format(fname, kind))
+
+
+def _read_ahead(chunks):
+    """iterates over chunks in a background thread, so that producing the
+       next buffers (decompression releases the GIL) overlaps with the
+       caller's processing of the current one"""
+    queue = Queue.Queue(read_ahead)
+    stop = threading.Event()
+
+    def put(item):
+        "queues item unless consumer has gone away"
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for data in chunks:
+                if not put((data, None)):
+                    return
+            put((None, None))
+        except Exception:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (data, error) = queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if data is None:
+                break
+            yield data
+    finally:
+        stop.set()
+
+
+def read_chunks(fname):
+    """yields contents of plain or compressed (.zip, .gz, .bz2, .xz,
+       zstd) file in large buffers, decompressing in background"""
+    kind = compression_type(fname)
+    if kind:
+        for data in _read_ahead(_decompressed_chunks(fname, kind)):
+            yield data
+        return
+    fd = open(fname, 'rb')
+    for data in iter(lambda: fd.read(chunk_size), ''):
+        yield data
+    fd.close()
+
+
+def read_range_chunks(fname, start, end):
+    "yields bytes start to end of plain file in large buffers"
+    fd = open(fname, 'rb')
+    fd.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = fd.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+    fd.close()
+
+
+def read_line_chunks(fname, chunks=None):
+    """reads file in large buffers, yielding lists of complete lines
+       with trailing newline removed.  Buffers may be given as chunks,
+       e.g. from read_range_chunks"""
+    partial = ''
+    for data in chunks if chunks is not None else read_chunks(fname):
+        lines = data.split('\n')
+        lines[0] = partial + lines[0]
+        partial = lines.pop()
+        yield lines
+    if partial:
+        yield [partial]
+
+
+def parse_file_lines(lines, width):
+    """
+    parses md5deep whole-file lines into (checksum, filename)
+    >>> list(parse_file_lines(['d41d8cd98f00b204e9800998ecf8427e  /a b'], 32))
+    [('d41d8cd98f00b204e9800998ecf8427e', '/a b')]
+    """
+    for text in lines:
+        if not text:
+            continue
+        if not text[width:width + 1].isspace():
+            raise BadFileEntry(text)
+        yield text[:width], text[width:].lstrip()
+
+
+def parse_subfile_lines(lines, width):
+    """parses md5deep sub-file lines, yielding (filename, blocks) for each
+       run of lines belonging to the same file, where blocks is a list of
+       (digest, start, end) with binary digest and integer offsets.
+       Separator is only validated where file name changes, malformed
+       lines otherwise fail digest or offset conversion
+    >>> lines = ['d41d8cd98f00b204e9800998ecf8427e  /a offset 0-1023',
+    ...          '00000000000000000000000000000001  /a offset 1024-1500',
+    ...          'd41d8cd98f00b204e9800998ecf8427e  /b offset 0-1023']
+    >>> [(name, [(d.encode('hex'), s, e) for d, s, e in blocks])
+    ...  for name, blocks in parse_subfile_lines(lines, 32)]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('/a', [('d41d8cd98f00b204e9800998ecf8427e', 0, 1023),
+             ('00000000000000000000000000000001', 1024, 1500)]),
+     ('/b', [('d41d8cd98f00b204e9800998ecf8427e', 0, 1023)])]
+    >>> list(parse_subfile_lines(['d41d8cd98f00b204e9800998ecf8427e  /a'], 32))
+    Traceback (most recent call last):
+    ...
+    BadSubfileEntry: d41d8cd98f00b204e9800998ecf8427e  /a
+    """
+    last_field = None       # file name field, including separator
+    blocks = []
+    append = blocks.append
+    unhex = unhexlify       # local names, avoids global lookup per line
+    to_int = int
+    text = None
+    try:
+        for text in lines:
+            (head, sep, span) = text.rpartition(' offset ')
+            field = head[width:]
+            if field != last_field:
+                if not sep or not field[:1].isspace():
+                    raise BadSubfileEntry(text)
+                if blocks:
+                    yield last_field.lstrip(), blocks
+                last_field = field
+                blocks = []
+                append = blocks.append
+            (start, sep, end) = span.partition('-')
+            append((unhex(head[:width]), to_int(start), to_int(end)))
+    except (TypeError, ValueError):
+        raise BadSubfileEntry(text)
+    if blocks:
+        yield last_field.lstrip(), blocks
+
+
+def read_file_entries(fname, hash_type='MD5'):
+    "yields (checksum, filename) for each line of md5deep whole-file output"
+    width = checksum_width(hash_type)
+    for lines in read_line_chunks(fname):
+        for entry in parse_file_lines(lines, width):
+            yield entry
+
+
+def read_subfile_blocks(fname, hash_type='MD5'):
+    "yields (filename, blocks) for md5deep sub-file output"
+    return parse_subfile_lines(
+        itertools.chain.from_iterable(read_line_chunks(fname)),
+        checksum_width(hash_type))
+
+
+def _file_field(text, width):
+    "file name field of sub-file line, including separator"
+    return text.rpartition(' offset ')[0][width:]
+
+
+def file_boundaries(fname, parts, hash_type='MD5'):
+    """parts + 1 byte offsets splitting plain md5deep sub-file output into
+       ranges that each start on the first line of a file, so no file is
+       split between ranges.  Each range ends at the first change of file
+       after its nominal end, so ranges may be empty when files are large
+       compared to range size
+    >>> import tempfile
+    >>> fd = tempfile.NamedTemporaryFile()
+    >>> fd.write(''.join('{:032x}  /{} offset {}-{}\\n'.format(0, name, i, i)
+    ...                  for name in 'abc' for i in range(3)))
+    >>> fd.flush()
+    >>> offsets = file_boundaries(fd.name, 3)
+    >>> offsets
+    [0, 288, 432, 432]
+    >>> [[name for name, blocks in read_subfile_range(fd.name, start, end)]
+    ...  for start, end in zip(offsets, offsets[1:])]
+    [['/a', '/b'], ['/c'], []]
+    """
+    if compression_type(fname):
+        raise UnsupportedCompression(
+            '{}: compressed input cannot be split'.format(fname))
+    width = checksum_width(hash_type)
+    size = os.path.getsize(fname)
+    offsets = [0]
+    fd = open(fname, 'rb')
+    for part in xrange(1, parts):
+        pos = max(size * part // parts, offsets[-1])
+        if pos > 0:
+            fd.seek(pos - 1)
+            fd.readline()           # move to start of next line
+        field = _file_field(fd.readline(), width)
+        boundary = size
+        while True:
+            start = fd.tell()
+            text = fd.readline()
+            if not text:
+                break
+            if _file_field(text, width) != field:
+                boundary = start
+                break
+        offsets.append(max(boundary, offsets[-1]))
+    fd.close()
+    offsets.append(size)
+    return offsets
+
+
+def read_subfile_range(fname, start, end, hash_type='MD5'):
+    """same as read_subfile_blocks, for bytes start to end of plain file,
+       as split by file_boundaries"""
+    return parse_subfile_lines(
+        itertools.chain.from_iterable(
+            read_line_chunks(fname, read_range_chunks(fname, start, end))),
+        checksum_width(hash_type))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
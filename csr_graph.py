@@ -0,0 +1,258 @@
+import itertools
+from collections import deque
+import numpy as np
+
+#---------------------------------------------------
+# Bipartite file/checksum graph in compressed sparse row form
+#---------------------------------------------------
+
+
+class CSRGraph(object):
+    """
+    Bipartite graph between files and checksums, stored as edge arrays
+    with CSR indexes in both directions.  Files and checksums are
+    numbered locally (0..nfiles-1 and 0..ncsums-1); files and csums
+    arrays map local numbers back to global fno and hno.  Where a single
+    node namespace is needed (paths, components) files are numbered
+    0..nfiles-1 and checksums nfiles..nfiles+ncsums-1.
+
+    >>> g = CSRGraph.from_vectors([[10, [1, 2]], [11, [2, 3]], [12, [7]]],
+    ...                           lambda hno: '_0_9')
+    >>> g.files.tolist(), g.csums.tolist()
+    ([10, 11, 12], [1, 2, 3, 7])
+    >>> g.csum_degrees().tolist()
+    [1, 2, 1, 1]
+    >>> g.savings()         # hno 2 stored once, for 10 bytes
+    (1, 10)
+    >>> [(f.tolist(), c.tolist(), e.tolist())
+    ...  for f, c, e in g.connected_components()]
+    [([0, 1], [0, 1, 2], [0, 1, 2, 3]), ([2], [3], [4])]
+    >>> s = g.subgraph([1], [1, 2])
+    >>> s.files.tolist(), s.csums.tolist(), s.csum_degrees().tolist()
+    ([11], [2, 3], [1, 1])
+    >>> g = CSRGraph.from_vectors([[10, [1, 5]], [13, [1, 5]], [11, [5, 6]],
+    ...                            [12, [6, 2]], [14, [6, 2]]],
+    ...                           lambda hno: '_0_9')
+    >>> g.min_cut(g.nfiles + 0, [g.nfiles + 1])     # separate hno 1 and 2
+    ([4], 1)
+    >>> g.edge_file[4], g.edge_csum[4]              # fno 11 to hno 5
+    (2, 2)
+    >>> g.remove_edges([4])
+    >>> [(f.tolist(), c.tolist()) for f, c, e in g.connected_components()]
+    [([0, 1], [0, 2]), ([2, 3, 4], [1, 3])]
+    """
+
+    def __init__(self, files, csums, edge_file, edge_csum, ranges,
+                 lengths=None):
+        self.files = files
+        self.csums = csums
+        self.ranges = ranges            # range key of each checksum
+        if lengths is None:
+            lengths = np.array([_range_length(key) for key in ranges],
+                               dtype=np.int64)
+        self.lengths = lengths          # block length of each checksum
+        self.edge_file = edge_file
+        self.edge_csum = edge_csum
+        self.live = np.ones(len(edge_file), dtype=bool)
+        self.file_ptr, self.file_edges = _index(edge_file, len(files))
+        self.csum_ptr, self.csum_edges = _index(edge_csum, len(csums))
+
+    @classmethod
+    def from_vectors(cls, vector_set, range_of):
+        """builds graph from [fno, [hno, ...]] vectors, range_of maps hno to
+           the block range used for conflict detection"""
+        files = np.array([fno for fno, hset in vector_set], dtype=np.int64)
+        lengths = [len(hset) for fno, hset in vector_set]
+        hnos = np.fromiter(itertools.chain.from_iterable(
+            hset for fno, hset in vector_set), dtype=np.int64,
+            count=sum(lengths))
+        edge_file = np.repeat(np.arange(len(files), dtype=np.int64), lengths)
+        csums, edge_csum = np.unique(hnos, return_inverse=True)
+        ranges = [range_of(hno) for hno in csums.tolist()]
+        return cls(files, csums, edge_file, edge_csum.astype(np.int64), ranges)
+
+    @property
+    def nfiles(self):
+        return len(self.files)
+
+    def csum_degrees(self):
+        "number of live edges of each checksum"
+        return np.bincount(self.edge_csum[self.live],
+                           minlength=len(self.csums))
+
+    def savings(self):
+        """(blocks, bytes) saved by storing each checksum once, rather than
+           once per live edge"""
+        copies = self.csum_degrees() - 1
+        return int(copies.sum()), int(np.dot(copies, self.lengths))
+
+    def subgraph(self, file_idx, csum_idx, edges=None):
+        """copy of graph restricted to local file and checksum numbers.
+           edges optionally limits candidate edge ids, e.g. to those of a
+           component, so extraction cost depends only on subgraph size"""
+        file_idx = np.unique(np.asarray(file_idx, dtype=np.int64))
+        csum_idx = np.unique(np.asarray(csum_idx, dtype=np.int64))
+        if edges is None:
+            edges = np.flatnonzero(self.live)
+        else:
+            edges = edges[self.live[edges]]
+        if len(file_idx) == 0 or len(csum_idx) == 0:
+            edges = edges[:0]
+        edge_file = np.searchsorted(file_idx, self.edge_file[edges])
+        edge_csum = np.searchsorted(csum_idx, self.edge_csum[edges])
+        keep = (edge_file < len(file_idx)) & (edge_csum < len(csum_idx))
+        edge_file = edge_file[keep]
+        edge_csum = edge_csum[keep]
+        edges = edges[keep]
+        keep = (file_idx[edge_file] == self.edge_file[edges]) & \
+            (csum_idx[edge_csum] == self.edge_csum[edges])
+        return CSRGraph(self.files[file_idx], self.csums[csum_idx],
+                        edge_file[keep], edge_csum[keep],
+                        [self.ranges[j] for j in csum_idx.tolist()],
+                        self.lengths[csum_idx])
+
+    def connected_components(self):
+        """returns list of (file numbers, checksum numbers, edge ids) per
+           component, using min-label hooking with pointer jumping over
+           live edges"""
+        nfiles = len(self.files)
+        parent = np.arange(nfiles + len(self.csums), dtype=np.int64)
+        edges = np.flatnonzero(self.live)
+        src = self.edge_file[edges]
+        dst = self.edge_csum[edges] + nfiles
+        while True:
+            root_src = parent[src]
+            root_dst = parent[dst]
+            differ = root_src != root_dst
+            if not differ.any():
+                break
+            low = np.minimum(root_src[differ], root_dst[differ])
+            high = np.maximum(root_src[differ], root_dst[differ])
+            np.minimum.at(parent, high, low)
+            while True:
+                grand = parent[parent]
+                if (grand == parent).all():
+                    break
+                parent = grand
+        order = np.argsort(parent, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(parent[order])) + 1
+        labels = parent[order[np.r_[0, bounds]]] if len(order) else order
+        edge_labels = parent[src]
+        edge_order = np.argsort(edge_labels, kind='mergesort')
+        edge_bounds = np.searchsorted(edge_labels[edge_order], labels)[1:]
+        components = []
+        for members, member_edges in itertools.izip(
+                np.split(order, bounds),
+                np.split(edges[edge_order], edge_bounds)):
+            split = np.searchsorted(members, nfiles)
+            components.append((members[:split], members[split:] - nfiles,
+                               member_edges))
+        return components
+
+    def neighbours(self):
+        """list of (neighbour, edge id) lists over live edges, in single
+           node namespace"""
+        nfiles = len(self.files)
+        adj = [[] for i in xrange(nfiles + len(self.csums))]
+        edges = np.flatnonzero(self.live)
+        for eid, fidx, cidx in itertools.izip(
+                edges.tolist(), self.edge_file[edges].tolist(),
+                (self.edge_csum[edges] + nfiles).tolist()):
+            adj[fidx].append((cidx, eid))
+            adj[cidx].append((fidx, eid))
+        return adj
+
+    def min_cut(self, source, sinks, limit=None, adj=None):
+        """minimum set of live edges whose removal separates source from
+           all sinks (nodes in single node namespace).  Unit capacity
+           augmenting paths, so cost is O(paths * edges) where the number
+           of paths is at most the degree of source.  Returns (edge ids,
+           paths found), or (None, paths found) if more than limit paths
+           are needed.  adj optionally gives current neighbours()"""
+        if adj is None:
+            adj = self.neighbours()
+        nfiles = len(self.files)
+        sinks = set(sinks)
+        flow = {}       # edge id -> +1 file to csum, -1 csum to file
+        paths = 0
+        while True:
+            previous = {source: None}
+            queue = deque([source])
+            reached = None
+            while queue and reached is None:
+                node = queue.popleft()
+                direction = 1 if node < nfiles else -1
+                for neighbour, eid in adj[node]:
+                    if neighbour in previous or \
+                            flow.get(eid, 0) * direction >= 1:
+                        continue
+                    previous[neighbour] = (node, eid)
+                    if neighbour in sinks:
+                        reached = neighbour
+                        break
+                    queue.append(neighbour)
+            if reached is None:
+                break
+            if limit is not None and paths >= limit:
+                return None, paths
+            paths += 1
+            node = reached
+            while previous[node] is not None:
+                (node, eid) = previous[node]
+                flow[eid] = flow.get(eid, 0) + (1 if node < nfiles else -1)
+        if len(previous) == 1 and paths:
+            # source side cut would leave source with no edges, use
+            # equally small cut closest to sinks instead
+            side = set(sinks)
+            queue = deque(sinks)
+            while queue:
+                node = queue.popleft()
+                for neighbour, eid in adj[node]:
+                    direction = 1 if neighbour < nfiles else -1
+                    if neighbour not in side and \
+                            flow.get(eid, 0) * direction < 1:
+                        side.add(neighbour)
+                        queue.append(neighbour)
+            cut = [eid for node in side for neighbour, eid in adj[node]
+                   if neighbour not in side]
+        else:
+            cut = [eid for node in previous for neighbour, eid in adj[node]
+                   if neighbour not in previous]
+        return sorted(cut), paths
+
+    def remove_edges(self, edge_ids):
+        "removes edges, given as edge ids"
+        self.live[edge_ids] = False
+
+    def to_networkx(self, encode_file, encode_csum):
+        "converts graph to networkx, for display"
+        import networkx as nx
+        graph = nx.Graph()
+        graph.add_nodes_from([encode_file(fno) for fno in self.files.tolist()],
+                             bipartite=0)
+        graph.add_nodes_from([encode_csum(hno) for hno in self.csums.tolist()],
+                             bipartite=1)
+        for fidx, cidx in itertools.izip(self.edge_file[self.live].tolist(),
+                                         self.edge_csum[self.live].tolist()):
+            graph.add_edge(encode_file(int(self.files[fidx])),
+                           encode_csum(int(self.csums[cidx])))
+        return graph
+
+
+def _range_length(key):
+    "byte length of block with range key '_<start>_<end>', end inclusive"
+    (blank, start, end) = key.split('_')
+    return int(end) - int(start) + 1
+
+
+def _index(endpoints, count):
+    "returns (ptr, edge ids) grouping edges by endpoint"
+    order = np.argsort(endpoints, kind='mergesort')
+    ptr = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(endpoints, minlength=count), out=ptr[1:])
+    return ptr, order
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,19 +1,42 @@
+import os
 import sys
 import networkx as nx
 from networkx.algorithms import bipartite
 import matplotlib.pyplot as plt
 import cPickle as pickle
 import string
+import tempfile
 import json
 import re
+import time
 import uuid
 from optparse import OptionParser
 import itertools
+import multiprocessing
+import threading
 import pprint       # used for debug only
 import pdb          # used for debug only
 #sys.path.append('/users/doug/SW_Dev/dedupe/')
 from fname_map import FnameMap
 from fname_map import ChecksumMap
+from fname_map import use_compact_tables
+from path_table import DuplicateMap
+from spill_table import use_spill_tables
+from csr_graph import CSRGraph
+from partition import partition_vectors
+from minhash import Precluster
+import parallel_parse
+from block_filter import BlockCounter
+from block_index import BlockIndex
+from vector_file import VectorFile
+from vector_file import write_vectors
+from result_file import write_results
+from stage_cache import StageCache
+from stage_cache import file_fingerprint
+from metrics import Metrics
+import scanner
+import checksum_reader
+from checksum_reader import BadSubfileEntry
 
 #------------------------------------------------
 #
@@ -85,6 +108,21 @@ def jdump(val, fname, pretty=False):
         fd.close()
 
 
+def jdump_lines(vals, fname):
+    """write out each of sequence of datastructures to file as a JSON
+       record on a line of its own, as soon as it is produced.  Returns
+       number of records written"""
+    count = 0
+    fd = open(fname, 'w+', 1)       # line buffered, records visible early
+    try:
+        for val in vals:
+            fd.write(json.dumps(val) + '\n')
+            count += 1
+    finally:
+        fd.close()
+    return count
+
+
 def dprint(val, nl=False):
     "print debug output"
     global debug
@@ -128,16 +166,36 @@ def parse_md5deep_file_entry(text):
         exit()
 
 
-def identify_duplicates(fname):
+class UnsortedInput(ValueError):
+    pass
+
+
+def identify_duplicates(fname, presorted=True, memory_limit=None,
+                        hash_type='MD5'):
     """fname composed of lines containing <filename> <hash>
-       where lines sorted by hash"""
+       where lines sorted by hash.  Falls back to sort-free grouping
+       if file turns out not to be sorted"""
+    if presorted:
+        try:
+            return identify_duplicate_entries(
+                checksum_reader.read_file_entries(fname, hash_type))
+        except UnsortedInput:
+            print 'Warning: {} not sorted by checksum,'.format(fname) + \
+                ' grouping without sort'
+    return group_duplicate_entries(
+        checksum_reader.read_file_entries(fname, hash_type), memory_limit)
+
+
+def identify_duplicate_entries(entries):
+    "entries is a sequence of (hash, filename) sorted by hash"
     duplicates = []
-    fd = open(fname)
     last_val = ""
     file_set = []
-    for text in fd:
-        (val, name) = parse_md5deep_file_entry(text)
-
+    lines = 0
+    for (val, name) in entries:
+        lines += 1
+        if val < last_val:
+            raise UnsortedInput(val)
         if val != last_val:
             if len(file_set) > 1:
                 duplicates.append(file_set)
@@ -146,25 +204,106 @@ def identify_duplicates(fname):
         file_set.append(name)
     if len(file_set) > 1:
         duplicates.append(file_set)
-    fd.close()
+    Metrics.count('whole_file_lines', lines)
     return duplicates
 
 
+# approximate per-entry cost of hash aggregation, beyond the string data
+entry_overhead = 120
+
+
+def group_duplicate_entries(entries, memory_limit=None, depth=0):
+    """groups (hash, filename) entries by hash, without requiring sorted
+       input.  Result matches identify_duplicate_entries on input sorted
+       by whole line: groups ordered by hash, file names sorted within
+       group.  Entries are aggregated in memory until memory_limit bytes
+       is reached, then spilled to temporary files partitioned by hash
+       digit, each of which is grouped in turn.  Entries of a partition
+       at the full hash width share one hash, so are grouped in memory"""
+    groups = {}
+    size = 0
+    lines = 0
+    spill = None
+    for (val, name) in entries:
+        lines += 1
+        if spill is not None:
+            _spill_entry(spill, val, name, depth)
+            continue
+        if val in groups:
+            groups[val].append(name)
+        else:
+            groups[val] = [name]
+            size += len(val) + entry_overhead
+        size += len(name) + entry_overhead
+        if memory_limit and size > memory_limit and depth >= len(val):
+            memory_limit = None     # all entries share hash, cannot partition
+        if memory_limit and size > memory_limit:
+            dprint('spilling whole-file checksums, depth {}'.format(depth))
+            spill = {}
+            for spill_val, names in groups.iteritems():
+                for spill_name in names:
+                    _spill_entry(spill, spill_val, spill_name, depth)
+            groups = None
+
+    if depth == 0:
+        Metrics.count('whole_file_lines', lines)
+    if spill is None:
+        return [sorted(groups[val]) for val in sorted(groups)
+                if len(groups[val]) > 1]
+
+    duplicates = []
+    for digit in sorted(spill):
+        fd = spill[digit]
+        fd.seek(0)
+        duplicates.extend(group_duplicate_entries(_read_spill(fd),
+                                                  memory_limit, depth + 1))
+        fd.close()
+    return duplicates
+
+
+def _spill_entry(spill, val, name, depth):
+    "appends entry to temporary partition file selected by hash digit"
+    digit = val[depth:depth + 1]
+    if digit not in spill:
+        spill[digit] = tempfile.TemporaryFile()
+    spill[digit].write('{} {}\n'.format(val, name))
+
+
+def _read_spill(fd):
+    for text in fd:
+        (val, name) = text[:-1].split(' ', 1)
+        yield val, name
+
+
 def create_duplicate_map(duplicates):
-    "creates a duplicate map, indexed by first duplicate file"
-    dup_map = {}
+    """creates a duplicate map, indexed by first duplicate file.  Paths are
+       keyed by id, with shared directories held once"""
+    dup_map = DuplicateMap()
     for dup_group in duplicates:
         primary = dup_group.pop()
         for secondary in dup_group:
-            dup_map[secondary] = primary
+            dup_map.add(secondary, primary)
     return dup_map
 
 
 def find_duplicateFiles(d_file, pickle_duplicates_fname=False,
-                        json_duplicates_fname=False):
-    "find all duplicate files based on sorted MD5 hashes"
+                        json_duplicates_fname=False, entries=None,
+                        presorted=True, memory_limit=None,
+                        hash_type='MD5'):
+    """find all duplicate files based on MD5 hashes, read from d_file
+       or taken from pre-parsed entries.  Unless presorted, input is
+       grouped by hash within memory_limit bytes"""
     dprint('identify duplicates')
-    duplicates = identify_duplicates(d_file)
+    with Metrics.timer('duplicates'):
+        if entries is None:
+            duplicates = identify_duplicates(d_file, presorted, memory_limit,
+                                             hash_type)
+        elif presorted:
+            duplicates = identify_duplicate_entries(entries)
+        else:
+            duplicates = group_duplicate_entries(entries, memory_limit)
+    Metrics.count('duplicate_groups', len(duplicates))
+    Metrics.count('duplicate_files', sum(len(group) for group in duplicates))
 
     dprint('dumping duplicates data structures')
     pdump(duplicates, pickle_duplicates_fname)
@@ -204,67 +343,164 @@ def construct_vector(name, hash_set, dup_map):
             [ChecksumMap.get_id(hval) for hval in hash_set]]
 
 
-def construct_subhash_vectors(fname, dup_map):
-    """collect set of checksums per file, substituting numeric id (fno, hno)
-    for text values"""
+def construct_block_vector(name, blocks, dup_map, counter=None):
+    """same as construct_vector, for (digest, start, end) block records.
+       If counter given, only blocks it reports as shared are kept"""
+    if name in dup_map:    # skipping -- duplicate
+        return False
+    if len(blocks) < 2:    # skipping -- empty or singleton
+        return False
+    if counter is not None:
+        blocks = counter.shared_blocks(blocks)
+        if len(blocks) == 0:   # skipping -- no shared blocks
+            return False
+    get_block_id = ChecksumMap.get_block_id
+    return [FnameMap.get_id(name),
+            [get_block_id(digest, start, end)
+             for digest, start, end in blocks]]
 
-    result = []
-    FnameMap.reset()        # initialize mapping tables
-    ChecksumMap.reset()
 
+def read_md5deep_subfile_entries(fname):
+    """yields (hval, filename) for each line of md5deep sub-file output.
+       Regex based, superseded by checksum_reader.read_subfile_blocks"""
     fd = open(fname)
-    last_name = ""
-    hash_set = []
     for text in fd:
-        (val, name) = parse_md5deep_subfile_entry(text)
+        yield parse_md5deep_subfile_entry(text)
+    fd.close()
 
-        if name != last_name:
-            vec = construct_vector(last_name, hash_set, dup_map)
-            if vec:
-                result.append(vec)
-            last_name = name
-            hash_set = []
 
-        hash_set.append(val)
+# rough size of a sub-file checksum line, used to estimate block count,
+# and typical compression ratio of checksum files
+subfile_line_size = 64
+subfile_compression_ratio = 4
 
-    vec = construct_vector(name, hash_set, dup_map)
-    if vec:
-        result.append(vec)
-    fd.close()
+
+def construct_subhash_vectors(fname, dup_map, hash_type='MD5',
+                              two_pass=False, reset_names=True,
+                              whole_savings=None, jobs=1):
+    """collect set of checksums per file, substituting numeric id (fno, hno)
+    for text values.  With two_pass, blocks are first counted so that
+    singleton blocks are never registered.  Otherwise large plain files
+    are parsed in ranges by jobs worker processes"""
+    if not two_pass and parallel_parse.splittable(fname, jobs):
+        return parallel_parse.construct_vectors_parallel(
+            fname, dup_map, jobs, hash_type, reset_names, whole_savings)
+    counter = None
+    if two_pass:
+        size = os.path.getsize(fname)
+        if checksum_reader.compression_type(fname):
+            size *= subfile_compression_ratio
+        counter = count_blocks(
+            checksum_reader.read_subfile_blocks(fname, hash_type), dup_map,
+            size // subfile_line_size)
+    return construct_block_vectors(
+        checksum_reader.read_subfile_blocks(fname, hash_type), dup_map,
+        counter, reset_names, whole_savings)
+
+
+def count_blocks(block_sets, dup_map, expected_blocks):
+    """first pass of two pass vector construction, counts occurrences of
+    blocks that construct_block_vector would accept"""
+    dprint('counting blocks')
+    counter = BlockCounter(expected_blocks)
+    with Metrics.timer('count_blocks'):
+        for name, blocks in block_sets:
+            if name not in dup_map and len(blocks) > 1:
+                counter.add_blocks(blocks)
+    return counter
+
+
+def construct_block_vectors(block_sets, dup_map, counter=None,
+                            reset_names=True, whole_savings=None):
+    """block_sets is a sequence of (filename, blocks), as produced by
+    checksum_reader.read_subfile_blocks or scanner.scan_tree.  If counter
+    given, vectors only hold blocks it reports as shared.  Unless
+    reset_names, file numbers from earlier calls are kept.  If given,
+    whole_savings 'files' and 'bytes' are increased by each duplicate
+    file left out, sized by its last block"""
+
+    result = []
+    if reset_names:
+        FnameMap.reset()    # initialize mapping tables
+    ChecksumMap.reset()
+
+    lines = 0
+    files = 0
+    for name, blocks in block_sets:
+        vec = construct_block_vector(name, blocks, dup_map, counter)
+        if vec:
+            result.append(vec)
+        elif whole_savings is not None and name in dup_map:
+            whole_savings['files'] += 1
+            whole_savings['bytes'] += blocks[-1][2] + 1 if blocks else 0
+        lines += len(blocks)
+        files += 1
+    Metrics.count('subfile_lines', lines)
+    Metrics.count('vectors_dropped', files - len(result))
+    Metrics.count('checksums', ChecksumMap.size())
     return result
 
 
 def prune_vectors(vector_set, min_blocks):
     "only keep vectors containing at least 1 shared checksum"
     result = []
-
-    for fno, hset in vector_set:
-        newset = []
-        for hno in hset:
-            if ChecksumMap.get_count(hno) > 1:
-                newset.append(hno)
-        if len(newset) >= min_blocks:
-            result.append([fno, newset])
+    vectors = 0
+    pruned = 0
+
+    with Metrics.timer('prune'):
+        for fno, hset in vector_set:
+            newset = []
+            for hno in hset:
+                if ChecksumMap.get_count(hno) > 1:
+                    newset.append(hno)
+            pruned += len(hset) - len(newset)
+            vectors += 1
+            if len(newset) >= min_blocks:
+                result.append([fno, newset])
+    Metrics.count('checksums_pruned', pruned)
+    Metrics.count('vectors_pruned', vectors - len(result))
     return result
 
 
-def output_vectors(name, vset):
-    "dumps vectors for use with alternative clustering tools"
-    if not name:
-        return
-    fd = open(name, 'w+')
-    for vec in vset:
-        fd.write('{}, {}'.format(vec, tuple))
-    fd.close()
+def construct_vectors(dsub_file, dup_map, block_sets=None, hash_type='MD5',
+                      two_pass=False, reset_names=True, whole_savings=None,
+                      jobs=1):
+    """unpruned vectors, from dsub_file or pre-parsed block records,
+       adding savings of duplicate files to whole_savings if given.
+       dsub_file may be parsed by jobs worker processes"""
+    dprint('processing sub-file hashes', nl=True)
+    with Metrics.timer('vectors'):
+        if block_sets is None:
+            return construct_subhash_vectors(dsub_file, dup_map, hash_type,
+                                             two_pass, reset_names,
+                                             whole_savings, jobs)
+        elif two_pass:
+            counter = count_blocks(block_sets, dup_map,
+                                   sum(len(blocks)
+                                       for name, blocks in block_sets))
+            return construct_block_vectors(block_sets, dup_map, counter,
+                                           reset_names, whole_savings)
+        else:
+            return construct_block_vectors(block_sets, dup_map,
+                                           reset_names=reset_names,
+                                           whole_savings=whole_savings)
 
 
 def generate_subfile_vectors(dsub_file, duplicates, min_blocks,
                              pickle_duplicates_fname=False,
-                             pickle_vectorset_fname=False,
-                             json_vectorset_fname=False,
-                             list_vectorset_fname=False):
+                             vectorset_fname=False,
+                             block_sets=None, hash_type='MD5',
+                             two_pass=False, whole_savings=None, jobs=1,
+                             pending=None):
     """top level routine - convert file checksums to vectors,
-       pruning non-shared entries"""
+       pruning non-shared entries.  Checksums read from dsub_file or taken
+       from pre-parsed (filename, blocks) records.  With two_pass, singleton
+       blocks are dropped before vectors are built, and dumped vectors only
+       hold (probably) shared blocks.  Vectors are dumped before pruning to
+       vectorset_fname, in vector_file format.  Savings of duplicate files
+       are added to whole_savings, if given.  dsub_file is parsed by jobs
+       worker processes where large enough.  If given, pending is a
+       parallel_parse.PendingVectors already parsing dsub_file"""
 
     dprint('creating duplicates map', nl=True)
     if pickle_duplicates_fname:
@@ -272,32 +508,60 @@ def generate_subfile_vectors(dsub_file, duplicates, min_blocks,
         duplicates = pload(pickle_duplicates_fname)
     dup_map = create_duplicate_map(duplicates)
 
-    dprint('processing sub-file hashes', nl=True)
-    vector_set = construct_subhash_vectors(dsub_file, dup_map)
+    if pending is not None:
+        dprint('merging sub-file hashes', nl=True)
+        with Metrics.timer('vectors'):
+            vector_set = pending.vectors(dup_map,
+                                         whole_savings=whole_savings)
+    else:
+        vector_set = construct_vectors(dsub_file, dup_map, block_sets,
+                                       hash_type, two_pass,
+                                       whole_savings=whole_savings, jobs=jobs)
 
     dprint('pruning', nl=True)
     pruned_vector_set = prune_vectors(vector_set, min_blocks)
 
-    pdump(vector_set, pickle_vectorset_fname)
-    jdump(vector_set, json_vectorset_fname)
-    output_vectors(list_vectorset_fname, vector_set)
+    if vectorset_fname:
+        print 'Outputting vectors to: {}'.format(vectorset_fname)
+        write_vectors(vectorset_fname, vector_set)
 
     return pruned_vector_set
 
+#----------------------------------------------------
+# Built-in checksum scan, replaces external md5deep step
+#----------------------------------------------------
+
+
+def scan_checksums(root, block_size, hash_type='MD5', threads=None):
+    """hashes all files below root.  Returns whole-file entries, and
+       (filename, blocks) records spilled to a temporary file as they are
+       hashed (scanner.BlockSpill), both in scan order"""
+    dprint('scanning ' + root)
+    file_entries = []
+    block_sets = scanner.BlockSpill()
+    for name, csum, blocks in scanner.scan_tree(root, block_size, hash_type,
+                                                threads):
+        file_entries.append((csum, name))
+        block_sets.add(name, blocks)
+    Metrics.count('spilled_block_sets', len(block_sets))
+    return file_entries, block_sets
+
+
 #----------------------------
 # Clustering and Subgraph Optimization
 #----------------------------
 
 
 def find_conflicting_checksums(csums, graph):
-    "find those block checksums that map to the same file region"
+    """find those block checksums that map to the same file region,
+       csums given as graph checksum numbers"""
     range_sets = {}
-    for hno in csums:
-        range_val = ChecksumMap.get_range_using_encoded_id(hno)
+    for cidx in csums:
+        range_val = graph.ranges[cidx]
         if range_val in range_sets:
-            range_sets[range_val].append(hno)
+            range_sets[range_val].append(cidx)
         else:
-            range_sets[range_val] = [hno]
+            range_sets[range_val] = [cidx]
 
     compatible = [value[0] for key, value in range_sets.items()
                   if len(value) == 1]
@@ -310,103 +574,123 @@ def find_conflicting_checksums(csums, graph):
     return compatible, conflicting, ranges
 
 
-def path_pairs(path):
-    """Converts path into a set of node pairs,
-    where pairs are encoded as a _ delimitted string"""
-    result = []
-    for i, node1 in enumerate(path, start=1):
-        if i < len(path):
-            node2 = path[i]
-            if node1 > node2:
-                # hack to make set intersection work
-                result.append('{}_{}'.format(node1, node2))
-            else:
-                result.append('{}_{}'.format(node2, node1))
-    return (set(result))
-
-
-def path_intersection(paths):
-    """finds common segments among a set of paths"""
-    result = []
-    for i, path1 in enumerate(paths, start=1):
-        if i < len(paths):
-            path2 = paths[i]
-            common = path1.intersection(path2)
-            if len(common) > 0:
-                pairs = []
-                for node_pair_enc in common:
-                    # unencode node pair
-                    pairs.append(node_pair_enc.split('_'))
-                result.append(pairs)
-    return result
+# maximum number of augmenting paths searched when splitting conflicts
+# within a sub-graph, 0 for no limit
+cut_limit = 0
+
+# seconds between progress lines while splitting conflicts of a sub-graph
+cut_progress_seconds = 60
+
+
+def split_conflicts(graph, conflict_details, limit=0):
+    """separates every pair of checksums sharing a range in a single pass.
+       Each conflicting checksum is cut from the remaining checksums of
+       its range by a minimum edge cut (isolating cut), costing at most
+       O(degree * edges).  Stops once limit augmenting paths have been
+       searched, returns number of checksums left unresolved.  Progress
+       is printed every cut_progress_seconds on long running sub-graphs"""
+    terminals = [sorted(conflict_details[key]) for key in
+                 sorted(conflict_details)]
+    total = sum(len(csums) - 1 for csums in terminals)
+    Metrics.count('conflict_checksums', total)
+    Metrics.maximum('subgraph_conflict_checksums', total)
+    next_progress = time.time() + cut_progress_seconds
+    done = 0
+    paths = 0
+    removed = 0
+    adj = graph.neighbours()
+    for csums in terminals:
+        for i, src in enumerate(csums[:-1]):
+            cut, count = graph.min_cut(
+                graph.nfiles + src,
+                [graph.nfiles + target for target in csums[i + 1:]],
+                limit - paths if limit else None, adj)
+            paths += count
+            Metrics.count('split_cuts')
+            Metrics.count('augmenting_paths', count)
+            if cut is None:
+                print 'Warning: conflict cut limit reached,' + \
+                    ' {} of {} checksums unresolved'.format(total - done,
+                                                           total)
+                return total - done
+            if cut:
+                graph.remove_edges(cut)
+                removed += len(cut)
+                Metrics.count('edges_removed', len(cut))
+                adj = graph.neighbours()
+            done += 1
+            if time.time() >= next_progress:
+                print 'split conflicts: {} of {} checksums,'.format(
+                    done, total) + ' {} edges removed'.format(removed)
+                sys.stdout.flush()
+                next_progress = time.time() + cut_progress_seconds
+    return 0
+
+
+def display_graph(graph):
+    nx.draw(graph.to_networkx(FnameMap.encode, ChecksumMap.encode))
+    plt.show()
 
 
 def process_subgraph(graph, dedupe_group):
-    files = dedupe_group['files']
-    csums = dedupe_group['csums']
+    with Metrics.timer('process_subgraph'):
+        return _process_subgraph(graph, dedupe_group)
+
 
+def _process_subgraph(graph, dedupe_group):
     global display_graph_flag
     if display_graph_flag:
         print 'Bipartite Sub-Graph'
-        nx.draw(graph)
-        plt.show()
+        display_graph(graph)
     common_csums, conflicting_csums, conflict_details = \
-        find_conflicting_checksums(csums, graph)
+        find_conflicting_checksums(range(len(graph.csums)), graph)
 
     if len(conflict_details) > 0:
         # create sub-graph with conflicting csums and fill set of files
-        new_graph = nx.subgraph(graph, files + conflicting_csums)
-        partitions = nx.connected_components(new_graph)
+        new_graph = graph.subgraph(range(graph.nfiles), conflicting_csums)
         if display_graph_flag:
-            nx.draw(new_graph)
-            plt.show()
-
-        while len(partitions) == 1:
-            #break-up monolithic partition -- find paths between
-            #conflict pairs and break shortest path.
-            paths = []
-            for src, target in conflict_details.values():
-                paths.append(path_pairs(nx.shortest_path(new_graph,
-                                                         src, target)))
-            common_paths = path_intersection(paths)
-
-            # for now, just break the first path and interate.
-            # In future, may want to break multiple paths at once
-            if len(common_paths) == 0 or len(common_paths[0]) == 0:
-                raise ValueError('Error: Unexpected result' +
-                                 ' - shoud be at least 1 common path pair')
-            pair = common_paths[0][0]    # arbitrarily pick first segment
-            new_graph.remove_edge(pair[0], pair[1])
-            partitions = nx.connected_components(new_graph)
-            common_csums, conflicting_csums,
-            conflict_details = find_conflicting_checksums(csums, new_graph)
-
-        subgroups = process_partitions(partitions, new_graph)
+            display_graph(new_graph)
+        common_csums, conflicting_csums, conflict_details = \
+            find_conflicting_checksums(range(len(new_graph.csums)), new_graph)
+
+        with Metrics.timer('split_conflicts'):
+            split_conflicts(new_graph, conflict_details, cut_limit)
+        partitions = new_graph.connected_components()
+        if len(partitions) == 1:
+            # limit reached before sub-graph could be split
+            partitions = []
+
+        # checksums cut off from all files are not kept in any group
+        dropped_csums = [hno for files, csums, edges in partitions
+                         if len(files) == 0
+                         for hno in new_graph.csums[csums].tolist()]
+        subgroups = process_partitions(
+            new_graph.subgraph(files, csums, edges)
+            for files, csums, edges in partitions if len(files) > 0)
         dedupe_group['subgroups'] = subgroups
 
     else:
         # no further sub-graphs
+        dropped_csums = []
         dedupe_group['subgroups'] = []
 
     #now compute combined result for group and it's subgroups
-    subgroup_csums = []
-    subgroup_files = []
-    tally = 0
-    for subgroup in dedupe_group['subgroups']:
-        for csum in subgroup['csums']:
-            subgroup_csums.append(csum)
-        for fname in subgroup['files']:
-            subgroup_files.append(fname)
-        tally += subgroup['savings']
-    # Below line split to keep pep8 happy
-    dedupe_group['selected_files'] = set(dedupe_group['files']) - \
-        set(subgroup_files)
-    dedupe_group['selected_csums'] = set(dedupe_group['csums']) - \
-        set(subgroup_csums)
-
-    for csum in csums:
-        tally += len(nx.edges(graph, csum)) - 1
-    dedupe_group['savings'] = tally
+    subgroups = dedupe_group['subgroups']
+    subgroup_csums = set(dropped_csums)
+    subgroup_files = set()
+    for subgroup in subgroups:
+        subgroup_csums.update(subgroup['csums'])
+        subgroup_files.update(subgroup['files'])
+    dedupe_group['selected_files'] = sorted(set(dedupe_group['files']) -
+                                            subgroup_files)
+    dedupe_group['selected_csums'] = sorted(set(dedupe_group['csums']) -
+                                            subgroup_csums)
+
+    (blocks, nbytes) = graph.savings()
+    dedupe_group['savings'] = blocks + sum(subgroup['savings']
+                                           for subgroup in subgroups)
+    dedupe_group['savings_bytes'] = nbytes + sum(subgroup['savings_bytes']
+                                                 for subgroup in subgroups)
     return dedupe_group
 
 
@@ -418,67 +702,568 @@ def optimize_dedupe_group(dedupe_group):
     return dedupe_group
 
 
-def process_partitions(partitions, graph, singleton_filter=False):
-    "processing of individual sub-graph"
-    dedupe_groups = []
-    for part in partitions:
-        files = [nodenum for nodenum in part if nodenum[0] == 'F']
-        csums = [nodenum for nodenum in part if nodenum[0] == 'H']
+def process_partitions(subgraphs, singleton_filter=False):
+    """processing of individual sub-graph, one per partition"""
+    return list(iter_process_partitions(subgraphs, singleton_filter))
+
+
+def iter_process_partitions(subgraphs, singleton_filter=False):
+    "same as process_partitions, yielding each group once processed"
+    for subgraph in subgraphs:
         # only select sub-graphs with multiple files
-        if (len(files) > 1) or (not singleton_filter):
-            subgraph = nx.subgraph(graph, part)
-            dedupe_group = {'name': str(uuid.uuid4()), 'files': files,
-                            'csums': csums}
+        if (subgraph.nfiles > 1) or (not singleton_filter):
+            dedupe_group = {'name': str(uuid.uuid4()),
+                            'files': subgraph.files.tolist(),
+                            'csums': subgraph.csums.tolist()}
             dedupe_group = process_subgraph(subgraph, dedupe_group)
-            dedupe_group = optimize_dedupe_group(dedupe_group)
-            dedupe_groups.append(dedupe_group)
-    return dedupe_groups
+            yield optimize_dedupe_group(dedupe_group)
 
 
 def build_graph_from_vectors(vector_set, show_subgraph=False):
-    "creates top-level fraph from set of vectors"
+    "creates graph from set of vectors, e.g. members of a partition"
+    with Metrics.timer('build_graph'):
+        return CSRGraph.from_vectors(vector_set, ChecksumMap.get_range)
+
 
-    B = nx.Graph()
-    for fno, hset in vector_set:
-        B.add_node(FnameMap.encode(fno), bipartite=0)
+# partitions are batched for dispatch to pool workers up to this many edges
+partition_batch_edges = 10000
+# batches handed to pool workers ahead of those whose groups have been
+# yielded, per worker
+batches_per_job = 4
+
+
+def partition_task(members):
+    """data shipped to pool worker for a partition: its member vectors and
+       the ranges of its checksums"""
+    ranges = {}
+    for fno, hset in members:
         for hno in hset:
-            if hno not in B:
-                B.add_node(ChecksumMap.encode(hno), bipartite=1)
-            B.add_edge(FnameMap.encode(fno), ChecksumMap.encode(hno))
-    return B
+            if hno not in ranges:
+                ranges[hno] = ChecksumMap.get_range(hno)
+    return members, ranges
 
 
-def resolve_file_names(files):
-    resolved_files = [FnameMap.get_name_using_encoded_id(fno) for fno in files]
+def process_partition_batch(batch):
+    """pool worker, batch is a list of (position, members, ranges).
+       Returns list of (position, dedupe group), and metrics of the batch
+       if enabled"""
+    Metrics.reset(Metrics.enabled)
+    result = []
+    for position, members, ranges in batch:
+        with Metrics.timer('build_graph'):
+            graph = CSRGraph.from_vectors(members, ranges.__getitem__)
+        result.append((position, process_partitions([graph])[0]))
+    return result, Metrics.report() if Metrics.enabled else None
+
+
+def partition_batches(partitions):
+    """(start, end) position ranges of batches of partitions, in dispatch
+       order.  A partition of partition_batch_edges edges or more is a
+       batch of its own, and these go first, largest first, so a giant
+       component found late does not hold up the end of the run.  Other
+       partitions are batched in runs of consecutive positions, which go
+       out in partition order
+    >>> small = [[0, [1, 2]], [1, [2]]]
+    >>> big = [[2, range(12000)], [3, [5]]]
+    >>> giant = [[4, range(20000)], [5, [7]]]
+    >>> partition_batches([small, big, small, small, giant, small])
+    [(4, 5), (1, 2), (0, 1), (2, 4), (5, 6)]
+    """
+    sizes = [sum(len(hset) for fno, hset in members) for members in partitions]
+    giants = []
+    runs = []
+    start = 0
+    edges = 0
+    for i, size in enumerate(sizes):
+        if size >= partition_batch_edges:
+            if i > start:
+                runs.append((start, i))
+            giants.append((i, i + 1))
+            start = i + 1
+            edges = 0
+            continue
+        edges += size
+        if edges >= partition_batch_edges:
+            runs.append((start, i + 1))
+            start = i + 1
+            edges = 0
+    if len(sizes) > start:
+        runs.append((start, len(sizes)))
+    giants.sort(key=lambda batch: (-sizes[batch[0]], batch[0]))
+    return giants + runs
+
+
+def process_partitions_parallel(partitions, jobs):
+    """same as process_partitions with singleton_filter, for partitions
+       given as member vectors, using a pool of jobs worker processes.
+       Groups are yielded in partition order, whatever order workers
+       finish in, each as soon as all groups before it are done.  A batch
+       holds its slot of the batches_per_job per worker until its groups
+       are yielded, so batches in the task queue and groups waiting for
+       earlier ones are both bounded.  While all slots are held, the
+       batch holding the next group is dispatched anyway, so giant
+       partitions going first cannot stall the run; at most one such
+       batch is out at a time"""
+    partitions = [members for members in partitions if len(members) > 1]
+    batches = partition_batches(partitions)
+    starts = dict((start, idx) for idx, (start, end) in enumerate(batches))
+    last = set(end - 1 for start, end in batches)
+    dispatched = [False] * len(batches)
+    free = [jobs * batches_per_job]     # slots, -1 while one batch forced
+    pending = {}
+    next_position = [0]
+    ready = threading.Condition()
+    stopped = []
+
+    def dispatch():
+        "batches, each once a slot is free or once its groups are next"
+        cursor = 0
+        while True:
+            with ready:
+                while True:
+                    while cursor < len(batches) and dispatched[cursor]:
+                        cursor += 1
+                    if stopped or cursor == len(batches):
+                        return
+                    if free[0] > 0:
+                        idx = cursor
+                        break
+                    idx = starts.get(next_position[0])
+                    if idx is not None and not dispatched[idx]:
+                        break
+                    ready.wait()
+                dispatched[idx] = True
+                free[0] -= 1
+            (start, end) = batches[idx]
+            yield [(i,) + partition_task(partitions[i])
+                   for i in xrange(start, end)]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for batch, report in pool.imap_unordered(process_partition_batch,
+                                                 dispatch()):
+            if report:
+                Metrics.merge(report)
+            for position, dedupe_group in batch:
+                pending[position] = dedupe_group
+            Metrics.maximum('pending_groups', len(pending))
+            while next_position[0] in pending:
+                position = next_position[0]
+                yield pending.pop(position)
+                with ready:
+                    next_position[0] += 1
+                    if position in last:
+                        free[0] += 1
+                    ready.notify()
+        pool.close()
+    finally:
+        with ready:
+            stopped.append(True)    # releases task handler if waiting
+            ready.notify()
+        pool.terminate()
+
+
+def resolve_file_names(files, names=None):
+    """file names of fnos.  If names given, each name is taken from it, or
+       added, so a file is resolved once however often it appears"""
+    if names is None:
+        return [FnameMap.get_name(fno) for fno in files]
+    resolved_files = []
+    for fno in files:
+        if fno not in names:
+            names[fno] = FnameMap.get_name(fno)
+        resolved_files.append(names[fno])
     return resolved_files
 
 
 def resolve_csums(csums):
-    resolved_checksums = [ChecksumMap.get_hval_using_encoded_id(hno)
-                          for hno in csums]
+    resolved_checksums = [ChecksumMap.get_hval(hno) for hno in csums]
     return resolved_checksums
 
 
-def annotate_group(group):
-    group['csums'] = resolve_csums(group['csums'])
-    group['selected_csums'] = resolve_csums(group['selected_csums'])
-    group['files'] = resolve_file_names(group['files'])
-    group['selected_files'] = resolve_file_names(group['selected_files'])
-    group['subgroup'] = [annotate_group(subgroup)
-                         for subgroup in group['subgroups']]
+def annotate_group(group, names=None):
+    """resolves ids of group and its subgroups, sharing one name string per
+       file across them"""
+    if names is None:
+        names = {}
+    with Metrics.timer('annotate'):
+        group['csums'] = resolve_csums(group['csums'])
+        group['selected_csums'] = resolve_csums(group['selected_csums'])
+        group['files'] = resolve_file_names(group['files'], names)
+        group['selected_files'] = resolve_file_names(group['selected_files'],
+                                                     names)
+        group['subgroup'] = [annotate_group(subgroup, names)
+                             for subgroup in group['subgroups']]
     return group
 
 
-def graph_analysis(vector_set):
+# splits giant partitions into clusters of similar files before exact
+# analysis, None to analyse partitions whole
+precluster = None
+
+
+def graph_analysis(vector_set, jobs=1, annotate=True):
     """top level routine, partitions vector sets and identified
-       common parent for a set of files"""
+       common parent for a set of files.  Partitions are analysed by
+       jobs worker processes when jobs > 1.  Unless annotate, groups
+       are left with file and checksum ids"""
+    return list(iter_graph_analysis(vector_set, jobs, annotate))
+
+
+def iter_graph_analysis(vector_set, jobs=1, annotate=True):
+    """same as graph_analysis, yielding each group as soon as its
+       partition has been processed"""
+    dprint('partitioning')
+    with Metrics.timer('partition'):
+        partitions = partition_vectors(vector_set, ChecksumMap.size())
+    if precluster:
+        partitions = precluster.split(partitions)
+    return iter_partition_analysis(partitions, jobs, annotate)
+
+
+def iter_partition_analysis(partitions, jobs=1, annotate=True):
+    """groups of each partition given as member vectors, in partition
+       order, annotated unless annotate is False"""
+    dprint('{} partitions'.format(len(partitions)))
+    if Metrics.enabled:
+        for members in partitions:
+            if len(members) > 1:
+                Metrics.count('partitions')
+                Metrics.maximum('largest_partition_files', len(members))
+                Metrics.maximum('largest_partition_blocks',
+                                sum(len(hset) for fno, hset in members))
+    if jobs > 1:
+        dedupe_groups = process_partitions_parallel(partitions, jobs)
+    else:
+        dedupe_groups = iter_process_partitions(
+            (build_graph_from_vectors(members) for members in partitions
+             if len(members) > 1), singleton_filter=True)
+
+    for group in dedupe_groups:
+        yield annotate_group(group) if annotate else group
+
 
-    B = build_graph_from_vectors(vector_set)
-    partitions = nx.connected_components(B)
-    dedupe_groups = process_partitions(partitions, B, singleton_filter=True)
+#------------------------------------
+# Incremental analysis using persistent state
+#------------------------------------
 
-    annotated_groups = [annotate_group(group) for group in dedupe_groups]
-    return annotated_groups
+
+def read_removed_files(fname):
+    "reads names of removed files, one per line"
+    if not fname:
+        return []
+    fd = open(fname)
+    names = [text.rstrip('\n') for text in fd if text.strip()]
+    fd.close()
+    return names
+
+
+def incremental_analysis(index, file_entries, block_sets, removed,
+                         min_blocks, jobs=1, json_duplicates_fname=False):
+    """applies delta of added, changed and removed files to index, and
+       re-analyses only partitions touched by the delta.  Returns all
+       dedupe groups, including those carried over from earlier runs"""
+    old_dup_map = create_duplicate_map([list(group) for group in
+                                        index.duplicates])
+    changed = index.update(file_entries, block_sets, removed)
+
+    dprint('identify duplicates')
+    index.duplicates = group_duplicate_entries(index.file_entries())
+    jdump(index.duplicates, json_duplicates_fname)
+    dup_map = create_duplicate_map([list(group) for group in
+                                    index.duplicates])
+    changed.update(set(dup_map).symmetric_difference(old_dup_map))
+
+    names = index.affected_files(changed)
+    dprint('re-analysing {} of {} files'.format(len(names), len(index.files)))
+    FnameMap.reset()
+    ChecksumMap.reset()
+    vector_set = index.vectors(names, dup_map, min_blocks)
+    index.replace_groups(names, graph_analysis(vector_set, jobs))
+    return index.all_groups()
+
+
+#------------------------------------
+# Resumable analysis using stage cache
+#------------------------------------
+
+analysis_stages = ['duplicates', 'vectors', 'pruned', 'partitions', 'groups']
+
+
+def stage_keys(d_file, dsub_file, min_blocks, hash_type='MD5',
+               two_pass=False):
+    """cache key of each analysis stage, each derived from the key of the
+       stage before it, so a change of input invalidates all later stages"""
+    keys = {}
+    keys['duplicates'] = StageCache.key(file_fingerprint(d_file), hash_type)
+    keys['vectors'] = StageCache.key(keys['duplicates'],
+                                     file_fingerprint(dsub_file),
+                                     hash_type, two_pass)
+    keys['pruned'] = StageCache.key(keys['vectors'], min_blocks)
+    keys['partitions'] = StageCache.key(
+        keys['pruned'], precluster and sorted(precluster.params().items()))
+    keys['groups'] = StageCache.key(keys['partitions'], cut_limit)
+    return keys
+
+
+def resumable_analysis(cache, d_file, dsub_file, min_blocks, jobs=1,
+                       json_duplicates_fname=False, vectorset_fname=False,
+                       presorted=True, memory_limit=None, hash_type='MD5',
+                       two_pass=False, whole_savings=None):
+    """whole-file and sub-file analysis, resumed from the last stage found
+       in cache for the same inputs and parameters.  Each stage run is
+       stored in cache.  File name and checksum tables are stored along
+       with raw vectors, and restored when resuming from any stage that
+       refers to them.  Savings of duplicate files are added to
+       whole_savings, if given.  Returns dedupe groups"""
+    keys = stage_keys(d_file, dsub_file, min_blocks, hash_type, two_pass)
+    have_tables = cache.contains('tables', keys['vectors'])
+    cached = [stage for stage in analysis_stages
+              if cache.contains(stage, keys[stage]) and
+              (stage in ('duplicates', 'groups') or have_tables)]
+
+    value = None
+    start = 0
+    if cached:
+        stage = cached[-1]
+        dprint('resuming from cached ' + stage)
+        value = cache.get(stage, keys[stage])
+        if stage not in ('duplicates', 'groups'):
+            (FnameMap.table, ChecksumMap.table) = \
+                cache.get('tables', keys['vectors'])
+        start = analysis_stages.index(stage) + 1
+        if whole_savings is not None and start > 1 and \
+                cache.contains('whole_savings', keys['vectors']):
+            whole_savings.update(cache.get('whole_savings', keys['vectors']))
+
+    for stage in analysis_stages[start:]:
+        if stage == 'duplicates':
+            value = find_duplicateFiles(
+                d_file, json_duplicates_fname=json_duplicates_fname,
+                presorted=presorted, memory_limit=memory_limit,
+                hash_type=hash_type)
+        elif stage == 'vectors':
+            savings = {'files': 0, 'bytes': 0}
+            value = construct_vectors(dsub_file, create_duplicate_map(value),
+                                      hash_type=hash_type, two_pass=two_pass,
+                                      whole_savings=savings, jobs=jobs)
+            cache.put('tables', keys['vectors'],
+                      (FnameMap.table, ChecksumMap.table))
+            cache.put('whole_savings', keys['vectors'], savings)
+            if whole_savings is not None:
+                whole_savings.update(savings)
+            if vectorset_fname:
+                print 'Outputting vectors to: {}'.format(vectorset_fname)
+                write_vectors(vectorset_fname, value)
+        elif stage == 'pruned':
+            dprint('pruning', nl=True)
+            value = prune_vectors(value, min_blocks)
+        elif stage == 'partitions':
+            dprint('partitioning')
+            value = partition_vectors(value, ChecksumMap.size())
+            if precluster:
+                value = precluster.split(value)
+        else:
+            dprint('graph analysis')
+            value = list(iter_partition_analysis(value, jobs))
+        dprint('caching ' + stage)
+        cache.put(stage, keys[stage], value)
+    return value
+
+
+#------------------------------------
+# Output
+#------------------------------------
+
+
+def output_base(fname):
+    "checksum file name without compression suffix and extension"
+    (base, ext) = string.rsplit(
+        checksum_reader.strip_compression_suffix(fname), '.', 1)
+    return base
+
+
+def savings_totals(whole_savings=None):
+    """global savings, starting from whole-file savings of duplicate files
+       if known, to which tally_savings adds sub-file savings"""
+    return {'whole_file': whole_savings,
+            'sub_file': {'groups': 0, 'blocks': 0, 'bytes': 0},
+            'total_bytes': whole_savings['bytes'] if whole_savings else 0}
+
+
+def tally_savings(dedupe_groups, totals):
+    "passes dedupe groups through, adding their savings to totals"
+    sub_file = totals['sub_file']
+    for group in dedupe_groups:
+        sub_file['groups'] += 1
+        sub_file['blocks'] += group['savings']
+        sub_file['bytes'] += group['savings_bytes']
+        totals['total_bytes'] += group['savings_bytes']
+        yield group
+
+
+def write_groups(dedupe_groups, d_subfile_base, ndjson=False, totals=None,
+                 compact=False):
+    """writes dedupe groups to .dedupe.json file, or one per line to
+       .dedupe.ndjson file as groups are produced, or with compact to
+       .dedupe.compact.json file in result_file format.  If totals given,
+       the savings of groups are added and written to .savings.json file"""
+    if totals is not None:
+        dedupe_groups = tally_savings(dedupe_groups, totals)
+        if not (ndjson or compact):
+            dedupe_groups = list(dedupe_groups)
+
+    if compact:
+        dedupe_out_fname = d_subfile_base + '.dedupe.compact.json'
+
+        print 'Outputting dedupe groups in compact format to:' + \
+            ' {}'.format(dedupe_out_fname)
+
+        with Metrics.timer('output'):
+            count = write_results(dedupe_out_fname, dedupe_groups)
+        dprint('{} dedupe groups'.format(count))
+
+    elif ndjson:
+        dedupe_out_fname = d_subfile_base + '.dedupe.ndjson'
+
+        print 'Outputting dedupe groups in NDJSON format to:' + \
+            ' {}'.format(dedupe_out_fname)
+
+        count = jdump_lines(dedupe_groups, dedupe_out_fname)
+        dprint('{} dedupe groups'.format(count))
+
+    else:
+        dpprint(dedupe_groups)
+        dedupe_out_fname = d_subfile_base + '.dedupe.json'
+
+        print 'Outputting dedupe groups in JSON format to:' + \
+            ' {}'.format(dedupe_out_fname)
+
+        with Metrics.timer('output'):
+            jdump(dedupe_groups, dedupe_out_fname, pretty=True)
+
+    if totals is not None:
+        savings_fname = d_subfile_base + '.savings.json'
+        print 'Outputting savings to: {}'.format(savings_fname)
+        print_savings(totals)
+        jdump(totals, savings_fname, pretty=True)
+
+
+def print_savings(totals):
+    whole_file = totals['whole_file']
+    if whole_file:
+        print '    whole-file: {} files, {:.1f} MB'.format(
+            whole_file['files'], whole_file['bytes'] / float(1 << 20))
+    sub_file = totals['sub_file']
+    print '    sub-file:   {} blocks in {} groups, {:.1f} MB'.format(
+        sub_file['blocks'], sub_file['groups'],
+        sub_file['bytes'] / float(1 << 20))
+    print '    total:      {:.1f} MB'.format(
+        totals['total_bytes'] / float(1 << 20))
+
+
+#------------------------------------
+# Analysis of several block sizes sharing whole-file results
+#------------------------------------
+
+
+def block_size_of(dsub_file, hash_type='MD5', sample=1000):
+    """block size of checksum file, the largest block among its first
+       sample files (smaller ones end a file)"""
+    size = 0
+    for name, blocks in itertools.islice(
+            checksum_reader.read_subfile_blocks(dsub_file, hash_type), sample):
+        for digest, start, end in blocks:
+            size = max(size, end - start + 1)
+    return size
+
+
+def summarize_groups(groups, block_size):
+    "counts of groups, subgroups and files, and savings of dedupe groups"
+    subgroups = 0
+    pending = [subgroup for group in groups for subgroup in group['subgroups']]
+    while pending:
+        subgroups += 1
+        pending.extend(pending.pop()['subgroups'])
+    return {'block_size': block_size,
+            'groups': len(groups),
+            'subgroups': subgroups,
+            'files': sum(len(group['files']) for group in groups),
+            'savings_blocks': sum(group['savings'] for group in groups),
+            'savings_bytes': sum(group['savings_bytes'] for group in groups)}
+
+
+def analyse_granularity(dsub_file, dup_map, min_blocks, jobs=1,
+                        hash_type='MD5', two_pass=False, ndjson=False,
+                        compact=False):
+    """sub-file analysis of one block checksum file, writing its dedupe
+       groups.  File numbers are kept from earlier granularities.
+       Returns summary of groups found"""
+    dprint('analysing ' + dsub_file, nl=True)
+    if precluster:
+        precluster.reset_stats()
+    whole_savings = {'files': 0, 'bytes': 0}
+    vector_set = prune_vectors(
+        construct_vectors(dsub_file, dup_map, hash_type=hash_type,
+                          two_pass=two_pass, reset_names=False,
+                          whole_savings=whole_savings, jobs=jobs), min_blocks)
+    block_size = block_size_of(dsub_file, hash_type)
+    dedupe_groups = graph_analysis(vector_set, jobs, annotate=not compact)
+    write_groups(dedupe_groups, output_base(dsub_file), ndjson,
+                 savings_totals(whole_savings), compact)
+    summary = summarize_groups(dedupe_groups, block_size)
+    summary['checksums'] = dsub_file
+    if precluster:
+        summary['precluster'] = precluster.report()
+    return summary
+
+
+def granularity_task(args):
+    "pool worker, analyses one granularity.  Returns summary and metrics"
+    Metrics.reset(Metrics.enabled)
+    summary = analyse_granularity(*args)
+    return summary, Metrics.report() if Metrics.enabled else None
+
+
+def granularity_analysis(dsub_files, duplicates, min_blocks, jobs=1,
+                         hash_type='MD5', two_pass=False, ndjson=False,
+                         compact=False):
+    """analyses each of several block checksum files of the same files,
+       sharing whole-file duplicates and, when run in turn, the file name
+       table.  With jobs > 1 granularities are analysed in parallel, one
+       per worker process.  Returns summaries ordered by block size"""
+    dup_map = create_duplicate_map(duplicates)
+    FnameMap.reset()
+    if jobs > 1:
+        pool = multiprocessing.Pool(min(jobs, len(dsub_files)))
+        try:
+            tasks = [(dsub_file, dup_map, min_blocks, 1, hash_type, two_pass,
+                      ndjson, compact) for dsub_file in dsub_files]
+            results = pool.map(granularity_task, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+        summaries = []
+        for summary, report in results:
+            if report:
+                Metrics.merge(report)
+            summaries.append(summary)
+    else:
+        summaries = [analyse_granularity(dsub_file, dup_map, min_blocks, 1,
+                                         hash_type, two_pass, ndjson, compact)
+                     for dsub_file in dsub_files]
+    return sorted(summaries, key=lambda summary: summary['block_size'])
+
+
+def print_granularity_report(summaries):
+    print '{:>12} {:>8} {:>10} {:>8} {:>14} {:>14}  {}'.format(
+        'block size', 'groups', 'subgroups', 'files', 'saved blocks',
+        'saved MB', 'checksums')
+    for summary in summaries:
+        print '{:12} {:8} {:10} {:8} {:14} {:14.1f}  {}'.format(
+            summary['block_size'], summary['groups'], summary['subgroups'],
+            summary['files'], summary['savings_blocks'],
+            summary['savings_bytes'] / float(1 << 20), summary['checksums'])
 
 
 #------------------------------------
@@ -487,7 +1272,9 @@ def graph_analysis(vector_set):
 
 if __name__ == "__main__":
     parser = OptionParser(usage='usage: %prog [options]' +
-                          ' whole_checksums [sorted_block_checksums]')
+                          ' whole_checksums [sorted_block_checksums ...]\n' +
+                          '       %prog [options] --scan directory\n' +
+                          '       %prog [options] --vectors vector_file')
 
     parser.add_option("-c", "--checksum_type", type='string',
                       default="MD5", dest="hash_type",
@@ -506,6 +1293,11 @@ if __name__ == "__main__":
                       help="enables dumping of vectors to .vectors file" +
                            " for use with alternative analysis")
 
+    parser.add_option("--vectors", default=False, action="store_true",
+                      dest="vectors",
+                      help="analyses .vectors file written by" +
+                           " --dump_vectors, in place of checksum files")
+
     parser.add_option("-d", "--debug", default=False, action="store_true",
                       dest="debug",
                       help="logs information to console for debug purposes")
@@ -514,6 +1306,157 @@ if __name__ == "__main__":
                       dest="show_graphs",
                       help="displays sub-graphs to console for debug purposes")
 
+    parser.add_option("-u", "--unsorted", default=False, action="store_true",
+                      dest="unsorted",
+                      help="whole-file checksums not sorted by checksum," +
+                           " group without external sort")
+
+    parser.add_option("--memory_limit", type='int', default=0,
+                      dest="memory_limit",
+                      help="memory budget in MB, beyond which intermediate" +
+                           " data, and file and checksum tables, are spilled" +
+                           " to disk",
+                      metavar="MB")
+
+    parser.add_option("--compact", default=False, action="store_true",
+                      dest="compact",
+                      help="uses array based checksum table, about 5x" +
+                           " smaller, at some cost in speed.  File names" +
+                           " are held compactly in any case, so peak" +
+                           " memory of a run drops by less, about 15%" +
+                           " on 690K blocks")
+
+    parser.add_option("-s", "--scan", default=False, action="store_true",
+                      dest="scan",
+                      help="computes whole-file and block checksums directly" +
+                           " from directory tree, instead of md5deep output")
+
+    parser.add_option("-b", "--block_size", type='string', default='1m',
+                      dest="block_size",
+                      help="block SIZE used by --scan, in md5deep -p" +
+                           " format (e.g. 64k, 1m)",
+                      metavar="SIZE")
+
+    parser.add_option("--scan_threads", type='int', default=0,
+                      dest="scan_threads",
+                      help="number of hashing threads used by --scan," +
+                           " defaults to number of cores",
+                      metavar="N")
+
+    parser.add_option("--two_pass", default=False, action="store_true",
+                      dest="two_pass",
+                      help="counts blocks in a first pass over sub-file" +
+                           " checksums, so that only shared blocks are kept" +
+                           " in memory")
+
+    parser.add_option("-j", "--jobs", type='int', default=1,
+                      dest="jobs",
+                      help="number of worker processes used for parsing" +
+                           " large block checksum files and analysis of" +
+                           " partitions",
+                      metavar="N")
+
+    parser.add_option("--cut_limit", type='int', default=0,
+                      dest="cut_limit",
+                      help="maximum number of augmenting PATHS searched when" +
+                           " splitting conflicts within a sub-graph," +
+                           " 0 for no limit",
+                      metavar="PATHS")
+
+    parser.add_option("--state", type='string', default='',
+                      dest="state",
+                      help="persistent state FILE.  Input checksums are" +
+                           " treated as added or changed files, and only" +
+                           " partitions they touch are re-analysed",
+                      metavar="FILE")
+
+    parser.add_option("--removed", type='string', default='',
+                      dest="removed",
+                      help="FILE listing names of files removed since" +
+                           " last run, used with --state",
+                      metavar="FILE")
+
+    parser.add_option("--resume", default=False, action="store_true",
+                      dest="resume",
+                      help="caches results of each analysis stage, and" +
+                           " skips stages whose inputs and parameters are" +
+                           " unchanged since an earlier run." +
+                           " Not used with --scan or --state")
+
+    parser.add_option("--cache_dir", type='string', default='.dedupe_cache',
+                      dest="cache_dir",
+                      help="DIR holding stage results for --resume",
+                      metavar="DIR")
+
+    parser.add_option("--cache_limit", type='int', default=0,
+                      dest="cache_limit",
+                      help="evicts least recently used stage results beyond" +
+                           " MB, 0 for no limit",
+                      metavar="MB")
+
+    parser.add_option("--clear_cache", default=False, action="store_true",
+                      dest="clear_cache",
+                      help="removes all stage results before running")
+
+    parser.add_option("--metrics", type='string', default='',
+                      dest="metrics",
+                      help="writes timings, peak memory and counters of" +
+                           " each stage to FILE in JSON format",
+                      metavar="FILE")
+
+    parser.add_option("--profile", type='string', default='',
+                      dest="profile",
+                      help="comma separated STAGES run under cProfile," +
+                           " e.g. vectors,split_conflicts.  Stats written" +
+                           " to <metrics file>.<stage>.prof, main process" +
+                           " only",
+                      metavar="STAGES")
+
+    parser.add_option("--ndjson", default=False, action="store_true",
+                      dest="ndjson",
+                      help="writes each dedupe group to .dedupe.ndjson" +
+                           " file as one JSON line, as soon as it is found")
+
+    parser.add_option("--pipeline", default=False, action="store_true",
+                      dest="pipeline",
+                      help="parses block checksums in worker processes" +
+                           " while whole-file duplicates are found.  Holds" +
+                           " parsed checksums of all files until then." +
+                           " Not used with --scan, --state, --resume," +
+                           " --vectors, --two_pass or several block" +
+                           " checksum files")
+
+    parser.add_option("--compact_output", default=False, action="store_true",
+                      dest="compact_output",
+                      help="writes dedupe groups to .dedupe.compact.json" +
+                           " file, referring by id to a single file table" +
+                           " and checksum table.  Read with result_file.py")
+
+    parser.add_option("--precluster", type='int', default=0,
+                      dest="precluster",
+                      help="splits partitions of more than FILES files into" +
+                           " clusters of similar files using MinHash/LSH," +
+                           " before exact analysis.  Faster, but misses" +
+                           " savings between clusters.  0 to disable",
+                      metavar="FILES")
+
+    parser.add_option("--minhash_perms", type='int', default=64,
+                      dest="minhash_perms",
+                      help="number of MinHash functions per file signature",
+                      metavar="N")
+
+    parser.add_option("--lsh_bands", type='int', default=16,
+                      dest="lsh_bands",
+                      help="number of LSH bands signatures are split into." +
+                           " More bands cluster less similar files",
+                      metavar="N")
+
+    parser.add_option("--hub_degree", type='int', default=100,
+                      dest="hub_degree",
+                      help="checksums held by more than FILES files of a" +
+                           " partition are left out of signatures",
+                      metavar="FILES")
+
     (options, args) = parser.parse_args()
 
     global display_graph_flag
@@ -524,38 +1467,179 @@ if __name__ == "__main__":
     debug = options.debug
     min_blocks = options.min_blocks
     display_graph_flag = options.show_graphs
-    if args:
+    cut_limit = options.cut_limit
+    if options.precluster:
+        if options.lsh_bands <= 0 or \
+                options.minhash_perms % options.lsh_bands:
+            parser.error('--minhash_perms must be a multiple of --lsh_bands')
+        precluster = Precluster(options.precluster, options.minhash_perms,
+                                options.lsh_bands, options.hub_degree)
+    use_compact_tables(options.compact)
+    profiled = [name for name in options.profile.split(',') if name]
+    Metrics.reset(bool(options.metrics or profiled), profiled)
+    file_entries = None
+    block_sets = None
+    dsub_files = []     # block checksum files given, as opposed to scanned
+    if options.vectors and args:
+        dsub_file = args[0]
+        (d_subfile_base, ext) = string.rsplit(dsub_file, '.', 1)
+    elif options.scan and args:
+        # outputs named as if md5deep output for directory had been used
+        d_file = dsub_file = args[0]
+        dir_base = os.path.basename(os.path.normpath(args[0]))
+        d_file_base = dir_base + '_hashes'
+        d_subfile_base = dir_base + '_subhashes'
+        file_entries, block_sets = scan_checksums(
+            args[0], scanner.parse_block_size(options.block_size),
+            options.hash_type, options.scan_threads)
+    elif args:
         d_file = args[0]
-        if len(args) == 2:
-            dsub_file = args[1]
+        d_file_base = output_base(d_file)
+        dsub_files = args[1:]
+        if len(dsub_files) > 1 and (options.state or options.resume):
+            parser.error('several block checksum files cannot be used' +
+                         ' with --state or --resume')
+        if dsub_files:
+            dsub_file = dsub_files[0]
+            d_subfile_base = output_base(dsub_file)
             enable_subfile_analysis = True
         else:
             enable_subfile_analysis = False
     else:
         raise MissingInputFiles
 
-    (d_file_base, ext) = string.rsplit(d_file, '.', 1)
-    jdup_fname = d_file_base + '.json'
-    duplicates = find_duplicateFiles(d_file, json_duplicates_fname=jdup_fname)
-
-    if enable_subfile_analysis:
-        (d_subfile_base, ext) = string.rsplit(dsub_file, '.', 1)
-        jvec_fname = False
-        lvec_fname = False
-        if options.dump_vectors:
-            jvec_fname = d_subfile_base + '.vect.json'  # Should delete?
-            lvec_fname = d_subfile_base + '.vectors'
-
-        vector_set = generate_subfile_vectors(dsub_file, duplicates,
-                                              min_blocks,
-                                              json_vectorset_fname=jvec_fname,
-                                              list_vectorset_fname=lvec_fname)
+    memory_limit = options.memory_limit * 1024 * 1024
+    if memory_limit:
+        # tables move to SQLite once over budget, held as selected by
+        # --compact until then
+        use_spill_tables(memory_limit, options.compact)
+
+    # sub-graphs can only be displayed from main process
+    jobs = 1 if display_graph_flag else options.jobs
+    cache = None
+    if options.resume or options.clear_cache:
+        cache = StageCache(options.cache_dir,
+                           options.cache_limit * 1024 * 1024)
+        if options.clear_cache:
+            cache.clear()
+
+    if options.ndjson and options.compact_output:
+        parser.error('--ndjson and --compact_output cannot both be used')
+    # streamed output only needs groups one at a time, and compact output
+    # resolves each file and checksum once
+    analyse = iter_graph_analysis if options.ndjson else graph_analysis
+    annotate = not options.compact_output
+
+    # savings of duplicate files, found while vectors are constructed.
+    # Not known for --vectors, and --state keeps groups of earlier runs
+    whole_savings = {'files': 0, 'bytes': 0}
+    totals = None
+
+    if options.vectors:
+        # duplicates and singleton files already left out of dumped vectors
+        dprint('loading vectors ' + dsub_file)
+        vector_file = VectorFile(dsub_file)
+        vector_file.restore_maps()
+        vector_set = prune_vectors(vector_file, min_blocks)
         dprint('graph analysis')
-        dedupe_groups = graph_analysis(vector_set)
-        dpprint(dedupe_groups)
-        dedupe_out_fname = d_subfile_base + '.dedupe.json'
+        dedupe_groups = analyse(vector_set, jobs, annotate)
+        totals = savings_totals()
+
+    elif options.state:
+        jdup_fname = d_file_base + '.json'
+        dprint('loading state ' + options.state)
+        index = BlockIndex.load(options.state)
+        removed = read_removed_files(options.removed)
+        if options.scan:
+            # scan covers whole tree, anything not found has been removed
+            removed = set(index.whole) - \
+                set(name for val, name in file_entries)
+        else:
+            file_entries = checksum_reader.read_file_entries(
+                d_file, options.hash_type)
+            if enable_subfile_analysis:
+                block_sets = checksum_reader.read_subfile_blocks(
+                    dsub_file, options.hash_type)
+        dedupe_groups = incremental_analysis(index, file_entries, block_sets,
+                                             removed, min_blocks, jobs,
+                                             jdup_fname)
+        dprint('saving state ' + options.state)
+        index.save(options.state)
+
+    elif options.resume and enable_subfile_analysis and not options.scan:
+        vec_fname = False
+        if options.dump_vectors:
+            vec_fname = d_subfile_base + '.vectors'
+        dedupe_groups = resumable_analysis(
+            cache, d_file, dsub_file, min_blocks, jobs,
+            json_duplicates_fname=d_file_base + '.json',
+            vectorset_fname=vec_fname,
+            presorted=not options.unsorted,
+            memory_limit=memory_limit,
+            hash_type=options.hash_type,
+            two_pass=options.two_pass,
+            whole_savings=whole_savings)
+        totals = savings_totals(whole_savings)
 
-        print 'Outputting dedupe groups in JSON format to:' + \
-            ' {}'.format(dedupe_out_fname)
+    else:
+        pending = None
+        if options.pipeline and enable_subfile_analysis and \
+                block_sets is None and len(dsub_files) == 1 and \
+                not options.two_pass:
+            # sub-file parsing overlaps whole-file stage
+            pending = parallel_parse.PendingVectors(dsub_file, jobs,
+                                                    options.hash_type)
+        jdup_fname = d_file_base + '.json'
+        duplicates = find_duplicateFiles(d_file,
+                                         json_duplicates_fname=jdup_fname,
+                                         entries=file_entries,
+                                         presorted=not (options.unsorted or
+                                                        options.scan),
+                                         memory_limit=memory_limit,
+                                         hash_type=options.hash_type)
+
+        if enable_subfile_analysis and len(dsub_files) > 1:
+            summaries = granularity_analysis(dsub_files, duplicates,
+                                             min_blocks, jobs,
+                                             options.hash_type,
+                                             options.two_pass, options.ndjson,
+                                             options.compact_output)
+            report_fname = d_file_base + '.granularity.json'
+            print 'Outputting block size comparison to: {}'.format(
+                report_fname)
+            print_granularity_report(summaries)
+            jdump(summaries, report_fname, pretty=True)
+            enable_subfile_analysis = False     # groups already written
+
+        elif enable_subfile_analysis:
+            vec_fname = False
+            if options.dump_vectors:
+                vec_fname = d_subfile_base + '.vectors'
+
+            vector_set = generate_subfile_vectors(
+                dsub_file, duplicates, min_blocks,
+                vectorset_fname=vec_fname,
+                block_sets=block_sets,
+                hash_type=options.hash_type,
+                two_pass=options.two_pass,
+                whole_savings=whole_savings,
+                jobs=jobs,
+                pending=pending)
+            dprint('graph analysis')
+            dedupe_groups = analyse(vector_set, jobs, annotate)
+            totals = savings_totals(whole_savings)
 
-        jdump(dedupe_groups, dedupe_out_fname, pretty=True)
+    if enable_subfile_analysis:
+        write_groups(dedupe_groups, d_subfile_base, options.ndjson, totals,
+                     options.compact_output)
+        if precluster:
+            report_fname = d_subfile_base + '.precluster.json'
+            print 'Outputting pre-clustering report to: {}'.format(
+                report_fname)
+            jdump(precluster.report(), report_fname, pretty=True)
+
+    if Metrics.enabled:
+        if options.metrics:
+            print 'Outputting metrics to: {}'.format(options.metrics)
+        Metrics.write(options.metrics,
+                      os.path.splitext(options.metrics or 'dedupe')[0])
@@ -1,4 +1,8 @@
 import string
+from array import array
+from binascii import hexlify
+from binascii import unhexlify
+from path_table import PrefixFnameTable
 
 #---------------------------------------------------
 # Tables for mapping fname and hash values to numeric keys
@@ -31,26 +35,32 @@ class FnameMap(object):
     >>> FnameMap.reset()
     """
 
-    map2val = []  # maps id to file name
+    table_type = PrefixFnameTable
+    table = PrefixFnameTable()
 
     @classmethod
     def get_id(cls, text):
         "Maps file names to unique file numbers and maintains mapping tables"
-        idx = len(cls.map2val)
-        cls.map2val.append(text)
-        return idx
+        return cls.table.get_id(text)
 
     @classmethod
     def get_name(cls, idx):
-        return cls.map2val[idx]
+        return cls.table.get_name(idx)
 
     @classmethod
     def get_name_using_encoded_id(cls, eidx):
-        return cls.map2val[cls.decode(eidx)]
+        return cls.table.get_name(cls.decode(eidx))
+
+    @classmethod
+    def size(cls):
+        return len(cls.table)
 
     @classmethod
-    def reset(cls):
-        cls.map2val = []
+    def reset(cls, table_type=None):
+        "clears mapping table, optionally switching storage type"
+        if table_type:
+            cls.table_type = table_type
+        cls.table = cls.table_type()
 
     @staticmethod
     def encode(idx):
@@ -73,6 +83,154 @@ class FnameMap(object):
         return int(idx)
 
 
+class ChecksumTable(object):
+    "dict backed storage for ChecksumMap"
+
+    def __init__(self):
+        self.map2idx = {}
+        self.map2hval = []
+        self.counts = []
+
+    def get_id(self, hval):
+        fingerprint = hval['c']+hval['r']  # include range in checksum name
+        if fingerprint in self.map2idx:
+            idx = self.map2idx[fingerprint]
+            self.counts[idx] += 1
+            return idx
+        else:
+            idx = len(self.map2hval)
+            self.map2idx[fingerprint] = idx
+            self.map2hval.append(hval)
+            self.counts.append(1)
+            return idx
+
+    def get_block_id(self, digest, start, end):
+        fingerprint = (digest, start, end)
+        if fingerprint in self.map2idx:
+            idx = self.map2idx[fingerprint]
+            self.counts[idx] += 1
+            return idx
+        else:
+            idx = len(self.map2hval)
+            self.map2idx[fingerprint] = idx
+            self.map2hval.append(fingerprint)
+            self.counts.append(1)
+            return idx
+
+    def get_hval(self, idx):
+        hval = self.map2hval[idx]
+        if isinstance(hval, tuple):
+            (digest, start, end) = hval
+            return {'c': hexlify(digest), 'r': '_{}_{}'.format(start, end)}
+        return hval
+
+    def get_count(self, idx):
+        return self.counts[idx]
+
+    def add_count(self, idx, count):
+        self.counts[idx] += count
+
+    def __len__(self):
+        return len(self.map2hval)
+
+
+class CompactChecksumTable(object):
+    """
+    storage for ChecksumMap using binary digests in a single buffer,
+    typed arrays for offsets and counts, and an open-addressing index
+    in place of the fingerprint dict.  Only accepts md5deep style hvals
+    >>> table = CompactChecksumTable()
+    >>> table.get_block_id('\\xab\\xcd', 0, 1023)
+    0
+    >>> table.get_id({'c': 'abcd', 'r': '_1024_2047'})
+    1
+    >>> table.get_block_id('\\xab\\xcd', 1024, 2047)
+    1
+    >>> table.get_block_id('\\xab\\xcd', 0, 1023)
+    0
+    >>> table.get_count(0), table.get_count(1)
+    (2, 2)
+    >>> table.get_hval(1)
+    {'c': 'abcd', 'r': '_1024_2047'}
+    >>> ids = [table.get_block_id(chr(i >> 8) + chr(i & 255), 0, 1)
+    ...        for i in range(999)]
+    >>> ids == range(2, 1001), table.get_block_id('\\x00*', 0, 1), len(table)
+    (True, 44, 1001)
+    """
+
+    min_index_size = 1024
+
+    def __init__(self):
+        self.digest_size = None
+        self.digests = bytearray()
+        self.starts = array('l')
+        self.lengths = array('I')   # block length, end is start + length - 1
+        self.counts = array('i')
+        self.index = array('i', [0]) * self.min_index_size  # id + 1
+        self.mask = self.min_index_size - 1
+
+    def get_id(self, hval):
+        (blank, start, end) = hval['r'].split('_')
+        return self.get_block_id(unhexlify(hval['c']), int(start), int(end))
+
+    def get_block_id(self, digest, start, end):
+        index = self.index
+        size = self.digest_size
+        slot = (hash(digest) ^ start) & self.mask
+        idx = index[slot] - 1
+        while idx >= 0:
+            if self.starts[idx] == start and \
+                    self.lengths[idx] == end - start + 1 and \
+                    self.digests[idx * size:idx * size + size] == digest:
+                self.counts[idx] += 1
+                return idx
+            slot = (slot + 1) & self.mask
+            idx = index[slot] - 1
+
+        idx = len(self.counts)
+        if size is None:
+            self.digest_size = len(digest)
+        elif len(digest) != size:
+            raise ValueError('Error: mixed checksum types')
+        self.digests.extend(digest)
+        self.starts.append(start)
+        self.lengths.append(end - start + 1)
+        self.counts.append(1)
+        index[slot] = idx + 1
+        if 3 * (idx + 1) > 2 * len(index):
+            self._grow()
+        return idx
+
+    def _grow(self):
+        "doubles index size, keeping load factor at or below 2/3"
+        size = self.digest_size
+        index = array('i', [0]) * (2 * len(self.index))
+        mask = len(index) - 1
+        for idx in xrange(len(self.counts)):
+            digest = str(self.digests[idx * size:idx * size + size])
+            slot = (hash(digest) ^ self.starts[idx]) & mask
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = idx + 1
+        self.index = index
+        self.mask = mask
+
+    def get_hval(self, idx):
+        size = self.digest_size
+        return {'c': hexlify(self.digests[idx * size:idx * size + size]),
+                'r': '_{}_{}'.format(self.starts[idx], self.starts[idx] +
+                                     self.lengths[idx] - 1)}
+
+    def get_count(self, idx):
+        return self.counts[idx]
+
+    def add_count(self, idx, count):
+        self.counts[idx] += count
+
+    def __len__(self):
+        return len(self.counts)
+
+
 class ChecksumMap:
     """
     Class for mapping checksum values to numeric key, and maintaining counts
@@ -114,27 +272,34 @@ class ChecksumMap:
     {'c': 'eee', 'r': 'r'}
     >>> ChecksumMap.get_range_using_encoded_id('H:1')
     'r'
+    >>> ChecksumMap.get_block_id('\\xab\\xcd', 0, 1023)
+    2
+    >>> ChecksumMap.get_block_id('\\xab\\xcd', 0, 1023)
+    2
+    >>> ChecksumMap.get_count(2)
+    2
+    >>> ChecksumMap.add_count(2, 3); ChecksumMap.get_count(2)
+    5
+    >>> ChecksumMap.get_hval(2)
+    {'c': 'abcd', 'r': '_0_1023'}
+    >>> ChecksumMap.get_range_using_encoded_id('H:2')
+    '_0_1023'
     >>> ChecksumMap.reset()
     """
 
-    map2idx = {}
-    map2hval = []
-    counts = []
+    table_type = ChecksumTable
+    table = ChecksumTable()
 
     @classmethod
     def get_id(cls, hval):
         "Maps hashes to unique hash numbers and maintains mapping tables"
-        fingerprint = hval['c']+hval['r']  # include range in checksum name
-        if fingerprint in cls.map2idx:
-            idx = cls.map2idx[fingerprint]
-            cls.counts[idx] += 1
-            return idx
-        else:
-            idx = len(cls.map2hval)
-            cls.map2idx[fingerprint] = idx
-            cls.map2hval.append(hval)
-            cls.counts.append(1)
-            return idx
+        return cls.table.get_id(hval)
+
+    @classmethod
+    def get_block_id(cls, digest, start, end):
+        """Same as get_id, for block records parsed into binary digest and
+        integer offsets"""
+        return cls.table.get_block_id(digest, start, end)
 
     @classmethod
     def get_encoded_id(cls, hval):
@@ -142,25 +307,39 @@ class ChecksumMap:
 
     @classmethod
     def get_hval(cls, idx):
-        return cls.map2hval[idx]
+        return cls.table.get_hval(idx)
 
     @classmethod
     def get_hval_using_encoded_id(cls, eidx):
-        return cls.map2hval[cls.decode(eidx)]
+        return cls.table.get_hval(cls.decode(eidx))
+
+    @classmethod
+    def get_range(cls, idx):
+        return cls.table.get_hval(idx)['r']
 
     @classmethod
     def get_range_using_encoded_id(cls, eidx):
-        return cls.map2hval[cls.decode(eidx)]['r']
+        return cls.table.get_hval(cls.decode(eidx))['r']
 
     @classmethod
     def get_count(cls, idx):
-        return cls.counts[idx]
+        return cls.table.get_count(idx)
+
+    @classmethod
+    def add_count(cls, idx, count):
+        "records count further occurrences of checksum idx"
+        cls.table.add_count(idx, count)
 
     @classmethod
-    def reset(cls):
-        cls.map2idx = {}
-        cls.map2hval = []
-        cls.counts = []
+    def size(cls):
+        return len(cls.table)
+
+    @classmethod
+    def reset(cls, table_type=None):
+        "clears mapping tables, optionally switching storage type"
+        if table_type:
+            cls.table_type = table_type
+        cls.table = cls.table_type()
 
     @staticmethod
     def encode(idx):
@@ -183,6 +362,17 @@ class ChecksumMap:
         return int(idx)
 
 
+def use_compact_tables(compact=True):
+    """selects compact storage for ChecksumMap, trading lookup speed for
+       memory.  File names are always stored with shared directories held
+       once"""
+    FnameMap.reset(PrefixFnameTable)
+    if compact:
+        ChecksumMap.reset(CompactChecksumTable)
+    else:
+        ChecksumMap.reset(ChecksumTable)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
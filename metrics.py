@@ -0,0 +1,282 @@
+import os
+import time
+import json
+import cProfile
+import resource
+
+#---------------------------------------------------
+# Per-stage timers, counters and peak memory, with optional profiling
+#---------------------------------------------------
+
+
+def peak_rss_mb():
+    "high-water mark of process memory so far, in MB"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def status_mb(field):
+    """memory field (e.g. VmRSS, VmHWM) of /proc/self/status in MB, None
+       where not available"""
+    try:
+        fd = open('/proc/self/status')
+    except IOError:
+        return None
+    try:
+        for text in fd:
+            if text.startswith(field + ':'):
+                return int(text.split()[1]) / 1024.0
+    finally:
+        fd.close()
+    return None
+
+
+def reset_peak_rss():
+    """restarts high-water mark reported by status_mb('VmHWM') from current
+       memory, where Linux allows.  Returns whether it was reset"""
+    try:
+        fd = open('/proc/self/clear_refs', 'w')
+        try:
+            fd.write('5')
+        finally:
+            fd.close()
+    except IOError:
+        return False
+    return status_mb('VmHWM') is not None
+
+
+class PeakMeter(object):
+    """
+    high-water mark of process memory in MB since last restarted, read
+    from VmHWM of /proc/self/status and restarted through
+    /proc/self/clear_refs.  Both files are kept open, as stages may be
+    timed thousands of times.  Where Linux does not allow a restart,
+    peak() is the high-water mark of the process so far
+    >>> meter = PeakMeter()
+    >>> block = ' ' * (64 << 20)
+    >>> before = meter.peak()
+    >>> del block
+    >>> meter.restart()
+    >>> meter.peak() < before - 32 or not meter.resettable
+    True
+    >>> meter.close()
+    """
+
+    def __init__(self):
+        self.resettable = False
+        try:
+            self.status = os.open('/proc/self/status', os.O_RDONLY)
+        except OSError:
+            self.status = None
+            return
+        try:
+            self.clear_refs = os.open('/proc/self/clear_refs', os.O_WRONLY)
+            os.write(self.clear_refs, '5')
+            self.resettable = True
+        except OSError:
+            self.clear_refs = None
+
+    def peak(self):
+        if self.status is None:
+            return peak_rss_mb()
+        os.lseek(self.status, 0, os.SEEK_SET)
+        text = os.read(self.status, 8192)
+        start = text.index('VmHWM:') + len('VmHWM:')
+        return int(text[start:text.index('kB', start)]) / 1024.0
+
+    def restart(self):
+        if self.resettable:
+            os.write(self.clear_refs, '5')
+
+    def close(self):
+        for fd in (self.status, self.clear_refs):
+            if fd is not None:
+                os.close(fd)
+        self.status = self.clear_refs = None
+        self.resettable = False
+
+
+class NullTimer(object):
+    "timer used while metrics are disabled"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class StageTimer(object):
+    """times one call of a stage.  Nested calls of the same stage (e.g.
+       recursive sub-group processing) are counted but not timed again.
+       Memory peaks are taken within each call, with the peak of an
+       inner stage also counted for the stages around it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.outer = False
+
+    def __enter__(self):
+        Metrics.calls[self.name] = Metrics.calls.get(self.name, 0) + 1
+        if self.name in Metrics.active:
+            return self
+        self.outer = True
+        Metrics.fold_peak()
+        Metrics.active.add(self.name)
+        if self.name in Metrics.profiled:
+            if self.name not in Metrics.profilers:
+                Metrics.profilers[self.name] = Metrics.profiler_type()
+            Metrics.profilers[self.name].enable()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.outer:
+            name = self.name
+            Metrics.seconds[name] = Metrics.seconds.get(name, 0.0) + \
+                time.time() - self.start
+            if name in Metrics.profilers:
+                Metrics.profilers[name].disable()
+            Metrics.fold_peak()
+            Metrics.active.discard(name)
+        return False
+
+
+class Metrics(object):
+    """
+    Class level collector of stage timings and counters, reset per run.
+    While disabled, timer() returns a no-op and counters are ignored.
+    Stages named in profiled are also run under profiler_type, e.g.
+    cProfile.Profile or any sampling profiler with the same enable,
+    disable and dump_stats methods.  Profiled stages should not nest.
+    peak_rss_mb of a stage is the high-water mark of process memory
+    while it ran, where Linux allows it to be restarted (see PeakMeter),
+    otherwise of the process so far
+    >>> Metrics.reset(enabled=True)
+    >>> with Metrics.timer('parse'):
+    ...     with Metrics.timer('parse'):
+    ...         Metrics.count('lines', 10)
+    >>> Metrics.count('lines', 5)
+    >>> Metrics.maximum('largest', 3); Metrics.maximum('largest', 2)
+    >>> report = Metrics.report()
+    >>> (report['counters'], report['maxima'],
+    ...  report['stages']['parse']['calls'])
+    ({'lines': 15}, {'largest': 3}, 2)
+    >>> Metrics.merge(report)
+    >>> Metrics.report()['counters']
+    {'lines': 30}
+    >>> with Metrics.timer('big'):
+    ...     block = ' ' * (64 << 20)
+    >>> del block
+    >>> with Metrics.timer('small'):
+    ...     pass
+    >>> stages = Metrics.report()['stages']
+    >>> (stages['small']['peak_rss_mb'] < stages['big']['peak_rss_mb'] - 32
+    ...  or not Metrics.meter.resettable)
+    True
+    >>> Metrics.reset()
+    >>> with Metrics.timer('parse'):
+    ...     Metrics.count('lines')
+    >>> Metrics.report()['counters']
+    {}
+    """
+
+    enabled = False
+    meter = None
+    profiler_type = cProfile.Profile
+    null_timer = NullTimer()
+
+    @classmethod
+    def reset(cls, enabled=False, profiled=()):
+        "clears all metrics, enabling collection and profiling as given"
+        cls.enabled = enabled
+        cls.profiled = frozenset(profiled)
+        cls.start = time.time()
+        cls.seconds = {}
+        cls.calls = {}
+        cls.peaks = {}
+        cls.counters = {}
+        cls.maxima = {}
+        cls.active = set()
+        cls.profilers = {}
+        cls.process_peak = 0.0
+        if cls.meter:
+            cls.meter.close()
+        cls.meter = PeakMeter() if enabled else None
+
+    @classmethod
+    def fold_peak(cls):
+        """adds memory high-water mark since last call to peaks of stages
+           running and of the process, and restarts it"""
+        peak = cls.meter.peak()
+        for name in cls.active:
+            cls.peaks[name] = max(cls.peaks.get(name, 0.0), peak)
+        cls.process_peak = max(cls.process_peak, peak)
+        cls.meter.restart()
+
+    @classmethod
+    def timer(cls, name):
+        "context manager timing stage name"
+        if not cls.enabled:
+            return cls.null_timer
+        return StageTimer(name)
+
+    @classmethod
+    def count(cls, name, amount=1):
+        if cls.enabled:
+            cls.counters[name] = cls.counters.get(name, 0) + amount
+
+    @classmethod
+    def maximum(cls, name, value):
+        "records largest value seen for name"
+        if cls.enabled and value > cls.maxima.get(name, value - 1):
+            cls.maxima[name] = value
+
+    @classmethod
+    def report(cls):
+        "all metrics collected since reset, as JSON serializable dict"
+        stages = {}
+        for name in cls.calls:
+            stages[name] = {'seconds': cls.seconds.get(name, 0.0),
+                            'calls': cls.calls[name],
+                            'peak_rss_mb': cls.peaks.get(name, 0.0)}
+        return {'wall_seconds': time.time() - cls.start,
+                'peak_rss_mb': max(peak_rss_mb(), cls.process_peak,
+                                   cls.meter.peak() if cls.meter else 0.0),
+                'stages': stages,
+                'counters': dict(cls.counters),
+                'maxima': dict(cls.maxima)}
+
+    @classmethod
+    def merge(cls, report):
+        """adds metrics reported by another process, e.g. a pool worker.
+           Timers and counters are summed, maxima and peaks combined"""
+        if not cls.enabled:
+            return
+        for name, stage in report['stages'].iteritems():
+            cls.seconds[name] = cls.seconds.get(name, 0.0) + stage['seconds']
+            cls.calls[name] = cls.calls.get(name, 0) + stage['calls']
+            cls.peaks[name] = max(cls.peaks.get(name, 0.0),
+                                  stage['peak_rss_mb'])
+        for name, amount in report['counters'].iteritems():
+            cls.count(name, amount)
+        for name, value in report['maxima'].iteritems():
+            cls.maximum(name, value)
+
+    @classmethod
+    def write(cls, fname, profile_prefix=None):
+        """writes report to fname in JSON format, if given, and stats of
+           each profiled stage to profile_prefix.<stage>.prof"""
+        if fname:
+            fd = open(fname, 'w')
+            json.dump(cls.report(), fd, indent=4, sort_keys=True)
+            fd.close()
+        for name, profiler in sorted(cls.profilers.items()):
+            profiler.dump_stats('{}.{}.prof'.format(profile_prefix, name))
+
+
+Metrics.reset()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,207 @@
+import numpy as np
+from partition import UnionFind
+from partition import partition_vectors
+from metrics import Metrics
+
+#---------------------------------------------------
+# MinHash/LSH pre-clustering, splitting giant partitions into clusters of
+# similar files before exact graph analysis
+#---------------------------------------------------
+
+prime = (1 << 31) - 1   # modulus of checksum hash functions, also empty value
+
+
+def hub_checksums(members, degree):
+    """checksums held by more than degree of member vectors, e.g. blocks of
+       zeros or common headers
+    >>> sorted(hub_checksums([[0, [1, 2]], [1, [2, 3]], [2, [2, 1]]], 2))
+    [2]
+    """
+    csums = np.fromiter((hno for fno, hset in members for hno in hset),
+                        dtype=np.int64)
+    if not len(csums):
+        return set()
+    (values, counts) = np.unique(csums, return_counts=True)
+    return set(values[counts > degree].tolist())
+
+
+def minhash_signatures(members, perms, hubs=(), seed=1):
+    """MinHash signature of each member vector over its checksums other than
+       hubs, as array[len(members), perms].  Vectors without such checksums
+       are given a signature of prime values only
+    >>> sig = minhash_signatures([[0, [1, 2, 3]], [1, [3, 2, 1]], [2, [4]],
+    ...                           [3, [5]]], 8, hubs=set([5]))
+    >>> (sig[0] == sig[1]).all(), (sig[0] == sig[2]).any()
+    (True, False)
+    >>> (sig[3] == prime).all()
+    True
+    """
+    rng = np.random.RandomState(seed)
+    mult = rng.randint(1, prime, size=perms).astype(np.int64)
+    add = rng.randint(0, prime, size=perms).astype(np.int64)
+    signatures = np.empty((len(members), perms), dtype=np.int64)
+    signatures.fill(prime)
+    for row, (fno, hset) in enumerate(members):
+        csums = np.array([hno for hno in hset if hno not in hubs],
+                         dtype=np.int64)
+        if len(csums):
+            signatures[row] = ((np.outer(csums, mult) + add) % prime).min(0)
+    return signatures
+
+
+def lsh_clusters(signatures, bands):
+    """cluster of each signature, as lowest row of cluster.  Signatures are
+       joined when equal in all rows of any of bands, and those of prime
+       values only are not joined
+    >>> sig = np.array([[1, 2, 3, 4], [1, 2, 5, 6], [7, 8, 5, 6],
+    ...                 [9, 9, 9, 9], [prime] * 4, [prime] * 4])
+    >>> lsh_clusters(sig, 2)
+    [0, 0, 0, 3, 4, 5]
+    """
+    (count, perms) = signatures.shape
+    rows = perms // bands
+    sets = UnionFind(count)
+    valid = np.flatnonzero(signatures[:, 0] != prime).tolist()
+    for band in xrange(bands):
+        buckets = {}
+        keys = signatures[:, band * rows:(band + 1) * rows]
+        for idx in valid:
+            key = keys[idx].tostring()
+            if key in buckets:
+                sets.union(buckets[key], idx)
+            else:
+                buckets[key] = idx
+    return [sets.find(idx) for idx in xrange(count)]
+
+
+def connected_members(members):
+    """partition_vectors of members, with checksums numbered locally so
+       union-find stays the size of members
+    >>> connected_members([[5, [900, 901]], [6, [7]], [8, [901]]])
+    [[[5, [900, 901]], [8, [901]]], [[6, [7]]]]
+    """
+    local = {}
+    renumbered = [[position, [local.setdefault(hno, len(local))
+                              for hno in hset]]
+                  for position, (fno, hset) in enumerate(members)]
+    return [[members[position] for position, hset in part]
+            for part in partition_vectors(renumbered, len(local))]
+
+
+class Precluster(object):
+    """
+    splits partitions of more than min_files files into clusters of similar
+    files, using MinHash signatures of perms hash functions banded into
+    bands for LSH.  Checksums held by more than hub_degree files of a
+    partition are left out of signatures, so hubs do not make all files
+    similar.  Each cluster is partitioned again, so partitions stay
+    connected; files left on their own are not analysed further.  Files
+    holding only hub checksums have no signature to cluster by, so they
+    are kept together as in the original partition, and counted.
+
+    Faster, at the cost of savings between files of different clusters.
+    More bands (fewer rows per band) find less similar files, see
+    similarity_threshold, at the cost of larger clusters
+    >>> members = [[fno, [10 * (fno // 3) + i for i in range(8)] + [99]]
+    ...            for fno in range(9)]
+    >>> precluster = Precluster(min_files=4, perms=16, bands=4, hub_degree=3)
+    >>> [[fno for fno, hset in part] for part in precluster.split([members])]
+    [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+    >>> report = precluster.report()
+    >>> (report['hub_checksums'], report['clusters'],
+    ...  report['unclustered_files'])
+    (1, 3, 0)
+    >>> precluster = Precluster(min_files=2, hub_degree=1)
+    >>> [[fno for fno, hset in part] for part in
+    ...  precluster.split([[[0, [1, 2]], [1, [1, 2]], [2, [2]]]])]
+    [[0, 1, 2]]
+    >>> precluster.report()['hub_only_files']
+    3
+    """
+
+    def __init__(self, min_files=1000, perms=64, bands=16, hub_degree=100,
+                 seed=1):
+        if perms % bands:
+            raise ValueError('Error: {} hash functions do not split into'
+                             ' {} bands'.format(perms, bands))
+        self.min_files = min_files
+        self.perms = perms
+        self.bands = bands
+        self.hub_degree = hub_degree
+        self.seed = seed
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.partitions_split = 0
+        self.files_split = 0
+        self.hubs = 0
+        self.clusters = 0
+        self.unclustered = 0
+        self.hub_only = 0
+
+    def params(self):
+        return {'min_files': self.min_files,
+                'perms': self.perms,
+                'bands': self.bands,
+                'hub_degree': self.hub_degree,
+                'seed': self.seed}
+
+    def similarity_threshold(self):
+        "Jaccard similarity at which files are clustered with even chance"
+        return (1.0 / self.bands) ** (float(self.bands) / self.perms)
+
+    def split(self, partitions):
+        """partitions, given as member vectors, with those of more than
+           min_files files replaced by partitions of their clusters"""
+        result = []
+        with Metrics.timer('precluster'):
+            for members in partitions:
+                if len(members) > self.min_files:
+                    result.extend(self.split_partition(members))
+                else:
+                    result.append(members)
+        return result
+
+    def split_partition(self, members):
+        hubs = hub_checksums(members, self.hub_degree)
+        signatures = minhash_signatures(members, self.perms, hubs, self.seed)
+        clusters = {}
+        order = []
+        hub_only = []
+        for vec, sig, cluster in zip(members, signatures,
+                                     lsh_clusters(signatures, self.bands)):
+            if sig[0] == prime:
+                hub_only.append(vec)
+                continue
+            if cluster not in clusters:
+                clusters[cluster] = []
+                order.append(cluster)
+            clusters[cluster].append(vec)
+
+        result = []
+        for cluster in order:
+            result.extend(connected_members(clusters[cluster]))
+        result.extend(connected_members(hub_only))
+        self.partitions_split += 1
+        self.files_split += len(members)
+        self.hubs += len(hubs)
+        self.hub_only += len(hub_only)
+        self.clusters += sum(1 for part in result if len(part) > 1)
+        self.unclustered += sum(1 for part in result if len(part) == 1)
+        return result
+
+    def report(self):
+        "parameters and results of pre-clustering, as JSON serializable dict"
+        return {'parameters': self.params(),
+                'similarity_threshold': self.similarity_threshold(),
+                'partitions_split': self.partitions_split,
+                'files_split': self.files_split,
+                'hub_checksums': self.hubs,
+                'clusters': self.clusters,
+                'unclustered_files': self.unclustered,
+                'hub_only_files': self.hub_only}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,291 @@
+import multiprocessing
+import os
+from array import array
+import checksum_reader
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+from metrics import Metrics
+
+#---------------------------------------------------
+# Parallel parsing of a single sub-file checksum file.  The file is split
+# into byte ranges at file name boundaries, each range parsed by a worker
+# into vectors over its own checksum table, and ranges merged in order
+# into FnameMap and ChecksumMap, so ids match those of a serial read.
+# Parsing may also start before whole-file duplicates are known, with
+# duplicates left out as ranges are merged
+#---------------------------------------------------
+
+# smallest range given to a worker, smaller files are read serially
+min_chunk_bytes = 16 << 20
+# ranges per worker, so one slow range does not hold up the others
+chunks_per_job = 4
+
+# duplicate map of pool workers, set by init_worker.  None when
+# duplicates are not yet known, so all files are kept
+worker_dup_map = None
+
+
+class ChunkVectors(object):
+    """
+    vectors of one range of a sub-file checksum file, numbered by a
+    checksum table of the range.  Once packed, checksums are held as one
+    digest string plus offset arrays and vector members as one array, so
+    a range is cheap to send back from a worker
+    >>> chunk = ChunkVectors()
+    >>> chunk.add_file('/a', [('\\x01', 0, 9), ('\\x02', 10, 19)], {})
+    >>> chunk.add_file('/b', [('\\x01', 0, 9), ('\\x03', 10, 19)], {})
+    >>> chunk.add_file('/c', [('\\x01', 0, 9)], {})
+    >>> chunk.add_file('/d', [('\\x04', 0, 9), ('\\x04', 10, 19)], {'/d': 1})
+    >>> chunk = chunk.pack()
+    >>> chunk.names, list(chunk.members), list(chunk.sizes)
+    (['/a', '/b'], [0, 1, 0, 2], [2, 2])
+    >>> list(chunk.counts), chunk.checksum(2)
+    ([2, 1, 1], ('\\x03', 10, 19))
+    >>> chunk.lines, chunk.files, chunk.duplicate_files, chunk.duplicate_bytes
+    (7, 4, 1, 20)
+    >>> chunk = ChunkVectors()
+    >>> chunk.add_file('/c', [('\\x01', 0, 9)], None)
+    >>> chunk.names, list(chunk.members)
+    (['/c'], [0])
+    """
+
+    def __init__(self):
+        self.ids = {}                   # (digest, start, end) -> local id
+        self.digests = []
+        self.digest_size = 0
+        self.starts = array('l')
+        self.ends = array('l')
+        self.counts = array('i')
+        self.names = []                 # names of files kept as vectors
+        self.members = array('i')       # local ids of all vectors in turn
+        self.sizes = array('i')         # number of members of each vector
+        self.lines = 0
+        self.files = 0
+        self.duplicate_files = 0
+        self.duplicate_bytes = 0
+
+    def add_file(self, name, blocks, dup_map):
+        """same filtering as construct_block_vector, also tallying
+           whole_savings of duplicate files.  With dup_map None, every file
+           is kept, for merge_deferred_chunk to filter"""
+        self.lines += len(blocks)
+        self.files += 1
+        if dup_map is None:
+            self.add_vector(name, blocks)
+        elif name in dup_map:
+            self.duplicate_files += 1
+            self.duplicate_bytes += blocks[-1][2] + 1 if blocks else 0
+        elif len(blocks) > 1:
+            self.add_vector(name, blocks)
+
+    def add_vector(self, name, blocks):
+        ids = self.ids
+        append = self.members.append
+        for fingerprint in blocks:
+            idx = ids.get(fingerprint)
+            if idx is None:
+                idx = ids[fingerprint] = len(self.counts)
+                self.digests.append(fingerprint[0])
+                self.starts.append(fingerprint[1])
+                self.ends.append(fingerprint[2])
+                self.counts.append(1)
+            else:
+                self.counts[idx] += 1
+            append(idx)
+        self.names.append(name)
+        self.sizes.append(len(blocks))
+
+    def pack(self):
+        "drops fingerprint index and joins digests, returns self"
+        self.ids = None
+        if self.digests:
+            self.digest_size = len(self.digests[0])
+        self.digests = ''.join(self.digests)
+        return self
+
+    def checksum(self, idx):
+        "(digest, start, end) of local id, once packed"
+        size = self.digest_size
+        return (self.digests[idx * size:idx * size + size],
+                self.starts[idx], self.ends[idx])
+
+
+def init_worker(dup_map):
+    global worker_dup_map
+    worker_dup_map = dup_map
+
+
+def parse_range(args):
+    """pool worker, ChunkVectors of bytes start to end of fname, or of the
+       whole file, which may be compressed, if start is None"""
+    (fname, start, end, hash_type) = args
+    chunk = ChunkVectors()
+    if start is None:
+        block_sets = checksum_reader.read_subfile_blocks(fname, hash_type)
+    else:
+        block_sets = checksum_reader.read_subfile_range(fname, start, end,
+                                                        hash_type)
+    for name, blocks in block_sets:
+        chunk.add_file(name, blocks, worker_dup_map)
+    return chunk.pack()
+
+
+def merge_chunk(chunk, result):
+    """adds vectors of chunk to result, numbering files and checksums in
+       FnameMap and ChecksumMap"""
+    table = ChecksumMap.table   # local names, merge is not parallel
+    get_block_id = table.get_block_id
+    digests = chunk.digests
+    size = chunk.digest_size
+    remap = []
+    pos = 0
+    for start, end, count in zip(chunk.starts, chunk.ends, chunk.counts):
+        hno = get_block_id(digests[pos:pos + size], start, end)
+        if count > 1:
+            table.add_count(hno, count - 1)
+        remap.append(hno)
+        pos += size
+
+    lookup = remap.__getitem__
+    members = chunk.members
+    pos = 0
+    for name, size in zip(chunk.names, chunk.sizes):
+        result.append([FnameMap.get_id(name),
+                       map(lookup, members[pos:pos + size])])
+        pos += size
+
+
+def merge_deferred_chunk(chunk, result, dup_map):
+    """same as merge_chunk, for a chunk parsed before duplicates were
+       known.  Duplicate and single block files are left out here, adding
+       duplicates to chunk savings, and only blocks of files kept are
+       counted"""
+    table = ChecksumMap.table   # local names, merge is not parallel
+    get_block_id = table.get_block_id
+    add_count = table.add_count
+    digests = chunk.digests
+    size = chunk.digest_size
+    starts = chunk.starts
+    ends = chunk.ends
+    remap = [-1] * len(chunk.counts)
+    members = chunk.members
+    pos = 0
+    for name, length in zip(chunk.names, chunk.sizes):
+        if name in dup_map:
+            chunk.duplicate_files += 1
+            chunk.duplicate_bytes += ends[members[pos + length - 1]] + 1
+        elif length > 1:
+            hset = []
+            for idx in members[pos:pos + length]:
+                hno = remap[idx]
+                if hno < 0:
+                    hno = remap[idx] = get_block_id(
+                        digests[idx * size:idx * size + size],
+                        starts[idx], ends[idx])
+                else:
+                    add_count(hno, 1)
+                hset.append(hno)
+            result.append([FnameMap.get_id(name), hset])
+        pos += length
+
+
+def merge_chunks(chunks, dup_map=None, reset_names=True,
+                 whole_savings=None):
+    """vectors of chunks, merged in order.  dup_map is given for chunks
+       parsed before duplicates were known"""
+    result = []
+    if reset_names:
+        FnameMap.reset()
+    ChecksumMap.reset()
+
+    lines = 0
+    files = 0
+    count = 0
+    for chunk in chunks:
+        with Metrics.timer('merge_chunks'):
+            if dup_map is None:
+                merge_chunk(chunk, result)
+            else:
+                merge_deferred_chunk(chunk, result, dup_map)
+        if whole_savings is not None:
+            whole_savings['files'] += chunk.duplicate_files
+            whole_savings['bytes'] += chunk.duplicate_bytes
+        lines += chunk.lines
+        files += chunk.files
+        count += 1
+    Metrics.count('parse_chunks', count)
+    Metrics.count('subfile_lines', lines)
+    Metrics.count('vectors_dropped', files - len(result))
+    Metrics.count('checksums', ChecksumMap.size())
+    return result
+
+
+def splittable(fname, jobs):
+    "whether fname is worth parsing in parallel by jobs workers"
+    return (jobs > 1 and not checksum_reader.compression_type(fname) and
+            os.path.getsize(fname) >= 2 * min_chunk_bytes)
+
+
+def chunk_ranges(fname, jobs, hash_type='MD5'):
+    "non-empty byte ranges of fname, at file name boundaries"
+    size = os.path.getsize(fname)
+    parts = max(1, min(jobs * chunks_per_job, size // min_chunk_bytes))
+    offsets = checksum_reader.file_boundaries(fname, parts, hash_type)
+    return [(start, end) for start, end in zip(offsets, offsets[1:])
+            if end > start]
+
+
+def construct_vectors_parallel(fname, dup_map, jobs, hash_type='MD5',
+                               reset_names=True, whole_savings=None):
+    """same as construct_block_vectors over
+       checksum_reader.read_subfile_blocks(fname), with ranges of plain
+       file fname parsed by jobs worker processes"""
+    ranges = chunk_ranges(fname, jobs, hash_type)
+    pool = multiprocessing.Pool(min(jobs, len(ranges)), init_worker,
+                                (dup_map,))
+    try:
+        result = merge_chunks(
+            pool.imap(parse_range, [(fname, start, end, hash_type)
+                                    for start, end in ranges]),
+            reset_names=reset_names, whole_savings=whole_savings)
+        pool.close()
+    finally:
+        pool.terminate()
+    return result
+
+
+class PendingVectors(object):
+    """
+    block checksum file parsed by worker processes from the time this is
+    created, typically before whole-file duplicates are known, while the
+    caller goes on with other stages.  Large plain files are parsed in
+    ranges by jobs workers, others whole by one worker.  Parsed ranges
+    are held until vectors() is called, once duplicates are known
+    """
+
+    def __init__(self, fname, jobs=1, hash_type='MD5'):
+        if splittable(fname, jobs):
+            ranges = chunk_ranges(fname, jobs, hash_type)
+        else:
+            ranges = [(None, None)]
+        self.pool = multiprocessing.Pool(min(jobs, len(ranges)), init_worker,
+                                         (None,))
+        self.chunks = self.pool.imap(parse_range,
+                                     [(fname, start, end, hash_type)
+                                      for start, end in ranges])
+
+    def vectors(self, dup_map, reset_names=True, whole_savings=None):
+        """same as construct_vectors_parallel, waiting for ranges still
+           being parsed"""
+        try:
+            result = merge_chunks(self.chunks, dup_map, reset_names,
+                                  whole_savings)
+            self.pool.close()
+        finally:
+            self.pool.terminate()
+        return result
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,86 @@
+from array import array
+
+#---------------------------------------------------
+# Streaming partitioning of file vectors into connected components
+#---------------------------------------------------
+
+
+class UnionFind(object):
+    """
+    disjoint sets over integer ids, grown on demand.  Each set is
+    represented by its lowest id, so results do not depend on union order
+    >>> sets = UnionFind()
+    >>> sets.union(5, 3)
+    3
+    >>> sets.union_all([7, 5, 8])
+    3
+    >>> [sets.find(idx) for idx in range(9)]
+    [0, 1, 2, 3, 4, 3, 6, 3, 3]
+    """
+
+    def __init__(self, size=0):
+        self.parent = array('l', xrange(size))
+
+    def _grow(self, idx):
+        parent = self.parent
+        parent.extend(xrange(len(parent), max(idx + 1, 2 * len(parent))))
+
+    def find(self, idx):
+        "returns representative of set containing idx, with path halving"
+        parent = self.parent
+        if idx >= len(parent):
+            self._grow(idx)
+            return idx
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    def union(self, idx1, idx2):
+        "merges sets containing idx1 and idx2, returns representative"
+        return self.union_all((idx1, idx2))
+
+    def union_all(self, ids):
+        "merges sets containing each of ids, returns representative"
+        find = self.find
+        roots = set(find(idx) for idx in ids)
+        root = min(roots)
+        parent = self.parent
+        for other in roots:
+            parent[other] = root
+        return root
+
+
+def partition_vectors(vectors, size=0):
+    """groups [fno, [hno, ...]] vectors into connected components of the
+       file/checksum graph.  Checksums are joined in a union-find as
+       vectors stream past, so no graph is built; size is an optional
+       hint of the number of checksum ids.  Returns a list of components,
+       each a list of member vectors, ordered by first member in stream
+    >>> partition_vectors([[10, [1, 2]], [11, [7]], [12, [2, 3]], [13, []]])
+    [[[10, [1, 2]], [12, [2, 3]]], [[11, [7]]], [[13, []]]]
+    """
+    sets = UnionFind(size)
+    members = []
+    for vec in vectors:
+        if vec[1]:
+            sets.union_all(vec[1])
+        members.append(vec)
+
+    find = sets.find
+    components = {}
+    result = []
+    for position, vec in enumerate(members):
+        # file without checksums is a component of its own
+        key = find(vec[1][0]) if vec[1] else -1 - position
+        if key in components:
+            components[key].append(vec)
+        else:
+            components[key] = [vec]
+            result.append(components[key])
+    return result
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,193 @@
+from array import array
+
+#---------------------------------------------------
+# File paths stored as interned directories plus base names, so that
+# directory prefixes shared by many files are held once
+#---------------------------------------------------
+
+
+class DirectoryTrie(object):
+    """
+    interned directory paths, each stored as parent directory id and last
+    path component.  Files are usually listed directory by directory, so
+    the last directory looked up is remembered
+    >>> dirs = DirectoryTrie()
+    >>> dirs.get_id('/a/b'), dirs.get_id('/a/c'), dirs.get_id('/a/b')
+    (2, 3, 2)
+    >>> dirs.find('/a'), dirs.find('/x'), dirs.path(3), len(dirs)
+    (1, None, '/a/c', 4)
+    """
+
+    def __init__(self):
+        self.ids = {}                   # (parent id, component) -> id
+        self.parents = array('i')
+        self.components = []
+        self.last = (None, None)        # last (path, id) looked up
+        self.last_path = (None, None)   # last (id, path) resolved
+
+    def get_id(self, path):
+        "id of directory path, adding it if new"
+        if path == self.last[0]:
+            return self.last[1]
+        ids = self.ids
+        idx = -1
+        for component in path.split('/'):
+            key = (idx, component)
+            if key in ids:
+                idx = ids[key]
+            else:
+                ids[key] = len(self.components)
+                idx = len(self.components)
+                self.parents.append(key[0])
+                self.components.append(component)
+        self.last = (path, idx)
+        return idx
+
+    def find(self, path):
+        "id of directory path, or None if not known"
+        if path == self.last[0]:
+            return self.last[1]
+        ids = self.ids
+        idx = -1
+        for component in path.split('/'):
+            idx = ids.get((idx, component))
+            if idx is None:
+                return None
+        self.last = (path, idx)
+        return idx
+
+    def path(self, idx):
+        "directory path of id"
+        if idx == self.last_path[0]:
+            return self.last_path[1]
+        components = []
+        node = idx
+        while node >= 0:
+            components.append(self.components[node])
+            node = self.parents[node]
+        path = '/'.join(reversed(components))
+        self.last_path = (idx, path)
+        return path
+
+    def __len__(self):
+        return len(self.components)
+
+
+def split_path(path):
+    """(directory, base name) of path, directory None if path has none
+    >>> split_path('/a/b.txt'), split_path('/b.txt'), split_path('b.txt')
+    (('/a', 'b.txt'), ('', 'b.txt'), (None, 'b.txt'))
+    """
+    (head, sep, base) = path.rpartition('/')
+    return (head if sep else None, base)
+
+
+class PrefixFnameTable(object):
+    """
+    storage for FnameMap, with directories interned in a DirectoryTrie and
+    base names in a single buffer
+    >>> table = PrefixFnameTable()
+    >>> [table.get_id(name) for name in ['/a/b/x', '/a/b/yy', 'z', '/q']]
+    [0, 1, 2, 3]
+    >>> [table.get_name(idx) for idx in range(4)], len(table), len(table.dirs)
+    (['/a/b/x', '/a/b/yy', 'z', '/q'], 4, 3)
+    """
+
+    def __init__(self):
+        self.dirs = DirectoryTrie()
+        self.file_dirs = array('i')         # directory id, -1 for none
+        self.names = bytearray()
+        self.offsets = array('L', [0])      # offsets[idx] is start of name
+
+    def get_id(self, text):
+        idx = len(self.file_dirs)
+        (head, base) = split_path(text)
+        self.file_dirs.append(-1 if head is None else self.dirs.get_id(head))
+        self.names.extend(base)
+        self.offsets.append(len(self.names))
+        return idx
+
+    def get_name(self, idx):
+        base = str(self.names[self.offsets[idx]:self.offsets[idx + 1]])
+        directory = self.file_dirs[idx]
+        if directory < 0:
+            return base
+        return self.dirs.path(directory) + '/' + base
+
+    def __len__(self):
+        return len(self.file_dirs)
+
+
+class DuplicateMap(object):
+    """
+    map of duplicate files to the file kept for each set, keyed by path id.
+    Paths are interned through a DirectoryTrie, so each directory is held
+    and hashed once however many files it holds
+    >>> dup_map = DuplicateMap()
+    >>> dup_map.add('/a/x', '/a/y'); dup_map.add('/b/z', '/a/y')
+    >>> '/a/x' in dup_map, '/a/y' in dup_map, '/c/x' in dup_map
+    (True, False, False)
+    >>> dup_map['/b/z'], sorted(dup_map), len(dup_map)
+    ('/a/y', ['/a/x', '/b/z'], 2)
+    """
+
+    def __init__(self):
+        self.dirs = DirectoryTrie()
+        self.ids = {}               # (directory id, base name) -> path id
+        self.keys = []
+        self.primary = array('i')   # path id of kept file, -1 if kept
+
+    def _key(self, path):
+        (head, base) = split_path(path)
+        return (-1 if head is None else self.dirs.get_id(head), base)
+
+    def _path_id(self, path):
+        key = self._key(path)
+        if key not in self.ids:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.primary.append(-1)
+        return self.ids[key]
+
+    def _find(self, path):
+        "path id, or None if path is not in map"
+        (head, base) = split_path(path)
+        if head is None:
+            return self.ids.get((-1, base))
+        directory = self.dirs.find(head)
+        if directory is None:
+            return None
+        return self.ids.get((directory, base))
+
+    def _path(self, idx):
+        (directory, base) = self.keys[idx]
+        if directory < 0:
+            return base
+        return self.dirs.path(directory) + '/' + base
+
+    def add(self, secondary, primary):
+        "records secondary as duplicate of primary"
+        self.primary[self._path_id(secondary)] = self._path_id(primary)
+
+    def __contains__(self, path):
+        idx = self._find(path)
+        return idx is not None and self.primary[idx] >= 0
+
+    def __getitem__(self, path):
+        idx = self._find(path)
+        if idx is None or self.primary[idx] < 0:
+            raise KeyError(path)
+        return self._path(self.primary[idx])
+
+    def __iter__(self):
+        for idx, primary in enumerate(self.primary):
+            if primary >= 0:
+                yield self._path(idx)
+
+    def __len__(self):
+        return sum(1 for primary in self.primary if primary >= 0)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,214 @@
+import json
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+
+#---------------------------------------------------
+# Dictionary encoded dedupe results: one file table and one checksum
+# table, with groups referring to both by position
+#---------------------------------------------------
+#
+#   {"format": "dedupe-compact", "version": 1,
+#    "files": [name, ...],
+#    "csums": {"c": [hex digest, ...], "r": [range, ...]},
+#    "groups": [{"files": [id, ...], "selected_files": [...],
+#                "csums": [id, ...], "selected_csums": [...],
+#                "subgroups": [...], "name": ..., "savings": ..., ...}]}
+#
+# Tables only hold files and checksums used by groups, in order of first
+# use.
+
+result_format = 'dedupe-compact'
+result_version = 1
+file_keys = ('files', 'selected_files')
+csum_keys = ('csums', 'selected_csums')
+
+
+class ResultTables(object):
+    """
+    file and checksum tables of a result file.  Groups are given either
+    with FnameMap / ChecksumMap ids, or already resolved to names and
+    checksum dicts
+    >>> tables = ResultTables()
+    >>> entry = tables.encode_group({'files': ['/a', '/b'],
+    ...     'selected_files': ['/b'], 'csums': [{'c': 'ab', 'r': '_0_9'}],
+    ...     'selected_csums': [], 'subgroups': [], 'name': 'g'})
+    >>> sorted(entry.items())       # doctest: +NORMALIZE_WHITESPACE
+    [('csums', [0]), ('files', [0, 1]), ('name', 'g'), ('selected_csums', []),
+     ('selected_files', [1]), ('subgroups', [])]
+    >>> tables.files, tables.digests, tables.ranges
+    (['/a', '/b'], ['ab'], ['_0_9'])
+    """
+
+    def __init__(self):
+        self.file_ids = {}
+        self.files = []
+        self.csum_ids = {}
+        self.digests = []
+        self.ranges = []
+
+    def file_id(self, fno):
+        idx = self.file_ids.get(fno)
+        if idx is None:
+            idx = self.file_ids[fno] = len(self.files)
+            self.files.append(fno if isinstance(fno, basestring)
+                              else FnameMap.get_name(fno))
+        return idx
+
+    def csum_id(self, hno):
+        if isinstance(hno, dict):
+            key = (hno['c'], hno['r'])
+        else:
+            key = hno
+        idx = self.csum_ids.get(key)
+        if idx is None:
+            idx = self.csum_ids[key] = len(self.digests)
+            hval = hno if isinstance(hno, dict) else ChecksumMap.get_hval(hno)
+            self.digests.append(hval['c'])
+            self.ranges.append(hval['r'])
+        return idx
+
+    def encode_group(self, group):
+        "group with files and checksums replaced by table positions"
+        entry = dict((key, value) for key, value in group.iteritems()
+                     if key != 'subgroup')     # alias of subgroups
+        for key in file_keys:
+            entry[key] = [self.file_id(fno) for fno in group[key]]
+        for key in csum_keys:
+            entry[key] = [self.csum_id(hno) for hno in group[key]]
+        entry['subgroups'] = [self.encode_group(subgroup)
+                              for subgroup in group['subgroups']]
+        return entry
+
+
+def write_results(fname, dedupe_groups):
+    """writes dedupe groups in dictionary encoded format, returns number of
+       groups.  Groups need not be annotated"""
+    tables = ResultTables()
+    groups = [tables.encode_group(group) for group in dedupe_groups]
+    fd = open(fname, 'w')
+    try:
+        # dumps rather than dump, which bypasses the C encoder
+        fd.write(json.dumps({'format': result_format,
+                             'version': result_version,
+                             'files': tables.files,
+                             'csums': {'c': tables.digests,
+                                       'r': tables.ranges},
+                             'groups': groups}, separators=(',', ':')))
+    finally:
+        fd.close()
+    return len(groups)
+
+
+class ResultGroup(object):
+    """
+    dedupe group read from a result file.  Ids are kept as read, and only
+    resolved to names and checksums when files, csums etc are accessed,
+    either as attributes or as dict keys
+    """
+
+    def __init__(self, entry, results):
+        self.entry = entry
+        self.results = results
+
+    def __getitem__(self, key):
+        if key in file_keys:
+            return [self.results.file_name(idx) for idx in self.entry[key]]
+        if key in csum_keys:
+            return [self.results.csum(idx) for idx in self.entry[key]]
+        if key in ('subgroups', 'subgroup'):
+            return [ResultGroup(subgroup, self.results)
+                    for subgroup in self.entry['subgroups']]
+        return self.entry[key]
+
+    def __getattr__(self, key):
+        if key in ('entry', 'results'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def ids(self, key):
+        "unresolved ids of files or csums, e.g. ids('selected_files')"
+        return self.entry[key]
+
+    def keys(self):
+        return self.entry.keys()
+
+
+class ResultFile(object):
+    """
+    dedupe results from a dictionary encoded file, or from .dedupe.json or
+    .dedupe.ndjson output of earlier versions whose groups are already
+    resolved.  Groups are wrapped as they are accessed
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'test.dedupe.compact.json')
+    >>> write_results(fname, [{'files': ['/a', '/b'], 'selected_files': [],
+    ...     'csums': [{'c': 'ab', 'r': '_0_9'}], 'selected_csums': [],
+    ...     'subgroups': [{'files': ['/b'], 'selected_files': ['/b'],
+    ...                    'csums': [], 'selected_csums': [],
+    ...                    'subgroups': [], 'savings': 0}], 'savings': 1}])
+    1
+    >>> results = ResultFile(fname)
+    >>> len(results), results[0].files, results[0]['csums']
+    (1, [u'/a', u'/b'], [{'c': u'ab', 'r': u'_0_9'}])
+    >>> [group.subgroups[0].selected_files for group in results]
+    [[u'/b']]
+    >>> results[0].ids('files'), results.file_count, results.csum_count
+    ([0, 1], 2, 1)
+    >>> os.remove(fname)
+    """
+
+    def __init__(self, fname):
+        fd = open(fname)
+        try:
+            if fname.endswith('.ndjson'):
+                data = [json.loads(text) for text in fd if text.strip()]
+            else:
+                data = json.load(fd)
+        finally:
+            fd.close()
+        if isinstance(data, dict) and data.get('format') == result_format:
+            if data['version'] > result_version:
+                raise ValueError('Error: {} written by a later version'.format(
+                    fname))
+            self.files = data['files']
+            self.digests = data['csums']['c']
+            self.ranges = data['csums']['r']
+            self.groups = data['groups']
+            self.resolved = False
+        else:
+            self.files = self.digests = self.ranges = None
+            self.groups = data
+            self.resolved = True
+
+    @property
+    def file_count(self):
+        return None if self.resolved else len(self.files)
+
+    @property
+    def csum_count(self):
+        return None if self.resolved else len(self.digests)
+
+    def file_name(self, idx):
+        return idx if self.resolved else self.files[idx]
+
+    def csum(self, idx):
+        if self.resolved:
+            return idx
+        return {'c': self.digests[idx], 'r': self.ranges[idx]}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __getitem__(self, idx):
+        return ResultGroup(self.groups[idx], self)
+
+    def __iter__(self):
+        for entry in self.groups:
+            yield ResultGroup(entry, self)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,156 @@
+import os
+import stat
+import hashlib
+import tempfile
+import multiprocessing
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+
+#---------------------------------------------------
+# Built-in replacement for md5deep -r -o f [-p size]
+#---------------------------------------------------
+
+hash_types = {'MD5': hashlib.md5,
+              'SHA1': hashlib.sha1,
+              'SHA256': hashlib.sha256}
+
+size_suffixes = {'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+# files are read in chunks of at least this size, regardless of block size
+min_read_size = 1 << 22
+
+
+def parse_block_size(text):
+    """
+    converts md5deep style piecewise size (-p option) into bytes
+    >>> parse_block_size('64k')
+    65536
+    >>> parse_block_size('1m')
+    1048576
+    >>> parse_block_size('512')
+    512
+    """
+    text = text.strip().lower()
+    if text and text[-1] in size_suffixes:
+        return int(text[:-1]) * size_suffixes[text[-1]]
+    return int(text)
+
+
+def walk_files(root):
+    "yields regular files below root, in a stable (sorted) order"
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError:
+                continue
+            if stat.S_ISREG(mode):
+                yield path
+
+
+def hash_file(path, block_size, hash_type='MD5'):
+    """computes whole-file and per-block checksums for a single file.
+       Returns (path, checksum, blocks) where checksum is hex and blocks
+       is a list of (digest, start, end) with binary digest and inclusive
+       end offset, as read by checksum_reader.read_subfile_blocks.
+       Returns None if file cannot be read"""
+    hash_func = hash_types[hash_type.upper()]
+    read_size = max(block_size, min_read_size // block_size * block_size)
+    whole = hash_func()
+    blocks = []
+    offset = 0
+    try:
+        fd = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        while True:
+            data = fd.read(read_size)
+            if not data:
+                break
+            whole.update(data)
+            view = memoryview(data)
+            for pos in xrange(0, len(data), block_size):
+                block = view[pos:pos + block_size]
+                blocks.append((hash_func(block).digest(),
+                               offset + pos, offset + pos + len(block) - 1))
+            offset += len(data)
+    except IOError:
+        return None
+    finally:
+        fd.close()
+    return path, whole.hexdigest(), blocks
+
+
+class _FileHasher(object):
+    "picklable wrapper binding hashing parameters for pool workers"
+
+    def __init__(self, block_size, hash_type):
+        self.block_size = block_size
+        self.hash_type = hash_type
+
+    def __call__(self, path):
+        return hash_file(path, self.block_size, self.hash_type)
+
+
+class BlockSpill(object):
+    """
+    (path, blocks) records written to an unlinked temporary file as files
+    are scanned, and read back in scan order each time the spill is
+    iterated, so block checksums of a large tree are not held in memory.
+    One iteration at a time
+    >>> spill = BlockSpill()
+    >>> spill.add('/a', [('\\x01', 0, 9), ('\\x02', 10, 12)])
+    >>> spill.add('/b', [('\\x01', 0, 9)])
+    >>> list(spill) == list(spill) == [('/a', [('\\x01', 0, 9),
+    ...                                        ('\\x02', 10, 12)]),
+    ...                                ('/b', [('\\x01', 0, 9)])]
+    True
+    >>> len(spill)
+    2
+    """
+
+    def __init__(self):
+        self.fd = tempfile.TemporaryFile()
+        self.pickler = pickle.Pickler(self.fd, pickle.HIGHEST_PROTOCOL)
+        self.count = 0
+
+    def add(self, path, blocks):
+        self.pickler.dump((path, blocks))
+        self.pickler.clear_memo()   # records are independent
+        self.count += 1
+
+    def __iter__(self):
+        self.fd.flush()
+        self.fd.seek(0)
+        unpickler = pickle.Unpickler(self.fd)
+        for i in xrange(self.count):
+            yield unpickler.load()
+        self.fd.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self.count
+
+
+def scan_tree(root, block_size, hash_type='MD5', threads=None):
+    """walks directory tree, hashing files across a thread pool.  hashlib
+       releases the GIL on large buffers, so threads scale with cores
+       without pickling block data between processes.  Yields
+       (path, checksum, blocks) in walk order"""
+    if not threads:
+        threads = multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    try:
+        hasher = _FileHasher(block_size, hash_type)
+        for result in pool.imap(hasher, walk_files(root), chunksize=8):
+            if result:
+                yield result
+    finally:
+        pool.terminate()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
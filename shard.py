@@ -0,0 +1,392 @@
+import os
+import json
+import heapq
+import struct
+import multiprocessing
+from binascii import hexlify
+from binascii import unhexlify
+from optparse import OptionParser
+import checksum_reader
+import dedupe
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+from partition import UnionFind
+
+#------------------------------------------------
+#
+# Sharded analysis, for checksum sets too large for one process.  Each
+# phase only reads and writes plain files in a shared work directory, so
+# phases can run as separate processes on one or several machines:
+#
+#   prepare      whole-file duplicates, block checksums split into ranges
+#   scatter I    blocks of range I, routed to shard by checksum
+#   reduce J     files holding each checksum of shard J, shared counts
+#   prune        files sharing at least min_blocks checksums
+#   link J       files connected by checksums of shard J
+#   merge        components across shards, each assigned to one worker
+#   analyse K    dedupe groups of components assigned to worker K
+#   gather       all dedupe groups, ordered as by dedupe.py
+#
+# Phases with an index run once for each of 0 .. shards-1, and all runs
+# of a phase must finish before the next phase starts.
+#
+# python shard.py -w /shared/run -n 16 prepare hashes.out subhashes.out
+# python shard.py -w /shared/run scatter 3
+# ...
+# python shard.py -w /shared/run gather
+#
+# or all phases with local worker processes:
+#
+# python shard.py -w /tmp/run -n 4 run hashes.out subhashes.out
+#
+#------------------------------------------------
+
+indexed_phases = ['scatter', 'reduce', 'link', 'analyse']
+phases = ['prepare', 'scatter', 'reduce', 'prune', 'link', 'merge',
+          'analyse', 'gather']
+
+
+def work_file(work, template, *indexes):
+    return os.path.join(work, template.format(*indexes))
+
+
+def load_config(work):
+    fd = open(work_file(work, 'shard.json'))
+    config = json.load(fd)
+    fd.close()
+    return config
+
+
+def read_lines(fname):
+    "yields lines of plain file, without trailing newline"
+    fd = open(fname)
+    for text in fd:
+        yield text.rstrip('\n')
+    fd.close()
+
+
+def shard_of(digest, start, shards):
+    """shard of block, from leading bytes of binary digest so that every
+       machine routes a block the same way
+    >>> shard_of('\\x01\\x00\\x00\\x00\\xff', 0, 4)
+    1
+    >>> shard_of('\\x01\\x00\\x00\\x00', 2, 4)
+    3
+    """
+    return (struct.unpack('<I', digest[:4])[0] ^ start) % shards
+
+
+def entry_name(entry):
+    "file name of '<order> <index> <name>' adjacency entry"
+    return entry.split(' ', 2)[2]
+
+
+def prepare(work, d_file, dsub_file, shards, min_blocks=2, hash_type='MD5',
+            cut_limit=0):
+    """finds whole-file duplicates and splits block checksums into shards
+       ranges at file boundaries.  Block checksums must not be compressed"""
+    if not os.path.isdir(work):
+        os.makedirs(work)
+    duplicates = dedupe.find_duplicateFiles(
+        d_file, json_duplicates_fname=dedupe.output_base(d_file) + '.json',
+        hash_type=hash_type)
+    dedupe.jdump(duplicates, work_file(work, 'duplicates.json'))
+    config = {'blocks': os.path.abspath(dsub_file),
+              'output': dedupe.output_base(dsub_file),
+              'shards': shards,
+              'offsets': checksum_reader.file_boundaries(dsub_file, shards,
+                                                         hash_type),
+              'min_blocks': min_blocks,
+              'hash_type': hash_type,
+              'cut_limit': cut_limit}
+    dedupe.jdump(config, work_file(work, 'shard.json'))
+
+
+def scatter(work, part):
+    """writes blocks of range part to scatter-<part>-<shard>.txt, skipping
+       files dedupe.construct_block_vector would skip.  Files are numbered
+       in input order, by range start plus position within range"""
+    config = load_config(work)
+    shards = config['shards']
+    fd = open(work_file(work, 'duplicates.json'))
+    dup_map = dedupe.create_duplicate_map(json.load(fd))
+    fd.close()
+    outputs = [open(work_file(work, 'scatter-{}-{}.txt', part, shard), 'w')
+               for shard in xrange(shards)]
+    (start, end) = config['offsets'][part:part + 2]
+    blocks_read = checksum_reader.read_subfile_range(
+        config['blocks'], start, end, config['hash_type'])
+    for position, (name, blocks) in enumerate(blocks_read):
+        if name in dup_map or len(blocks) < 2:
+            continue
+        for index, (digest, bstart, bend) in enumerate(blocks):
+            outputs[shard_of(digest, bstart, shards)].write(
+                '{} {} {} {} {} {}\n'.format(hexlify(digest), bstart, bend,
+                                             start + position, index, name))
+    for fd in outputs:
+        fd.close()
+
+
+def reduce_shard(work, shard):
+    """collects files holding each checksum of shard.  Writes checksums
+       held by several files to adjacency-<shard>.txt, one per line with
+       '<order> <index> <name>' entries, and number of such checksums of
+       each file to shared-<shard>.txt"""
+    config = load_config(work)
+    holders = {}
+    for part in xrange(config['shards']):
+        for text in read_lines(work_file(work, 'scatter-{}-{}.txt',
+                                         part, shard)):
+            (digest, start, end, entry) = text.split(' ', 3)
+            key = ' '.join((digest, start, end))
+            if key in holders:
+                holders[key].append(entry)
+            else:
+                holders[key] = [entry]
+
+    shared = {}
+    fd = open(work_file(work, 'adjacency-{}.txt', shard), 'w')
+    for key, entries in holders.iteritems():
+        if len(entries) > 1:
+            fd.write(key + '\t' + '\t'.join(entries) + '\n')
+            for entry in entries:
+                name = entry_name(entry)
+                shared[name] = shared.get(name, 0) + 1
+    fd.close()
+    fd = open(work_file(work, 'shared-{}.txt', shard), 'w')
+    for name, count in shared.iteritems():
+        fd.write('{}\t{}\n'.format(count, name))
+    fd.close()
+
+
+def prune(work):
+    "writes names of files sharing at least min_blocks checksums to kept.txt"
+    config = load_config(work)
+    counts = {}
+    for shard in xrange(config['shards']):
+        for text in read_lines(work_file(work, 'shared-{}.txt', shard)):
+            (count, name) = text.split('\t', 1)
+            counts[name] = counts.get(name, 0) + int(count)
+    fd = open(work_file(work, 'kept.txt'), 'w')
+    for name in sorted(counts):
+        if counts[name] >= config['min_blocks']:
+            fd.write(name + '\n')
+    fd.close()
+
+
+def connected_names(name_lists):
+    """components of names joined by each list of names, as lists of
+       names, leaving out single names"""
+    ids = {}
+    names = []
+    sets = UnionFind()
+    for members in name_lists:
+        member_ids = []
+        for name in members:
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+            member_ids.append(ids[name])
+        sets.union_all(member_ids)
+    components = {}
+    for idx, name in enumerate(names):
+        components.setdefault(sets.find(idx), []).append(name)
+    return [members for members in components.itervalues()
+            if len(members) > 1]
+
+
+def link(work, shard):
+    """writes components of kept files joined by checksums of shard to
+       components-<shard>.txt, one per line"""
+    kept = set(read_lines(work_file(work, 'kept.txt')))
+    lists = ([name for name in (entry_name(entry)
+                                for entry in text.split('\t')[1:])
+              if name in kept]
+             for text in read_lines(work_file(work, 'adjacency-{}.txt',
+                                              shard)))
+    fd = open(work_file(work, 'components-{}.txt', shard), 'w')
+    for members in connected_names(members for members in lists
+                                   if len(members) > 1):
+        fd.write('\t'.join(members) + '\n')
+    fd.close()
+
+
+def merge(work):
+    """joins components of all shards and assigns each to a worker, largest
+       first to the least loaded worker.  Writes '<worker> <component>
+       <name>' lines to routes.txt"""
+    config = load_config(work)
+    lists = (text.split('\t') for shard in xrange(config['shards'])
+             for text in read_lines(work_file(work, 'components-{}.txt',
+                                              shard)))
+    components = sorted(connected_names(lists), key=len, reverse=True)
+    load = [(0, worker) for worker in xrange(config['shards'])]
+    fd = open(work_file(work, 'routes.txt'), 'w')
+    for component, members in enumerate(components):
+        (files, worker) = heapq.heappop(load)
+        heapq.heappush(load, (files + len(members), worker))
+        for name in members:
+            fd.write('{}\t{}\t{}\n'.format(worker, component, name))
+    fd.close()
+
+
+def analyse(work, worker):
+    """dedupe groups of components assigned to worker, written to
+       groups-<worker>.json as [order, group] pairs.  Files and checksums
+       are numbered in input order, so groups are as found by dedupe.py"""
+    config = load_config(work)
+    dedupe.cut_limit = config['cut_limit']
+    component_of = {}
+    for text in read_lines(work_file(work, 'routes.txt')):
+        (target, component, name) = text.split('\t', 2)
+        if int(target) == worker:
+            component_of[name] = int(component)
+
+    files = {}          # name -> (order, [(index, key)])
+    first_seen = {}     # key -> (order, index) of first file holding it
+    for shard in xrange(config['shards']):
+        for text in read_lines(work_file(work, 'adjacency-{}.txt', shard)):
+            fields = text.split('\t')
+            entries = [entry.split(' ', 2) for entry in fields[1:]]
+            members = [(int(order), int(index), name)
+                       for order, index, name in entries
+                       if name in component_of]
+            if not members:
+                continue
+            key = fields[0]
+            first_seen[key] = min((int(order), int(index))
+                                  for order, index, name in entries)
+            for order, index, name in members:
+                if name not in files:
+                    files[name] = (order, [])
+                files[name][1].append((index, key))
+
+    FnameMap.reset()
+    ChecksumMap.reset()
+    hnos = {}
+    for key in sorted(first_seen, key=first_seen.get):
+        (digest, start, end) = key.split(' ')
+        hnos[key] = ChecksumMap.get_block_id(unhexlify(digest), int(start),
+                                             int(end))
+    partitions = {}
+    for name in sorted(files, key=lambda name: files[name][0]):
+        (order, blocks) = files[name]
+        vec = [FnameMap.get_id(name),
+               [hnos[key] for index, key in sorted(blocks)]]
+        partitions.setdefault(component_of[name], []).append((order, vec))
+
+    ordered = sorted(partitions.itervalues(), key=lambda members: members[0])
+    groups = dedupe.iter_partition_analysis(
+        [[vec for order, vec in members] for members in ordered])
+    results = [[members[0][0], group]
+               for members, group in zip(ordered, groups)]
+    dedupe.jdump(results, work_file(work, 'groups-{}.json', worker))
+
+
+def gather(work, ndjson=False):
+    "writes dedupe groups of all workers, in input order of first file"
+    config = load_config(work)
+    results = []
+    for worker in xrange(config['shards']):
+        fd = open(work_file(work, 'groups-{}.json', worker))
+        results.extend(json.load(fd))
+        fd.close()
+    results.sort(key=lambda result: result[0])
+    dedupe.write_groups([group for order, group in results],
+                        config['output'], ndjson)
+
+
+def run_phase(args):
+    "runs one phase, args is (phase, work, index)"
+    (phase, work, index) = args
+    {'scatter': scatter, 'reduce': reduce_shard, 'link': link,
+     'analyse': analyse}[phase](work, index)
+
+
+def run_all(work, d_file, dsub_file, shards, jobs, min_blocks=2,
+            hash_type='MD5', cut_limit=0, ndjson=False):
+    "runs all phases in turn, indexed phases using jobs local processes"
+    prepare(work, d_file, dsub_file, shards, min_blocks, hash_type,
+            cut_limit)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for phase in phases[1:-1]:
+            dedupe.dprint('phase ' + phase)
+            if phase in indexed_phases:
+                pool.map(run_phase, [(phase, work, index)
+                                     for index in xrange(shards)])
+            elif phase == 'prune':
+                prune(work)
+            else:
+                merge(work)
+        pool.close()
+    finally:
+        pool.terminate()
+    gather(work, ndjson)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(
+        usage='usage: %prog [options] prepare|run whole_checksums' +
+              ' block_checksums\n' +
+              '       %prog [options] scatter|reduce|link|analyse INDEX\n' +
+              '       %prog [options] prune|merge|gather')
+    parser.add_option("-w", "--work", type='string', default='',
+                      dest="work",
+                      help="work DIR shared by all phases",
+                      metavar="DIR")
+    parser.add_option("-n", "--shards", type='int',
+                      default=multiprocessing.cpu_count(), dest="shards",
+                      help="number of shards, and of workers for each" +
+                           " indexed phase")
+    parser.add_option("-j", "--jobs", type='int', default=0, dest="jobs",
+                      help="local processes used by run, defaults to" +
+                           " number of shards")
+    parser.add_option("-c", "--checksum_type", type='string',
+                      default="MD5", dest="hash_type",
+                      help="format of checksum in input file," +
+                           " where checksum TYPE is MD5 or SHA256",
+                      metavar="TYPE")
+    parser.add_option("-m", "--min_blocks", type='int', default=2,
+                      dest="min_blocks",
+                      help="minimum number of BLOCKS that a file must share" +
+                           " to be considered a candidate for dedupe",
+                      metavar="BLOCKS")
+    parser.add_option("--cut_limit", type='int', default=0,
+                      dest="cut_limit",
+                      help="maximum number of augmenting PATHS searched" +
+                           " when splitting conflicts, 0 for no limit",
+                      metavar="PATHS")
+    parser.add_option("--ndjson", default=False, action="store_true",
+                      dest="ndjson",
+                      help="gather writes groups to .dedupe.ndjson file")
+    parser.add_option("-d", "--debug", default=False, action="store_true",
+                      dest="debug",
+                      help="logs information to console for debug purposes")
+    (options, args) = parser.parse_args()
+
+    dedupe.debug = options.debug
+    dedupe.display_graph_flag = False
+    if not options.work or not args or args[0] not in phases + ['run']:
+        parser.error('work directory and phase required')
+    phase = args[0]
+    if phase in ('prepare', 'run') and len(args) != 3:
+        parser.error(phase + ' requires whole_checksums and block_checksums')
+    if phase in indexed_phases and len(args) != 2:
+        parser.error(phase + ' requires INDEX')
+
+    if phase == 'run':
+        run_all(options.work, args[1], args[2], options.shards,
+                options.jobs or options.shards, options.min_blocks,
+                options.hash_type, options.cut_limit, options.ndjson)
+    elif phase == 'prepare':
+        prepare(options.work, args[1], args[2], options.shards,
+                options.min_blocks, options.hash_type, options.cut_limit)
+    elif phase in indexed_phases:
+        run_phase((phase, options.work, int(args[1])))
+    elif phase == 'prune':
+        prune(options.work)
+    elif phase == 'merge':
+        merge(options.work)
+    else:
+        gather(options.work, options.ndjson)
@@ -0,0 +1,316 @@
+import os
+import sqlite3
+import tempfile
+from array import array
+from binascii import hexlify
+from binascii import unhexlify
+from collections import OrderedDict
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+from fname_map import ChecksumTable
+from fname_map import CompactChecksumTable
+from path_table import PrefixFnameTable
+
+#---------------------------------------------------
+# FnameMap and ChecksumMap storage moved to SQLite beyond a memory budget,
+# with a cache of recently used entries in front
+#---------------------------------------------------
+
+# approximate memory taken by each entry of an LRUCache
+cache_entry_cost = 200
+
+
+class LRUCache(object):
+    """
+    mapping of at most capacity entries, dropping least recently used
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1); cache.put('b', 2); cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b'), cache.get('a'), cache.get('c')
+    (None, 1, 3)
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1)
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        "value of key, or None, marking key as recently used"
+        entries = self.entries
+        if key not in entries:
+            return None
+        value = entries.pop(key)
+        entries[key] = value
+        return value
+
+    def put(self, key, value):
+        entries = self.entries
+        entries.pop(key, None)
+        entries[key] = value
+        if len(entries) > self.capacity:
+            entries.popitem(last=False)
+
+
+def open_spill_db(schema):
+    """SQLite database in a temporary file.  The file is removed once open,
+       so its space is reclaimed when the process exits"""
+    (fd, fname) = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    db = sqlite3.connect(fname)
+    db.text_factory = str       # file names need not be UTF-8
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    for statement in schema:
+        db.execute(statement)
+    os.remove(fname)
+    return db
+
+
+class SpillFnameTable(PrefixFnameTable):
+    """
+    FnameMap storage held as a PrefixFnameTable until it takes about
+    memory_limit bytes, then moved to SQLite
+    >>> SpillFnameTable.memory_limit = 400
+    >>> table = SpillFnameTable()
+    >>> [table.get_id('/dir{}/file{}'.format(i, i)) for i in range(4)]
+    [0, 1, 2, 3]
+    >>> table.db is not None, table.get_name(1), table.get_name(3), len(table)
+    (True, '/dir1/file1', '/dir3/file3', 4)
+    >>> SpillFnameTable.memory_limit = 0
+    """
+
+    memory_limit = 0        # bytes, 0 for no limit
+    file_overhead = 12      # offset and directory id arrays, beyond name
+    dir_overhead = 150      # trie dict slot, key tuple and component
+
+    def __init__(self):
+        PrefixFnameTable.__init__(self)
+        self.count = 0
+        self.db = None
+        self.cache = None
+
+    def size(self):
+        "approximate memory held before spilling, in bytes"
+        return len(self.names) + self.file_overhead * len(self.file_dirs) + \
+            self.dir_overhead * len(self.dirs)
+
+    def get_id(self, text):
+        if self.db is None:
+            idx = PrefixFnameTable.get_id(self, text)
+            if self.memory_limit and self.size() > self.memory_limit:
+                self.spill()
+            return idx
+        idx = self.count
+        self.db.execute('INSERT INTO names VALUES (?, ?)', (idx, text))
+        self.count += 1
+        self.cache.put(idx, text)
+        return idx
+
+    def get_name(self, idx):
+        if self.db is None:
+            return PrefixFnameTable.get_name(self, idx)
+        name = self.cache.get(idx)
+        if name is None:
+            (name,) = self.db.execute('SELECT name FROM names WHERE id = ?',
+                                      (idx,)).fetchone()
+            self.cache.put(idx, name)
+        return name
+
+    def spill(self):
+        "moves names to SQLite, keeping recently used names in memory"
+        self.db = open_spill_db(['CREATE TABLE names' +
+                                 ' (id INTEGER PRIMARY KEY, name TEXT)'])
+        self.count = len(self.file_dirs)
+        self.db.executemany('INSERT INTO names VALUES (?, ?)',
+                            ((idx, PrefixFnameTable.get_name(self, idx))
+                             for idx in xrange(self.count)))
+        PrefixFnameTable.__init__(self)     # releases in memory storage
+        self.cache = LRUCache(self.memory_limit // (2 * cache_entry_cost))
+
+    def __len__(self):
+        if self.db is None:
+            return len(self.file_dirs)
+        return self.count
+
+    def __getstate__(self):
+        "spilled names are pickled as a list, and spilled again once loaded"
+        if self.db is None:
+            return self.__dict__
+        return {'spilled_names': [name for (name,) in self.db.execute(
+                    'SELECT name FROM names ORDER BY id')]}
+
+    def __setstate__(self, state):
+        self.__init__()
+        if 'spilled_names' in state:
+            for name in state['spilled_names']:
+                self.get_id(name)
+        else:
+            self.__dict__.update(state)
+
+
+# approximate memory taken by each checksum of in memory tables
+checksum_entry_costs = {ChecksumTable: 250, CompactChecksumTable: 40}
+
+
+class SpillChecksumTable(object):
+    """
+    ChecksumMap storage held in a memory_type table (ChecksumTable or
+    CompactChecksumTable) until memory_limit bytes are reached, then moved
+    to SQLite with fingerprint to id and id to checksum caches in front.
+    Counts stay in memory, as an array of 4 bytes per checksum, since
+    every id is counted and pruned.  Only accepts md5deep style hvals
+    >>> SpillChecksumTable.memory_limit = 1000
+    >>> table = SpillChecksumTable()
+    >>> ids = [table.get_block_id(chr(i), 0, 9) for i in range(6)]
+    >>> table.db is not None, table.get_block_id('\\x02', 0, 9), len(table)
+    (True, 2, 6)
+    >>> table.get_id({'c': '07', 'r': '_10_19'}), table.get_count(2)
+    (6, 2)
+    >>> table.get_hval(6), table.get_hval(0)
+    ({'c': '07', 'r': '_10_19'}, {'c': '00', 'r': '_0_9'})
+    >>> SpillChecksumTable.memory_type = CompactChecksumTable
+    >>> table = SpillChecksumTable()
+    >>> ids = [table.get_block_id(chr(i), 0, 9) for i in range(30)]
+    >>> table.db is not None, table.get_block_id('\\x1d', 0, 9), len(table)
+    (True, 29, 30)
+    >>> SpillChecksumTable.memory_limit = 0
+    >>> SpillChecksumTable.memory_type = ChecksumTable
+    """
+
+    memory_limit = 0                # bytes, 0 for no limit
+    memory_type = ChecksumTable     # storage until spilled
+
+    def __init__(self):
+        self.memory = self.memory_type()
+        self.entry_cost = checksum_entry_costs[self.memory_type]
+        self.counts = None
+        self.db = None
+        self.ids = None
+        self.hvals = None
+
+    def get_id(self, hval):
+        (blank, start, end) = hval['r'].split('_')
+        return self.get_block_id(unhexlify(hval['c']), int(start), int(end))
+
+    def get_block_id(self, digest, start, end):
+        if self.db is None:
+            idx = self.memory.get_block_id(digest, start, end)
+            if self.memory_limit and \
+                    len(self.memory) * self.entry_cost > self.memory_limit:
+                self.spill()
+            return idx
+        fingerprint = (digest, start, end)
+        idx = self.ids.get(fingerprint)
+        if idx is None:
+            row = self.db.execute(
+                'SELECT id FROM csums WHERE digest = ? AND' +
+                ' start_offset = ? AND end_offset = ?',
+                (buffer(digest), start, end)).fetchone()
+            if row:
+                idx = row[0]
+            else:
+                idx = len(self.counts)
+                self.db.execute('INSERT INTO csums VALUES (?, ?, ?, ?)',
+                                (idx, buffer(digest), start, end))
+                self.counts.append(0)
+            self.ids.put(fingerprint, idx)
+        self.counts[idx] += 1
+        return idx
+
+    def get_hval(self, idx):
+        if self.db is None:
+            return self.memory.get_hval(idx)
+        hval = self.hvals.get(idx)
+        if hval is None:
+            (digest, start, end) = self.db.execute(
+                'SELECT digest, start_offset, end_offset FROM csums' +
+                ' WHERE id = ?', (idx,)).fetchone()
+            hval = {'c': hexlify(digest), 'r': '_{}_{}'.format(start, end)}
+            self.hvals.put(idx, hval)
+        return hval
+
+    def get_count(self, idx):
+        if self.db is None:
+            return self.memory.get_count(idx)
+        return self.counts[idx]
+
+    def add_count(self, idx, count):
+        if self.db is None:
+            self.memory.add_count(idx, count)
+        else:
+            self.counts[idx] += count
+
+    def blocks(self):
+        "(digest, start, end) of each checksum in id order"
+        if self.db is None:
+            for idx in xrange(len(self.memory)):
+                hval = self.memory.get_hval(idx)
+                (blank, start, end) = hval['r'].split('_')
+                yield (unhexlify(hval['c']), int(start), int(end))
+        else:
+            for digest, start, end in self.db.execute(
+                    'SELECT digest, start_offset, end_offset' +
+                    ' FROM csums ORDER BY id'):
+                yield (str(digest), start, end)
+
+    def spill(self):
+        """moves checksums to SQLite, keeping recently used fingerprints
+           and checksums in memory.  Lookups match all three columns, so
+           the index covers them all, as one digest (e.g. of zeros) may
+           appear at many offsets"""
+        db = open_spill_db(['CREATE TABLE csums' +
+                            ' (id INTEGER PRIMARY KEY, digest BLOB,' +
+                            ' start_offset INTEGER, end_offset INTEGER)'])
+        db.executemany('INSERT INTO csums VALUES (?, ?, ?, ?)',
+                       ((idx, buffer(digest), start, end)
+                        for idx, (digest, start, end)
+                        in enumerate(self.blocks())))
+        db.execute('CREATE UNIQUE INDEX csum_blocks ON csums' +
+                   ' (digest, start_offset, end_offset)')
+        self.counts = array('i', (self.memory.get_count(idx)
+                                  for idx in xrange(len(self.memory))))
+        self.db = db
+        self.memory = None
+        capacity = self.memory_limit // (4 * cache_entry_cost)
+        self.ids = LRUCache(capacity)
+        self.hvals = LRUCache(capacity)
+
+    def __len__(self):
+        if self.db is None:
+            return len(self.memory)
+        return len(self.counts)
+
+    def __getstate__(self):
+        "spilled checksums are pickled as a list, spilled again once loaded"
+        if self.db is None:
+            return self.__dict__
+        return {'spilled_blocks': list(self.blocks()),
+                'counts': self.counts}
+
+    def __setstate__(self, state):
+        self.__init__()
+        if 'spilled_blocks' in state:
+            for idx, block in enumerate(state['spilled_blocks']):
+                self.get_block_id(*block)
+                self.add_count(idx, state['counts'][idx] - 1)
+        else:
+            self.__dict__.update(state)
+
+
+def use_spill_tables(memory_limit, compact=False):
+    """selects FnameMap and ChecksumMap storage moved to SQLite once
+       memory_limit bytes are reached, most of which goes to checksums.
+       Until then, checksums are held in a CompactChecksumTable if
+       compact, otherwise in a ChecksumTable"""
+    SpillFnameTable.memory_limit = memory_limit // 4
+    SpillChecksumTable.memory_limit = memory_limit - memory_limit // 4
+    SpillChecksumTable.memory_type = \
+        CompactChecksumTable if compact else ChecksumTable
+    FnameMap.reset(SpillFnameTable)
+    ChecksumMap.reset(SpillChecksumTable)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
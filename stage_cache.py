@@ -0,0 +1,121 @@
+import os
+import gc
+import hashlib
+import cPickle as pickle
+
+#---------------------------------------------------
+# On-disk cache of pipeline stage results, keyed by stage inputs
+#---------------------------------------------------
+
+cache_version = 1       # bump when format of any cached stage changes
+
+
+def file_fingerprint(fname, chunk_size=1 << 20):
+    "(size, mtime, md5 of content) of fname"
+    stat = os.stat(fname)
+    digest = hashlib.md5()
+    fd = open(fname, 'rb')
+    try:
+        for chunk in iter(lambda: fd.read(chunk_size), ''):
+            digest.update(chunk)
+    finally:
+        fd.close()
+    return (stat.st_size, stat.st_mtime, digest.hexdigest())
+
+
+class StageCache(object):
+    """
+    pickled stage results in a directory, one file per (stage, key).
+    Entries are touched when read, and beyond limit bytes the least
+    recently used entries are evicted
+    >>> import tempfile
+    >>> cache = StageCache(tempfile.mkdtemp(), limit=100)
+    >>> key = StageCache.key('input', 2)
+    >>> cache.contains('groups', key)
+    False
+    >>> cache.put('groups', key, [{'files': ['/a', '/b']}])
+    >>> cache.contains('groups', key), cache.get('groups', key)
+    (True, [{'files': ['/a', '/b']}])
+    >>> cache.put('pruned', key, range(40))       # over limit, evicts groups
+    >>> cache.contains('groups', key), cache.contains('pruned', key)
+    (False, True)
+    >>> cache.clear()
+    >>> cache.contains('pruned', key)
+    False
+    >>> os.rmdir(cache.directory)
+    """
+
+    suffix = '.pickle'
+
+    def __init__(self, directory, limit=0):
+        self.directory = directory
+        self.limit = limit          # bytes, 0 for no limit
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        "key for stage inputs and parameters, e.g. file fingerprints"
+        return hashlib.sha1(repr((cache_version,) + parts)).hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.directory, stage + '-' + key + self.suffix)
+
+    def contains(self, stage, key):
+        return os.path.exists(self._path(stage, key))
+
+    def get(self, stage, key):
+        "cached value of stage for key, marking entry as recently used"
+        fname = self._path(stage, key)
+        fd = open(fname, 'rb')
+        gc.disable()    # collector passes over large results add minutes
+        try:
+            value = pickle.load(fd)
+        finally:
+            gc.enable()
+            fd.close()
+        os.utime(fname, None)
+        return value
+
+    def put(self, stage, key, value):
+        """stores value of stage for key, replacing any earlier entry only
+           once complete, then evicts entries beyond limit"""
+        fname = self._path(stage, key)
+        fd = open(fname + '.tmp', 'wb')
+        gc.disable()
+        try:
+            pickle.dump(value, fd, pickle.HIGHEST_PROTOCOL)
+        finally:
+            gc.enable()
+            fd.close()
+        os.rename(fname + '.tmp', fname)
+        if self.limit:
+            self.evict(self.limit)
+
+    def entries(self):
+        "(mtime, size, path) of each entry, least recently used first"
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                result.append((stat.st_mtime, stat.st_size, path))
+        return sorted(result)
+
+    def evict(self, limit):
+        "removes least recently used entries until total size is within limit"
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= limit:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
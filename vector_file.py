@@ -0,0 +1,201 @@
+import struct
+import itertools
+from binascii import hexlify
+from binascii import unhexlify
+import numpy as np
+from fname_map import FnameMap
+from fname_map import ChecksumMap
+
+#---------------------------------------------------
+# Binary columnar vector set files, reopened with numpy.memmap
+#---------------------------------------------------
+#
+# Layout, all integers little-endian, each section padded to 8 bytes:
+#
+#   header      magic, then nvectors, nentries, nfiles, ncsums,
+#               digest_size, names_size as int64
+#   files       int32[nvectors]         fno of each vector
+#   offsets     int64[nvectors + 1]     vector i is csums[offsets[i]:..]
+#   csums       int32[nentries]         hno of each vector entry
+#   starts      int64[ncsums]           block start of each checksum
+#   ends        int64[ncsums]           block end (inclusive)
+#   counts      int32[ncsums]           occurrences of each checksum
+#   digests     uint8[ncsums, digest_size]
+#   name_ptr    int64[nfiles + 1]       file name i is names[name_ptr[i]:..]
+#   names       uint8[names_size]
+
+magic = 'DDVECT01'
+header = struct.Struct('<8s6q')
+
+
+def _sections(nvectors, nentries, nfiles, ncsums, digest_size, names_size):
+    "(name, dtype, shape, offset) of each section following header"
+    shapes = [('files', '<i4', (nvectors,)),
+              ('offsets', '<i8', (nvectors + 1,)),
+              ('csums', '<i4', (nentries,)),
+              ('starts', '<i8', (ncsums,)),
+              ('ends', '<i8', (ncsums,)),
+              ('counts', '<i4', (ncsums,)),
+              ('digests', 'u1', (ncsums, digest_size)),
+              ('name_ptr', '<i8', (nfiles + 1,)),
+              ('names', 'u1', (names_size,))]
+    result = []
+    offset = header.size
+    for name, dtype, shape in shapes:
+        result.append((name, dtype, shape, offset))
+        size = np.dtype(dtype).itemsize * int(np.prod(shape))
+        offset += (size + 7) & ~7
+    return result
+
+
+def _write_array(fd, values):
+    values.tofile(fd)
+    fd.write('\0' * (-values.nbytes & 7))
+
+
+def write_vectors(fname, vector_set):
+    """writes [fno, [hno, ...]] vectors, with the FnameMap and ChecksumMap
+       tables they refer to, in a single sequential pass"""
+    nfiles = FnameMap.size()
+    ncsums = ChecksumMap.size()
+    lengths = np.fromiter((len(hset) for fno, hset in vector_set),
+                          dtype=np.int64, count=len(vector_set))
+    offsets = np.zeros(len(vector_set) + 1, dtype='<i8')
+    np.cumsum(lengths, out=offsets[1:])
+
+    digests = []
+    starts = np.zeros(ncsums, dtype='<i8')
+    ends = np.zeros(ncsums, dtype='<i8')
+    for hno in xrange(ncsums):
+        hval = ChecksumMap.get_hval(hno)
+        (blank, start, end) = hval['r'].split('_')
+        digests.append(unhexlify(hval['c']))
+        starts[hno] = int(start)
+        ends[hno] = int(end)
+    digest_size = len(digests[0]) if digests else 0
+    if any(len(digest) != digest_size for digest in digests):
+        raise ValueError('Error: mixed checksum types')
+
+    name_ptr = np.zeros(nfiles + 1, dtype='<i8')
+    np.cumsum(np.fromiter((len(FnameMap.get_name(fno))
+                           for fno in xrange(nfiles)),
+                          dtype=np.int64, count=nfiles), out=name_ptr[1:])
+
+    fd = open(fname, 'wb')
+    try:
+        fd.write(header.pack(magic, len(vector_set), int(offsets[-1]),
+                             nfiles, ncsums, digest_size, int(name_ptr[-1])))
+        _write_array(fd, np.fromiter((fno for fno, hset in vector_set),
+                                     dtype='<i4', count=len(vector_set)))
+        _write_array(fd, offsets)
+        _write_array(fd, np.fromiter(
+            itertools.chain.from_iterable(hset for fno, hset in vector_set),
+            dtype='<i4', count=int(offsets[-1])))
+        _write_array(fd, starts)
+        _write_array(fd, ends)
+        _write_array(fd, np.fromiter(
+            (ChecksumMap.get_count(hno) for hno in xrange(ncsums)),
+            dtype='<i4', count=ncsums))
+        fd.write(''.join(digests))
+        fd.write('\0' * (-ncsums * digest_size & 7))
+        _write_array(fd, name_ptr)
+        for fno in xrange(nfiles):
+            fd.write(FnameMap.get_name(fno))
+    finally:
+        fd.close()
+
+
+class MappedFnameTable(object):
+    "read-only FnameMap storage over a vector file"
+
+    def __init__(self, name_ptr, names):
+        self.name_ptr = name_ptr
+        self.names = names
+
+    def get_name(self, idx):
+        return self.names[self.name_ptr[idx]:self.name_ptr[idx + 1]].tostring()
+
+    def __len__(self):
+        return len(self.name_ptr) - 1
+
+
+class MappedChecksumTable(object):
+    "read-only ChecksumMap storage over a vector file"
+
+    def __init__(self, digests, starts, ends, counts):
+        self.digests = digests
+        self.starts = starts
+        self.ends = ends
+        self.counts = counts
+
+    def get_hval(self, idx):
+        return {'c': hexlify(self.digests[idx].tostring()),
+                'r': '_{}_{}'.format(self.starts[idx], self.ends[idx])}
+
+    def get_count(self, idx):
+        return int(self.counts[idx])
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class VectorFile(object):
+    """
+    vector set file opened through numpy.memmap, without parsing.
+    Iterating gives [fno, [hno, ...]] vectors; files, offsets and csums
+    arrays can also be used directly, e.g. by external clustering tools
+    >>> import os, tempfile
+    >>> FnameMap.reset(); ChecksumMap.reset()
+    >>> blocks = [ChecksumMap.get_block_id('\\xab\\xcd', 0, 9),
+    ...           ChecksumMap.get_block_id('\\xef\\x01', 10, 19)]
+    >>> vectors = [[FnameMap.get_id('/a'), blocks],
+    ...            [FnameMap.get_id('/b'),
+    ...             [ChecksumMap.get_block_id('\\xab\\xcd', 0, 9)]]]
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'test.vectors')
+    >>> write_vectors(fname, vectors)
+    >>> vfile = VectorFile(fname)
+    >>> list(vfile), len(vfile), vfile.offsets.tolist()
+    ([[0, [0, 1]], [1, [0]]], 2, [0, 2, 3])
+    >>> vfile.restore_maps()
+    >>> FnameMap.get_name(1), ChecksumMap.get_count(0), ChecksumMap.get_hval(1)
+    ('/b', 2, {'c': 'ef01', 'r': '_10_19'})
+    >>> os.remove(fname)
+    >>> FnameMap.reset(); ChecksumMap.reset()
+    """
+
+    def __init__(self, fname):
+        fd = open(fname, 'rb')
+        try:
+            values = header.unpack(fd.read(header.size))
+        finally:
+            fd.close()
+        if values[0] != magic:
+            raise ValueError('Error: {} is not a vector file'.format(fname))
+        for name, dtype, shape, offset in _sections(*values[1:]):
+            if 0 in shape:      # memmap cannot map empty sections
+                array = np.zeros(shape, dtype=dtype)
+            else:
+                array = np.memmap(fname, dtype=dtype, mode='r',
+                                  offset=offset, shape=shape)
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        offsets = self.offsets.tolist()
+        csums = self.csums
+        for idx, fno in enumerate(self.files.tolist()):
+            yield [fno, csums[offsets[idx]:offsets[idx + 1]].tolist()]
+
+    def restore_maps(self):
+        """points FnameMap and ChecksumMap at the file's tables, so the
+           vectors can be analysed and results resolved to names"""
+        FnameMap.table = MappedFnameTable(self.name_ptr, self.names)
+        ChecksumMap.table = MappedChecksumTable(self.digests, self.starts,
+                                                self.ends, self.counts)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()